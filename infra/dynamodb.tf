@@ -9,6 +9,8 @@
 # - Global secondary index for phase and timestamp
 # - Global secondary index for geohash5 and timestamp
 # - Global secondary index for geohash12 and timestamp
+# - Global secondary index for date_key and timestamp
+# Region/time and day queries go through the geohash5 and date_key indexes (see tools/reports/dynamodb_query.py)
 
 resource "aws_dynamodb_table" "mros_dynamodb_table" {
   name           = var.dynamodb_table_name
@@ -84,6 +86,20 @@ resource "aws_dynamodb_table" "mros_dynamodb_table" {
       type = "S"
   }
 
+  # create a global secondary index for date_key (day the record was staged, "YYYY_MM_DD") and timestamp
+  global_secondary_index {
+    name               = "date_key-timestamp-index"
+    hash_key           = "date_key"
+    range_key          = "timestamp"
+    projection_type    = "ALL"
+  } 
+
+  # set date_key attribute
+  attribute {
+      name = "date_key"
+      type = "S"
+  }
+
 }
 
 # # DynamoDB table policy to allow lambda to write to table
@@ -379,6 +379,7 @@ data "aws_iam_policy_document" "lambda_dynamodb_policy_doc" {
 
     actions = [
       "dynamodb:GetItem",
+      "dynamodb:BatchGetItem",
       "dynamodb:PutItem",
       "dynamodb:UpdateItem",
       "dynamodb:BatchWriteItem",
@@ -452,6 +453,21 @@ data "aws_iam_policy_document" "sqs_consumer_lambda_policy_doc" {
     # }
   }
 
+  # mros_append_daily_data deletes master dataset files that are no longer in the manifest (see master_manifest.py)
+  statement {
+    sid = "MasterDatasetDeletePermissions"
+
+    effect = "Allow"
+
+    actions = [
+      "s3:DeleteObject"
+    ]
+
+    resources = [
+      "${data.aws_s3_bucket.output_s3_bucket.arn}/mros_output/*",
+    ]
+  }
+
   statement {
     sid = "SQSReadDeletePermissions"
     
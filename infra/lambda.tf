@@ -265,8 +265,9 @@ resource "aws_lambda_function" "mros_append_daily_data_lambda_function" {
   architectures    = ["x86_64"]
   # architectures    = ["arm64"]
 
-  # # Pandas lambda layer
-  layers = ["arn:aws:lambda:us-west-1:336392948345:layer:AWSSDKPandas-Python311:6"]
+  # # Pandas lambda layer, must bundle botocore >= 1.35.69 for the conditional writes of master_manifest.py
+  layers = [var.mros_append_daily_data_pandas_layer_arn]
+  # layers = ["arn:aws:lambda:us-west-1:336392948345:layer:AWSSDKPandas-Python311:6"]
 
   # # Pandas lambda layer
   # layers = ["arn:aws:lambda:us-west-1:336392948345:layer:AWSSDKPandas-Python311:4"]
@@ -278,15 +279,28 @@ resource "aws_lambda_function" "mros_append_daily_data_lambda_function" {
   # memory in MB
   memory_size     = 3400
 
-  # Only allow for a maximum of 1 Lambdas to be run concurrently
-  reserved_concurrent_executions = 1
+  # Appenders commit to the master dataset manifest with conditional writes (see master_manifest.py),
+  # so several can run at once
+  reserved_concurrent_executions = 5
 
   # Attach the Lambda function to the CloudWatch Logs group
   environment {
     variables = {
         CW_LOG_GROUP         = aws_cloudwatch_log_group.prod_to_output_lambda_log_group.name,
         OUTPUT_S3_BUCKET     = data.aws_s3_bucket.output_s3_bucket.bucket,
-        OUTPUT_OBJECT_KEY    = "mros_output.csv"
+        OUTPUT_OBJECT_KEY    = "mros_output.csv",
+        # master dataset lives in "mros_output/" (manifest + snapshot/delta Parquet files),
+        # "mros_output.parquet" and the CSV are derived exports rewritten after each compaction, so they lag the
+        # manifest by up to MASTER_COMPACT_DELTAS - 1 appends ("master-version" object metadata = manifest version)
+        WRITE_CSV_EXPORT     = "true",
+        MASTER_COMMIT_RETRIES = "8",
+        MASTER_COMPACT_DELTAS = "10",
+        # files superseded by a compaction are deleted after this many seconds (at least the timeout)
+        MASTER_GC_GRACE_S     = "900",
+        # columns missing from master_schema.py are kept as strings ("drop" to leave them out, "fail" to stop the queue)
+        MASTER_UNKNOWN_COLUMNS = "string",
+        # /tmp cache of the master dataset files for warm containers (must fit in the 512 MB ephemeral storage)
+        MASTER_CACHE_MAX_MB   = "400"
   }
   }
 
@@ -377,6 +391,15 @@ resource "aws_lambda_function" "mros_insert_into_dynamodb_lambda_function" {
     variables = {
         CW_LOG_GROUP         = aws_cloudwatch_log_group.mros_insert_into_dynamodb_lambda_log_group.name,
         DYNAMODB_TABLE       = aws_dynamodb_table.mros_dynamodb_table.name,
+        # parallel BatchWriteItem writer (see batch_writer.py), the write rate adapts to throttling from DYNAMODB_WRITE_RATE
+        DYNAMODB_WRITE_WORKERS = "8",
+        DYNAMODB_WRITE_RETRIES = "10",
+        DYNAMODB_WRITE_RATE    = "1000",
+        # skip items that are already in the table unchanged (BatchGetItem lookup of the stored item_hash)
+        DYNAMODB_WRITE_IF_CHANGED = "true",
+        # CSV files are read/written in chunks of rows, progress is checkpointed to "_checkpoints/" in the prod bucket
+        DYNAMODB_CHUNK_ROWS    = "5000",
+        STOP_BEFORE_TIMEOUT_MS = "60000"
   }
   }
 
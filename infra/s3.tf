@@ -225,6 +225,51 @@ resource "aws_s3_bucket_versioning" "output_s3_bucket_versioning" {
   }
 }
 
+# Expire old versions of the master dataset files (manifest, snapshots, deltas, summaries).
+# mros_append_daily_data deletes the snapshot/delta files a compaction superseded (after MASTER_GC_GRACE_S),
+# with versioning on a delete only adds a delete marker, so the deleted data is kept for noncurrent_days
+# (to recover from a bad compaction) and then removed
+resource "aws_s3_bucket_lifecycle_configuration" "output_s3_bucket_lifecycle" {
+  bucket = data.aws_s3_bucket.output_s3_bucket.id
+
+  rule {
+    id     = "expire-superseded-master-dataset-files"
+    status = "Enabled"
+
+    filter {
+      prefix = "mros_output/"
+    }
+
+    noncurrent_version_expiration {
+      noncurrent_days = 7
+    }
+
+    expiration {
+      expired_object_delete_marker = true
+    }
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
+  }
+
+  # the single file Parquet export is rewritten after each compaction
+  rule {
+    id     = "expire-old-parquet-exports"
+    status = "Enabled"
+
+    filter {
+      prefix = "mros_output.parquet"
+    }
+
+    noncurrent_version_expiration {
+      noncurrent_days = 7
+    }
+  }
+
+  depends_on = [aws_s3_bucket_versioning.output_s3_bucket_versioning]
+}
+
 # OUTPUT S3 Bucket stationary CSV file for appending
 
 data "aws_s3_object" "output_s3_bucket_stationary_csv" {
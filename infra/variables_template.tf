@@ -100,6 +100,18 @@ variable "mros_append_daily_data_lambda_function_name" {
     sensitive   = true
 }
 
+# mros_append_daily_data commits to the master dataset manifest with conditional PutObject requests
+# (IfMatch/IfNoneMatch), which need boto3/botocore >= 1.35.69. boto3 is NOT vendored into the lambda zip
+# (it would shadow the boto3 awswrangler was built against and add ~80-100 MB unzipped), so this has to be an
+# AWSSDKPandas-Python311 layer version that bundles botocore >= 1.35.69 (the lambda fails with a clear error otherwise).
+# The default is pinned to the AWS SDK for pandas 3.11.0 layer (built after botocore 1.35.69), override it with
+# TF_VAR_mros_append_daily_data_pandas_layer_arn to move to a newer layer version
+variable "mros_append_daily_data_pandas_layer_arn" {
+    description = "ARN of the AWS SDK for pandas layer of the Daily data append Lambda (must bundle botocore >= 1.35.69)."
+    type        = string
+    default     = "arn:aws:lambda:us-west-1:336392948345:layer:AWSSDKPandas-Python311:20"
+}
+
 variable "mros_insert_into_dynamodb_lambda_zip_file_name" {
     description = "Name of the zip file thats contains the lambda function that inserts MROS data into DynamoDB."
     type        = string
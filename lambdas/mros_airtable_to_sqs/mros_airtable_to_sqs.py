@@ -11,13 +11,16 @@ import json
 import time
 import hashlib
 
-# pandas and json_normalize for flattening JSON data
-import pandas as pd
-from pandas import json_normalize
+# NOTE: pandas (json_normalize for flattening JSON data) and the (numpy/pandas based) near duplicate detection are
+# imported in records_to_dataframe(), so days without any Airtable records don't pay for them
 
-# AWS SDK for Python (Boto3) and S3fs for S3 file system support
-import boto3
-import s3fs
+# per-invocation phase timers and counters (CloudWatch EMF), leveled, sampled logging and opt-in profiling,
+# lazily created boto3 clients, per-stage lineage timestamps
+from mros_common import metrics
+from mros_common import log
+from mros_common import profiling
+from mros_common import aws
+from mros_common import lineage
 
 # environemnt variables
 BASE_ID = os.environ.get('BASE_ID')
@@ -25,8 +28,13 @@ TABLE_ID = os.environ.get('TABLE_ID')
 AIRTABLE_TOKEN = os.environ.get('AIRTABLE_TOKEN')
 SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL')
 
-# SQS client
-sqs = boto3.client('sqs')
+# Airtable API base URL (tools/pipeline_harness/fake_airtable.py serves a local stand-in for load tests)
+AIRTABLE_API_URL = os.environ.get('AIRTABLE_API_URL', 'https://api.airtable.com/v0').rstrip('/')
+
+# SQS client (created on first use)
+sqs = aws.LazyClient('sqs')
+
+logger = log.get_logger("mros_airtable_to_sqs")
 
 # Construct a list of dates 'n' days before the provided date 'timestamp' (in the format "YYYY-MM-DDTHH:MM:SSZ")
 def get_dates_before(timestamp, n):
@@ -61,35 +69,33 @@ def fetch_airtable_data(date, base_id, table_id, airtable_token):
     offset         = None
     pause_duration = 2  # Initial pause duration in seconds
 
-    print(f"Fetching airtable data for:")
-    print(f" - date: {date}")
-    print(f" - base_id: {base_id}")
-    print(f" - table_id: {table_id}")
+    logger.info("Fetching airtable data for date %s", date, base_id=base_id, table_id=table_id)
 
     while True:
         # Construct the Airtable API endpoint URL with the offset if available
-        url = f"https://api.airtable.com/v0/{base_id}/{table_id}/?filterByFormula=%7Bdate_submitted_utc%7D='{date}'"
+        url = f"{AIRTABLE_API_URL}/{base_id}/{table_id}/?filterByFormula=%7Bdate_submitted_utc%7D='{date}'"
 
         if offset:
-            print(f"Adding offset to url...")
+            logger.debug("Adding offset to url...")
             url += f"&offset={offset}"
 
         # Set headers with the Authorization token
         headers = {"Authorization": f"Bearer {airtable_token}"}
 
         # Make GET request to Airtable API
-        response = requests.get(url, headers=headers)
+        with metrics.phase("airtable_get"):
+            response = requests.get(url, headers=headers)
+
+        metrics.count("airtable_requests")
 
         # Check the response status
         if response.status_code == 200:
 
-            print(f"Successfully request")
-
             # Successful request
             response_data = response.json()
             records = response_data.get("records")
             
-            print(f"Retrieved {len(records)} more records")
+            logger.debug("Retrieved %s more records", len(records))
 
             # Extend fetched records list to the all_records list
             all_records.extend(records)
@@ -99,32 +105,32 @@ def fetch_airtable_data(date, base_id, table_id, airtable_token):
 
             # If no more offset, break the loop
             if not offset:
-                print(f"No offset provided, stopping requests")
-                print(f"====" * 6)
+                logger.debug("No offset provided, stopping requests")
                 break
 
         elif response.status_code == 429:
             # Too Many Requests error handling
-            print(f"Received 429 status code")
-            print(f"Too many requests, sleeping for 30 seconds and trying again...")
-            time.sleep(30)  # Pause for 30 seconds
-            print(f"====" * 6)
+            logger.warning("Received 429 status code, sleeping for 30 seconds and trying again...")
+            metrics.count("airtable_throttles")
+
+            with metrics.phase("airtable_wait"):
+                time.sleep(30)  # Pause for 30 seconds
             continue
         else:
             # Error handling
-            print(f"Error: {response.status_code} - {response.text}")
+            logger.error("Error: %s - %s", response.status_code, lambda: response.text, date=date)
+            metrics.count("airtable_errors")
             break
         
-        print(f"Sleeping for {pause_duration} seconds")
+        logger.debug("Sleeping for %s seconds", pause_duration)
 
         # Pause before making the next request
-        time.sleep(pause_duration)
+        with metrics.phase("airtable_wait"):
+            time.sleep(pause_duration)
 
         # Increase the pause duration exponentially for the next request
         pause_duration *= 2
 
-        print(f"====" * 6)
-
     return all_records
 
 def records_to_dataframe(records_list):
@@ -132,6 +138,11 @@ def records_to_dataframe(records_list):
         # Check if records_list exisits
         if records_list:
 
+            with metrics.phase("import_pandas"):
+                import pandas as pd
+                from pandas import json_normalize
+                from mros_airtable_to_sqs import near_duplicates
+
             # pandas JSON normalize the records data into a pandas dataframe
             df = json_normalize(records_list)
              
@@ -178,6 +189,18 @@ def records_to_dataframe(records_list):
 
             # Group by 'duplicate_id' and add a 'duplicate_count' column
             df['duplicate_count'] = df.groupby('duplicate_id').cumcount() + 1
+
+            # flag (or drop) app double-taps (same user, a few seconds and meters apart) before they go through enrichment
+            with metrics.phase("near_duplicates"):
+                df, near_duplicate_count = near_duplicates.handle_near_duplicates(df)
+
+            metrics.count("near_duplicates", near_duplicate_count)
+
+            if near_duplicate_count:
+                logger.info("Found %s near duplicate records", near_duplicate_count,
+                            mode=near_duplicates.NEAR_DUPLICATE_MODE,
+                            window_s=near_duplicates.NEAR_DUPLICATE_WINDOW_S,
+                            distance_m=near_duplicates.NEAR_DUPLICATE_DISTANCE_M)
             
             return df
 
@@ -208,16 +231,61 @@ def hash_dictionary(dictionary, hash_type="sha256"):
 
     return hash_value
 
+# Build the SQS message body of each row of a records_to_dataframe() dataframe (all values as strings),
+# with a 'record_hash' of the message body added (and 'near_duplicate_of' for flagged near duplicates)
+def build_messages(df):
+    messages = []
+
+    for i in range(0, len(df)):
+
+        # Construct the message body
+        message_body = {
+            'id': str(df["id"].iloc[i]),
+            'timestamp': str(df["timestamp"].iloc[i]),
+            'createdtime': str(df["createdtime"].iloc[i]),
+            'name': str(df["name"].iloc[i]),
+            'latitude': str(df["latitude"].iloc[i]),
+            'user': str(df["user"].iloc[i]),
+            'longitude': str(df["longitude"].iloc[i]),
+            'submitted_time': str(df["submitted_time"].iloc[i]),
+            'local_time': str(df["local_time"].iloc[i]),
+            'submitted_date': str(df["submitted_date"].iloc[i]),
+            'local_date': str(df["local_date"].iloc[i]),
+            'comment': str(df["comment"].iloc[i]),
+            'time': str(df["time"].iloc[i]),
+            'device_type': str(df["device_type"].iloc[i]),
+            # 'uuid': str(df["uuid"].iloc[i]),
+            'duplicate_id': str(df["duplicate_id"].iloc[i]),
+            'duplicate_count': str(df["duplicate_count"].iloc[i])
+        }
+
+        # create a hash of the message body
+        message_hash = hash_dictionary(message_body)
+
+        # add the hash to the message body
+        message_body['record_hash'] = message_hash
+
+        # id of the record a near duplicate was flagged against (NEAR_DUPLICATE_MODE "flag"), added after the
+        # record_hash like the lineage timestamps, so flagging a record does not change its record_hash
+        if "near_duplicate" in df.columns and df["near_duplicate"].iloc[i]:
+            message_body['near_duplicate_of'] = str(df["near_duplicate_of"].iloc[i])
+
+        messages.append(message_body)
+
+    return messages
+
 # Lambda handler function
 # Uses the date from the event to query data from Airtable API for the two previous days and send each record to SQS
 # Lambda is triggered by an EventBridge rule that runs on a schedule (probably daily)
+@metrics.instrumented("mros_airtable_to_sqs")
+@profiling.profiled("mros_airtable_to_sqs")
 def mros_airtable_to_sqs(event, context):
 
     curr_time = event['time']
 
     # curr_time = "2025-06-15T00:00:00Z"
     
-    print(f"curr_time: {curr_time}")
+    logger.info("curr_time: %s", curr_time)
 
     # New method of getting DATE_LIST for 7 days ago (or any number of days with 'n' argument)
     DATE_LIST = get_dates_before(curr_time, 7)
@@ -227,80 +295,71 @@ def mros_airtable_to_sqs(event, context):
     # properly uploaded and ready to be accessed
     DATE_LIST = DATE_LIST[-2:]
 
-    print(f"- DATE_LIST: {json.dumps(DATE_LIST)}")
+    logger.info("DATE_LIST: %s", DATE_LIST)
 
     # Get airtable data for each date in DATE_LIST
     airtable_data = {var: fetch_airtable_data(var, BASE_ID, TABLE_ID, AIRTABLE_TOKEN) for var in DATE_LIST}
     # {var: fetch_airtable_data(var, BASE_ID, TABLE_ID, AIRTABLE_TOKEN) for var in DATE_LIST} 
     # Make a count of the number of records from each day
     record_counts = [i + ": " + str(len(airtable_data[i])) for i in airtable_data]
-    print(f"record_counts: {json.dumps(record_counts)}")
+    logger.info("record_counts: %s", record_counts)
 
     # # Convert each list of airtable jsons to a pandas dataframe
     # record_dfs = {i: records_to_dataframe(airtable_data[i]) for i in airtable_data if airtable_data[i]}
 
     for i in airtable_data:
         # print(f"i: {i}")
+        metrics.count("records", len(airtable_data[i]))
+
         if airtable_data[i]:
-            print(f"Converting airtable list for date '{i}' to dataframe...")
-            airtable_data[i] = records_to_dataframe(airtable_data[i])
+            logger.debug("Converting airtable list for date '%s' to dataframe...", i)
+
+            with metrics.phase("dataframe"):
+                airtable_data[i] = records_to_dataframe(airtable_data[i])
         else:
-            print(f"No records found for date '{i}', Skipping key '{i}'...")
+            logger.info("No records found for date '%s', Skipping key '%s'...", i, i)
             airtable_data[i] = None
 
+    # number of messages sent to SQS and messages that failed to send
+    sent_count   = 0
+    failed_count = 0
+
     # Loop through each key in the dictionary 
     for date_key in airtable_data:
         # for date_key in record_dfs:
-        print(f"(date_key: {date_key})")
 
         # Get the dataframe for the given date
         df = airtable_data[date_key]
 
         if df is not None:
-            print(f"Number of rows in df: {len(df)}")
-            print(f"Number of columns in df: {len(df.columns)}")
-
-            # Loop through the dataframe and send each record to SQS
-            print(f"Adding {len(df)} records to SQS queue")
-            for i in range(0, len(df)):
-
-                # Construct the message body
-                message_body = {
-                    'id': str(df["id"].iloc[i]),
-                    'timestamp': str(df["timestamp"].iloc[i]),
-                    'createdtime': str(df["createdtime"].iloc[i]),
-                    'name': str(df["name"].iloc[i]),
-                    'latitude': str(df["latitude"].iloc[i]),
-                    'user': str(df["user"].iloc[i]),
-                    'longitude': str(df["longitude"].iloc[i]),
-                    'submitted_time': str(df["submitted_time"].iloc[i]),
-                    'local_time': str(df["local_time"].iloc[i]),
-                    'submitted_date': str(df["submitted_date"].iloc[i]),
-                    'local_date': str(df["local_date"].iloc[i]),
-                    'comment': str(df["comment"].iloc[i]),
-                    'time': str(df["time"].iloc[i]),
-                    'device_type': str(df["device_type"].iloc[i]),
-                    # 'uuid': str(df["uuid"].iloc[i]),
-                    'duplicate_id': str(df["duplicate_id"].iloc[i]),
-                    'duplicate_count': str(df["duplicate_count"].iloc[i])
-                }
-                
-                # create a hash of the message body
-                message_hash = hash_dictionary(message_body)
-
-                # add the hash to the message body
-                message_body['record_hash'] = message_hash
+            logger.debug("Dataframe of date_key %s", date_key, rows=len(df), columns=len(df.columns))
+
+            # Build the message bodies (with their record_hash) and send each record to SQS
+            with metrics.phase("build_messages"):
+                messages = build_messages(df)
+
+            logger.info("Adding %s records of date_key %s to SQS queue", len(messages), date_key)
+            for i, message_body in enumerate(messages):
+
+                # stamp the send time (after the record_hash, which must not change when a record is sent again)
+                message_body[lineage.ENQUEUED] = str(lineage.now_ms())
 
                 # try to send the message to SQS
                 try:
                     # Send the message to SQS
-                    sqs.send_message(
-                        QueueUrl    = SQS_QUEUE_URL,
-                        MessageBody = json.dumps(message_body)
-                    )
+                    with metrics.phase("sqs_send"):
+                        sqs.send_message(
+                            QueueUrl    = SQS_QUEUE_URL,
+                            MessageBody = json.dumps(message_body)
+                        )
+                    sent_count += 1
                 except Exception as e:
-                    print(f"Exception raised from row i {i}\n: {e}")
-        
-        print(f"====" * 6)
+                    logger.error("Exception raised from row i %s: %s", i, e, record_id=message_body.get("id"))
+                    failed_count += 1
+
+    metrics.count("sqs_messages", sent_count)
+    metrics.count("sqs_errors", failed_count)
+
+    logger.summary("Sent %s Airtable records to SQS", sent_count, failed=failed_count, record_counts=record_counts)
 
     return
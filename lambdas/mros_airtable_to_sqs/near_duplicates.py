@@ -0,0 +1,290 @@
+# Description: Spatio-temporal near-duplicate detection of Airtable records, run in records_to_dataframe() before the
+# records are sent to SQS. duplicate_id only catches exact user + time repeats, app double-taps (same user, a few
+# seconds apart, a few meters apart) went on through the (expensive) add_climate_data enrichment.
+#
+# Two records are near duplicates when they have the same user, were received at most NEAR_DUPLICATE_WINDOW_S
+# seconds apart and are at most NEAR_DUPLICATE_DISTANCE_M meters apart. Candidates are found without comparing all
+# pairs (O(n log n)):
+#   - each record is put in its geohash cell, at the longest geohash12 prefix whose cells are at least
+#     NEAR_DUPLICATE_DISTANCE_M wide (so any record within the distance is in the same cell or one of its 8 neighbors)
+#   - records are sorted by (user, cell, time), and each record looks up the records of its own and neighboring
+#     cells that fall in its time window with binary searches
+#   - the candidate pairs are checked with the haversine distance
+#   - one sweep over the close pairs, in time order, decides which records are kept (see below)
+# Records are kept in time order: a record is a near duplicate of the earliest KEPT record it is close to, and is kept
+# itself when it is not close to any kept record. Near duplicates are compared with the kept record, not with each
+# other, so a user submitting every 25 s from the same spot (window 30 s) keeps every other record instead of
+# the whole series collapsing into its first record.
+#
+# NEAR_DUPLICATE_MODE:
+#   "flag"  keep every record and mark the near duplicates (near_duplicate, near_duplicate_of columns), the id of the
+#           kept record is sent along in the SQS message body (near_duplicate_of) and ends up in prod and the master
+#           dataset (default)
+#   "drop"  remove the near duplicates, they are NOT sent to SQS and are only counted/logged (opt-in)
+#   "off"   skip the detection
+# Usage: from mros_airtable_to_sqs import near_duplicates
+# Author: Angus Watters
+
+# general utility libraries
+import os
+
+import numpy as np
+import pandas as pd
+
+# Environment variables
+# What to do with near duplicates ("flag", "drop" or "off")
+NEAR_DUPLICATE_MODE       = os.environ.get('NEAR_DUPLICATE_MODE', 'flag').lower()
+
+# Max time (seconds) between two records of a user for them to be near duplicates
+NEAR_DUPLICATE_WINDOW_S   = float(os.environ.get('NEAR_DUPLICATE_WINDOW_S', '30'))
+
+# Max distance (meters) between two records of a user for them to be near duplicates
+NEAR_DUPLICATE_DISTANCE_M = float(os.environ.get('NEAR_DUPLICATE_DISTANCE_M', '50'))
+
+MODES = ("flag", "drop", "off")
+
+EARTH_RADIUS_M = 6371008.8
+
+# meters per degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = 2 * np.pi * EARTH_RADIUS_M / 360
+
+# cell offsets of a cell and its 8 neighbors
+NEIGHBOR_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+def geohash_bits(precision):
+    """Number of (longitude, latitude) bits of a geohash of precision characters (5 bits each, longitude first)."""
+    bits = 5 * precision
+    return (bits + 1) // 2, bits // 2
+
+def cell_precision(distance_m, max_abs_lat, max_precision=12):
+    """
+    Longest geohash precision whose cells are at least distance_m wide and high at latitudes up to max_abs_lat.
+
+    Parameters:
+    distance_m (float): Min cell size (meters).
+    max_abs_lat (float): Largest absolute latitude of the records (cells get narrower towards the poles).
+    max_precision (int): Longest precision considered (geohash12).
+
+    Returns:
+    int: Geohash precision (at least 1).
+    """
+    cos_lat = max(np.cos(np.radians(min(max_abs_lat, 89.9))), 1e-6)
+
+    for precision in range(max_precision, 0, -1):
+        lon_bits, lat_bits = geohash_bits(precision)
+
+        height_m = 180 / 2 ** lat_bits * METERS_PER_DEGREE
+        width_m  = 360 / 2 ** lon_bits * METERS_PER_DEGREE * cos_lat
+
+        if min(height_m, width_m) >= distance_m:
+            return precision
+
+    return 1
+
+def geohash_cells(lat, lon, precision):
+    """
+    Column and row of the geohash cells (of a precision) holding each coordinate, i.e. the geohash prefix of that
+    length as integer grid coordinates, so neighbors are +-1 away.
+
+    Returns:
+    tuple: numpy int64 arrays (column, row).
+    """
+    lon_bits, lat_bits = geohash_bits(precision)
+
+    col = np.floor((lon + 180) / 360 * 2 ** lon_bits).astype(np.int64)
+    row = np.floor((lat + 90) / 180 * 2 ** lat_bits).astype(np.int64)
+
+    # 180 degrees longitude / 90 degrees latitude belong to the last cell
+    return np.minimum(col, 2 ** lon_bits - 1), np.minimum(row, 2 ** lat_bits - 1)
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great circle distance (meters) between coordinates (numpy arrays, degrees)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def _expand_ranges(starts, ends):
+    """Indices of all [start, end) ranges, and the range each index came from (vectorized)."""
+    counts = ends - starts
+    owner  = np.repeat(np.arange(len(starts)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return starts[owner] + offset, owner
+
+def find_near_duplicates(users, lat, lon, times, window_s=None, distance_m=None):
+    """
+    Find near duplicate records (see the module description).
+
+    Parameters:
+    users (array-like): User of each record.
+    lat, lon (array-like): Coordinates (degrees, records with missing/invalid coordinates are never near duplicates).
+    times (array-like): Epoch seconds (records with a missing time are never near duplicates).
+    window_s (float): Max time between near duplicates (defaults to NEAR_DUPLICATE_WINDOW_S).
+    distance_m (float): Max distance between near duplicates (defaults to NEAR_DUPLICATE_DISTANCE_M).
+
+    Returns:
+    numpy.ndarray: For each record, the position of the (kept) record it is a near duplicate of, or -1 for kept
+    records.
+    """
+    window_s   = NEAR_DUPLICATE_WINDOW_S if window_s is None else window_s
+    distance_m = NEAR_DUPLICATE_DISTANCE_M if distance_m is None else distance_m
+
+    lat   = pd.to_numeric(pd.Series(lat), errors="coerce").to_numpy(dtype=float)
+    lon   = pd.to_numeric(pd.Series(lon), errors="coerce").to_numpy(dtype=float)
+    times = pd.to_numeric(pd.Series(times), errors="coerce").to_numpy(dtype=float)
+    n     = len(lat)
+
+    parent = np.full(n, -1, dtype=np.int64)
+
+    valid = np.isfinite(lat) & np.isfinite(lon) & np.isfinite(times) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+    valid &= pd.Series(users).notna().to_numpy()
+
+    if valid.sum() < 2:
+        return parent
+
+    idx = np.flatnonzero(valid)
+    lat, lon, times = lat[idx], lon[idx], times[idx]
+
+    user_codes = pd.factorize(pd.Series(users).to_numpy()[idx])[0].astype(np.int64)
+
+    # the (user, column, row) bit fields of the cell keys have to fit in an int64
+    user_bits = int(user_codes.max()).bit_length()
+    precision = cell_precision(distance_m, np.abs(lat).max(), min(12, (62 - user_bits) // 5))
+
+    lon_bits, lat_bits = geohash_bits(precision)
+    col, row           = geohash_cells(lat, lon, precision)
+
+    # one integer key per (user, cell): user | column | row bit fields
+    def cell_key(user, col, row):
+        return (user << (lon_bits + lat_bits)) | (col << lat_bits) | row
+
+    keys = cell_key(user_codes, col, row)
+
+    # (user, cell) runs: dense run number of each key, in key order
+    run_keys, runs = np.unique(keys, return_inverse=True)
+
+    # sort key: run number, then time (integer milliseconds, offset so that every time +- the window is within
+    # [0, span)), so one searchsorted finds the time window of any run
+    window_ms = int(np.ceil(window_s * 1000))
+    time_ms   = np.round(times * 1000).astype(np.int64)
+    time_ms  -= time_ms.min() - window_ms
+    span      = int(time_ms.max()) + window_ms + 1
+
+    sort_keys = runs.astype(np.int64) * span + time_ms
+    order     = np.argsort(sort_keys, kind="stable")
+    sort_keys = sort_keys[order]
+
+    # the records are probed in sort order, so the searchsorted needles are (nearly) sorted too, which keeps the
+    # binary searches cache friendly on large batches
+    s_user, s_col, s_row, s_time = user_codes[order], col[order], row[order], time_ms[order]
+
+    pair_a, pair_b = [], []
+
+    for dx, dy in NEIGHBOR_OFFSETS:
+        # neighboring cell of each record (columns wrap around at 180 degrees, rows stop at the poles)
+        n_col = (s_col + dx) % (2 ** lon_bits)
+        n_row = s_row + dy
+        ok    = (n_row >= 0) & (n_row < 2 ** lat_bits)
+
+        n_key = cell_key(s_user, n_col, np.clip(n_row, 0, 2 ** lat_bits - 1))
+
+        # run of the neighboring cell, if it has any records of the user
+        n_run = np.minimum(np.searchsorted(run_keys, n_key), len(run_keys) - 1)
+        probe = np.flatnonzero(ok & (run_keys[n_run] == n_key))
+
+        if not len(probe):
+            continue
+
+        base   = n_run[probe].astype(np.int64) * span
+        starts = np.searchsorted(sort_keys, base + s_time[probe] - window_ms, side="left")
+        ends   = np.searchsorted(sort_keys, base + s_time[probe] + window_ms, side="right")
+
+        positions, owner = _expand_ranges(starts, ends)
+
+        pair_a.append(order[probe[owner]])
+        pair_b.append(order[positions])
+
+    if not pair_a:
+        return parent
+
+    a = np.concatenate(pair_a)
+    b = np.concatenate(pair_b)
+
+    # b is the earlier record of the pair (ties broken by position), within the distance
+    earlier = (times[b] < times[a]) | ((times[b] == times[a]) & (b < a))
+    a, b    = a[earlier], b[earlier]
+
+    close = haversine_m(lat[a], lon[a], lat[b], lon[b]) <= distance_m
+    a, b  = a[close], b[close]
+
+    # records are kept in time order (ties broken by position): a record is a near duplicate as soon as one of its
+    # earlier close records is kept, and is kept when none of them is. One sweep over the pairs sorted by the time
+    # rank of their later record decides every record: the earlier record of a pair always has a lower rank, so it
+    # is decided before any of its pairs as the later record come up (records of different users or cells never
+    # share a pair, so one global time order covers every (user, connected component))
+    m = len(idx)
+
+    rank = np.empty(m, dtype=np.int64)
+    rank[np.lexsort((np.arange(m), times))] = np.arange(m)
+
+    by_rank = np.argsort(rank[a], kind="stable")
+    kept    = [True] * m
+
+    for later, earlier in zip(a[by_rank].tolist(), b[by_rank].tolist()):
+        if kept[earlier]:
+            kept[later] = False
+
+    kept = np.array(kept, dtype=bool)
+
+    # each near duplicate points to the earliest kept record it is close to
+    local = np.full(m, -1, dtype=np.int64)
+
+    a, b = a[kept[b] & ~kept[a]], b[kept[b] & ~kept[a]]
+
+    if len(a):
+        by_time = np.lexsort((b, times[b], a))
+        first   = np.unique(a[by_time], return_index=True)[1]
+        local[a[by_time][first]] = b[by_time][first]
+
+    parent[idx] = np.where(local >= 0, idx[np.maximum(local, 0)], -1)
+
+    return parent
+
+def handle_near_duplicates(df, mode=None, window_s=None, distance_m=None):
+    """
+    Flag or drop the near duplicates of a records_to_dataframe() dataframe.
+
+    Parameters:
+    df (pandas.DataFrame): Records with 'id', 'user', 'latitude', 'longitude' and 'timestamp' (epoch seconds) columns.
+    mode (str): "flag", "drop" or "off" (defaults to NEAR_DUPLICATE_MODE).
+    window_s (float): Max time between near duplicates (defaults to NEAR_DUPLICATE_WINDOW_S).
+    distance_m (float): Max distance between near duplicates (defaults to NEAR_DUPLICATE_DISTANCE_M).
+
+    Returns:
+    tuple: (dataframe, number of near duplicates). In "flag" mode the dataframe gets a boolean 'near_duplicate' column
+    and a 'near_duplicate_of' column (id of the kept record, None if the record is kept), in "drop" mode the near
+    duplicates are removed.
+    """
+    mode = (mode or NEAR_DUPLICATE_MODE).lower()
+
+    if mode not in MODES:
+        raise ValueError(f"Invalid near duplicate mode '{mode}', must be one of {', '.join(MODES)}")
+
+    if mode == "off" or df.empty:
+        return df, 0
+
+    parent = find_near_duplicates(df["user"], df["latitude"], df["longitude"], df["timestamp"], window_s, distance_m)
+    is_dup = parent >= 0
+
+    if mode == "drop":
+        return df[~is_dup].reset_index(drop=True), int(is_dup.sum())
+
+    ids = df["id"].to_numpy()
+
+    df = df.copy()
+    df["near_duplicate"]    = is_dup
+    df["near_duplicate_of"] = np.where(is_dup, ids[np.maximum(parent, 0)], None)
+
+    return df, int(is_dup.sum())
@@ -0,0 +1,206 @@
+# Description: Local /tmp cache of the master dataset Parquet files for warm mros_append_daily_data containers.
+# Files are keyed by S3 URI and validated with a HEAD request (the cached ETag and the object size), so an unchanged
+# object is never downloaded twice by the same container, and objects too large to cache are not downloaded here. Files written by this container are put in the cache as
+# they are uploaded, with the ETag of the PutObject response. The cache is bounded in size, the least recently used
+# files are evicted first.
+# Usage: from mros_append_daily_data import master_cache
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import uuid
+import shutil
+from collections import OrderedDict
+
+# lazily created boto3 clients
+from mros_common import aws
+
+# per-invocation counters (CloudWatch EMF), leveled, structured logging
+from mros_common import metrics
+from mros_common import log
+
+# Environment variables
+# Directory of the cached files (Lambda containers can only write to /tmp)
+CACHE_DIR       = os.environ.get('MASTER_CACHE_DIR', '/tmp/mros_master_cache')
+
+# Max size of the cache in MB (0 disables the cache), must fit in the Lambda ephemeral storage
+CACHE_MAX_BYTES = int(float(os.environ.get('MASTER_CACHE_MAX_MB', '400')) * 1024 * 1024)
+
+# read the S3 object body in 8 MB chunks
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# S3 client (created on first use)
+s3 = aws.LazyClient('s3')
+
+logger = log.get_logger("master_cache")
+
+# S3 URI -> {"path", "etag", "bytes"}, least recently used first
+# NOTE: module level, so the index lives as long as the (warm) container does
+_index = OrderedDict()
+
+# hit/miss metrics (reset at the start of each invocation with reset_stats())
+_stats = {}
+
+def reset_stats():
+    """Reset the cache hit/miss metrics."""
+    _stats.update(hits=0, misses=0, uncached=0, projected=0, evictions=0, bytes_downloaded=0, bytes_saved=0)
+
+def cache_stats():
+    """
+    Get the cache hit/miss metrics since the last reset_stats().
+
+    Returns:
+    dict: "hits", "misses", "uncached" (objects too large to cache), "projected" (uncached objects only some
+          columns were read from), "evictions", "bytes_downloaded", "bytes_saved" (bytes not downloaded thanks to cache hits), "cached_files" and "cached_bytes".
+    """
+    return dict(_stats, cached_files=len(_index), cached_bytes=sum(entry["bytes"] for entry in _index.values()))
+
+def enabled():
+    """Check if the cache is enabled (MASTER_CACHE_MAX_MB > 0)."""
+    return CACHE_MAX_BYTES > 0
+
+def _split_uri(uri):
+    bucket, key = uri.replace("s3://", "").split("/", 1)
+    return bucket, key
+
+def _init_cache_dir():
+    """Start from an empty cache directory (files left by an earlier process are not in the index)."""
+    if not _index and os.path.isdir(CACHE_DIR):
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+def _evict(needed_bytes):
+    """Remove least recently used files until needed_bytes fit in the cache."""
+    cached_bytes = sum(entry["bytes"] for entry in _index.values())
+
+    while _index and cached_bytes + needed_bytes > CACHE_MAX_BYTES:
+        uri, entry = _index.popitem(last=False)
+        cached_bytes -= entry["bytes"]
+
+        logger.debug("Evicting '%s' from the master cache", uri, bytes=entry['bytes'])
+
+        if os.path.exists(entry["path"]):
+            os.remove(entry["path"])
+
+        _stats["evictions"] += 1
+
+def _add(uri, etag, write_file, size):
+    """Write a file into the cache (write_file(fileobj) writes the contents) and add it to the index."""
+    _init_cache_dir()
+    _evict(size)
+
+    path     = os.path.join(CACHE_DIR, uuid.uuid4().hex)
+    tmp_path = f"{path}.part"
+
+    with open(tmp_path, "wb") as f:
+        write_file(f)
+
+    os.replace(tmp_path, path)
+
+    _index[uri] = {"path": path, "etag": etag, "bytes": size}
+
+    return path
+
+def _drop(uri):
+    """Remove a file from the cache."""
+    entry = _index.pop(uri, None)
+
+    if entry and os.path.exists(entry["path"]):
+        os.remove(entry["path"])
+
+def fetch(uri, columns=None):
+    """
+    Get a local copy of an S3 object, downloading it only if it is not cached or has changed.
+    A HEAD request checks the cached ETag and the object size before anything is downloaded, so objects too large
+    to cache are never downloaded here. Projected reads (columns given) of objects that are not cached are left to
+    the caller, which reads only those columns from S3 instead of the whole object.
+
+    Parameters:
+    uri (str): S3 URI of the object.
+    columns (list): Columns the caller is going to read (None for the whole object).
+
+    Returns:
+    str: Local file path, or None if the cache is disabled, the object is too large to cache, or it is not cached
+         and only some of its columns are read.
+    """
+    if not enabled():
+        return None
+
+    if not _stats:
+        reset_stats()
+
+    bucket, key = _split_uri(uri)
+    entry       = _index.get(uri)
+
+    with metrics.phase("s3_head"):
+        head = s3.head_object(Bucket=bucket, Key=key)
+
+    if entry and head["ETag"] == entry["etag"]:
+        logger.debug("Master cache hit for '%s'", uri, etag=entry['etag'])
+
+        _stats["hits"]        += 1
+        _stats["bytes_saved"] += entry["bytes"]
+        _index.move_to_end(uri)
+
+        metrics.count("master_cache_hits")
+
+        return entry["path"]
+
+    # object is new to the cache or has changed since it was cached
+    _drop(uri)
+
+    if head["ContentLength"] > CACHE_MAX_BYTES:
+        logger.info("'%s' is larger than the master cache, not caching it", uri, cache_max_bytes=CACHE_MAX_BYTES)
+
+        _stats["uncached"] += 1
+        return None
+
+    if columns is not None:
+        logger.debug("'%s' is not cached, reading only the columns %s from S3", uri, columns)
+
+        _stats["projected"] += 1
+        return None
+
+    logger.debug("Master cache miss for '%s', downloading", uri, bytes=head['ContentLength'])
+
+    _stats["misses"] += 1
+    metrics.count("master_cache_misses")
+
+    with metrics.phase("s3_get"):
+        response = s3.get_object(Bucket=bucket, Key=key)
+
+    downloaded = 0
+
+    def write_body(f):
+        nonlocal downloaded
+
+        for chunk in response["Body"].iter_chunks(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            downloaded += len(chunk)
+
+    try:
+        return _add(uri, response["ETag"], write_body, response["ContentLength"])
+    finally:
+        # only the bytes actually read from the body
+        _stats["bytes_downloaded"] += downloaded
+        metrics.count("s3_get_bytes", downloaded)
+
+def store(uri, data, etag):
+    """
+    Put the contents of an object this container just uploaded into the cache, so reading it back is a cache hit.
+
+    Parameters:
+    uri (str): S3 URI the data was uploaded to.
+    data (bytes): Object contents.
+    etag (str): ETag returned by the PutObject request that uploaded the data (a separate HEAD request could see
+                an object another appender wrote in between, and the cached copy would be validated with its ETag).
+    """
+    if not enabled() or len(data) > CACHE_MAX_BYTES:
+        return
+
+    if not _stats:
+        reset_stats()
+
+    _drop(uri)
+    _add(uri, etag, lambda f: f.write(data), len(data))
@@ -0,0 +1,512 @@
+# Description: Commit protocol that lets several mros_append_daily_data invocations append to the master dataset at once.
+# The master dataset is a snapshot Parquet file plus a list of delta Parquet files, both listed in a JSON manifest in S3.
+# Each appender writes its own delta file and then adds it to the manifest with a conditional write (If-Match on the
+# manifest ETag). When another appender committed first, the new records are checked against the deltas that were
+# added in the meantime and the commit is retried. Every so often an appender compacts the deltas into a new snapshot.
+#
+# Files that are no longer part of the master dataset are deleted:
+#   - delta/snapshot files that never made it into the manifest (lost races, rewritten deltas) right away
+#   - the snapshot and deltas folded into a new snapshot by a compaction are listed in the manifest "garbage" and
+#     deleted by a later compaction once they are MASTER_GC_GRACE_S seconds old (appenders that read an older
+#     manifest may still be reading them)
+# The output bucket is versioned, so a delete only adds a delete marker, the old versions are expired by the
+# lifecycle rule of the "mros_output/" prefix (infra/s3.tf).
+#
+# S3 layout (for OUTPUT_OBJECT_KEY = "mros_output.csv"):
+#   mros_output/_manifest.json                  <- manifest (version, snapshot, deltas)
+#   mros_output/snapshots/v00000012_<uuid>.parquet
+#   mros_output/deltas/<uuid>.parquet
+#   mros_output/summaries/...                   <- summary tables (see master_summaries.py)
+#   mros_output.parquet, mros_output.csv        <- single file exports, rewritten after each compaction (only by a
+#                                                  newer manifest version, see master_store.put_export())
+#
+# NOTE: conditional PutObject (IfMatch/IfNoneMatch) requires boto3/botocore >= 1.35.69, which has to come from the
+# NOTE: AWSSDKPandas layer (infra/lambda.tf), commit_append() fails with a clear error on an older botocore
+# Usage: from mros_append_daily_data import master_manifest
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import json
+import time
+import uuid
+import random
+from datetime import datetime, timezone
+
+import pandas as pd
+
+# AWS SDK for Python (Boto3) exceptions, lazily created boto3 clients, leveled, structured logging
+from botocore.exceptions import ClientError
+from mros_common import aws
+from mros_common import log
+
+# declared (typed) schema of the master dataset and S3 read/write helpers
+from mros_append_daily_data import master_schema
+from mros_append_daily_data import master_store
+
+# Environment variables
+# Number of times to retry a manifest commit that lost the race against another appender
+MAX_COMMIT_RETRIES     = int(os.environ.get('MASTER_COMMIT_RETRIES', '8'))
+
+# Compact the deltas into a new snapshot once the manifest lists this many deltas
+COMPACT_EVERY_N_DELTAS = int(os.environ.get('MASTER_COMPACT_DELTAS', '10'))
+
+# Seconds a file superseded by a compaction is kept before it is deleted (at least the Lambda timeout)
+GC_GRACE_SECONDS       = float(os.environ.get('MASTER_GC_GRACE_S', '900'))
+
+# base/max sleep (seconds) between commit retries (full jitter)
+RETRY_BASE_SLEEP = 0.2
+RETRY_MAX_SLEEP  = 5.0
+
+MANIFEST_NAME = "_manifest.json"
+
+# first botocore release that can send conditional PutObject requests (IfMatch/IfNoneMatch)
+MIN_BOTOCORE_VERSION = (1, 35, 69)
+
+# S3 error codes returned when a conditional write loses the race
+CONFLICT_ERROR_CODES = master_store.CONFLICT_ERROR_CODES
+
+# S3 client (created on first use)
+s3 = aws.LazyClient('s3')
+
+logger = log.get_logger("master_manifest")
+
+class ManifestConflictError(Exception):
+    """
+    Raised when the manifest was changed by another appender since it was read (conditional write failed).
+    """
+    pass
+
+def check_botocore_version():
+    """
+    Raise a clear error if the botocore of the runtime cannot send conditional PutObject requests
+    (otherwise the first commit fails with "Unknown parameter in input: IfMatch").
+    """
+    import botocore
+
+    version = tuple(int(part) for part in botocore.__version__.split(".")[:3])
+
+    if version < MIN_BOTOCORE_VERSION:
+        raise RuntimeError(
+            f"botocore {botocore.__version__} cannot send conditional PutObject requests (IfMatch/IfNoneMatch), "
+            f"the master dataset manifest needs botocore >= {'.'.join(map(str, MIN_BOTOCORE_VERSION))} "
+            f"(use an AWSSDKPandas layer version that bundles it, see infra/lambda.tf)"
+            )
+
+def master_prefix(object_key):
+    """
+    Get the S3 key prefix of the manifest/snapshot/delta files from the master dataset object key.
+    (e.g. "mros_output.csv" -> "mros_output")
+    """
+    return os.path.splitext(object_key)[0]
+
+def manifest_key(prefix):
+    return f"{prefix}/{MANIFEST_NAME}"
+
+# timestamp format of the manifest ("updated_at", "committed_at", "superseded_at")
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# max number of keys of a DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+def utc_now():
+    return datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+def age_seconds(timestamp):
+    """Seconds since a manifest timestamp."""
+    then = datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - then).total_seconds()
+
+def backoff(attempt):
+    """Sleep for a jittered, exponentially increasing amount of time."""
+    sleep_seconds = random.uniform(0, min(RETRY_MAX_SLEEP, RETRY_BASE_SLEEP * (2 ** attempt)))
+    logger.debug("Sleeping for %s seconds before retrying commit", round(sleep_seconds, 3))
+    time.sleep(sleep_seconds)
+
+def manifest_uris(bucket, manifest, entries=None):
+    """
+    Get the S3 URIs of the snapshot and delta files in a manifest.
+
+    Parameters:
+    bucket (str): S3 bucket name.
+    manifest (dict): Manifest.
+    entries (list): Optional list of delta entries to use instead of all the deltas in the manifest.
+
+    Returns:
+    list: S3 URIs (snapshot first, then deltas in commit order).
+    """
+    if entries is not None:
+        return [f"s3://{bucket}/{entry['key']}" for entry in entries]
+
+    uris = []
+
+    if manifest.get("snapshot"):
+        uris.append(f"s3://{bucket}/{manifest['snapshot']['key']}")
+
+    uris.extend(f"s3://{bucket}/{entry['key']}" for entry in manifest["deltas"])
+
+    return uris
+
+def read_json(bucket, key):
+    """
+    Read a JSON object and its ETag.
+
+    Returns:
+    tuple: (dict, ETag), or (None, None) if the object does not exist.
+    """
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, None
+        raise
+
+    return json.load(obj["Body"]), obj["ETag"]
+
+def put_json(bucket, key, body, etag):
+    """
+    Conditionally write a JSON object. If etag is None, the object must not exist yet,
+    otherwise the current object must still have that ETag.
+
+    Returns:
+    str: ETag of the new object.
+
+    Raises:
+    ManifestConflictError: if the object was changed (or created) by another appender.
+    """
+    condition = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+
+    try:
+        response = s3.put_object(
+            Bucket      = bucket,
+            Key         = key,
+            Body        = json.dumps(body).encode("utf-8"),
+            ContentType = "application/json",
+            **condition
+            )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in CONFLICT_ERROR_CODES:
+            raise ManifestConflictError(f"'{key}' was changed by another appender (commit of version {body['version']})") from e
+        raise
+
+    return response["ETag"]
+
+def read_manifest(bucket, prefix):
+    """
+    Read the manifest and its ETag.
+
+    Returns:
+    tuple: (manifest dict, ETag), or (None, None) if there is no manifest yet.
+    """
+    return read_json(bucket, manifest_key(prefix))
+
+def put_manifest(bucket, prefix, manifest, etag):
+    """
+    Conditionally write the manifest (see put_json()).
+
+    Returns:
+    str: ETag of the new manifest.
+    """
+    return put_json(bucket, manifest_key(prefix), manifest, etag)
+
+def referenced_keys(manifest):
+    """
+    Get the keys of every file a manifest refers to (snapshot, deltas and garbage waiting to be deleted).
+    """
+    keys = {entry["key"] for entry in manifest["deltas"]}
+    keys.update(entry["key"] for entry in manifest.get("garbage", []))
+
+    if manifest.get("snapshot"):
+        keys.add(manifest["snapshot"]["key"])
+
+    return keys
+
+def delete_keys(bucket, keys):
+    """
+    Delete S3 objects. Best effort: a failed delete only leaves a file behind, it never affects the master dataset.
+
+    Returns:
+    int: Number of objects deleted.
+    """
+    keys    = sorted(set(keys))
+    deleted = 0
+
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+
+        try:
+            response = s3.delete_objects(
+                Bucket = bucket,
+                Delete = {"Objects": [{"Key": key} for key in batch], "Quiet": True}
+                )
+        except ClientError as e:
+            logger.warning("Could not delete %s superseded files: %s", len(batch), e)
+            continue
+
+        errors   = response.get("Errors", [])
+        deleted += len(batch) - len(errors)
+
+        for error in errors:
+            logger.warning("Could not delete '%s': %s %s", error.get('Key'), error.get('Code'), error.get('Message'))
+
+    if keys:
+        logger.info("Deleted %s of %s files no longer in the master dataset", deleted, len(keys))
+
+    return deleted
+
+def discard_unreferenced(bucket, key, manifest):
+    """Delete a file this appender wrote, unless the manifest refers to it (e.g. a commit that did go through)."""
+    if key not in referenced_keys(manifest):
+        delete_keys(bucket, [key])
+
+def read_manifest_columns(bucket, manifest, columns, entries=None):
+    """
+    Read columns of every file in the manifest (or only the given delta entries) into a single dataframe.
+    """
+    uris = manifest_uris(bucket, manifest, entries)
+
+    if not uris:
+        return pd.DataFrame({col: pd.Series(dtype=object) for col in (columns or master_store.DEDUP_COLUMNS)})
+
+    return pd.concat([master_store.read_parquet_columns(uri, columns) for uri in uris], axis=0, ignore_index=True)
+
+def write_parquet_file(bucket, key, df):
+    """Write a typed dataframe as a master dataset Parquet file and return its manifest entry."""
+    size = master_store.write_master(df, f"s3://{bucket}/{key}")
+
+    return {"key": key, "rows": len(df), "bytes": size, "committed_at": utc_now()}
+
+def _object_exists(uri):
+    """Check if an S3 object exists (HEAD request)."""
+    bucket, key = uri.replace("s3://", "").split("/", 1)
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return False
+        raise
+    return True
+
+def bootstrap_manifest(bucket, prefix, legacy_parquet_uri, legacy_csv_uri):
+    """
+    Create the first manifest from the single file master dataset (Parquet if it exists, otherwise CSV).
+
+    Returns:
+    tuple: (manifest dict, ETag) of the manifest that won the bootstrap (another appender may have created it first).
+    """
+    logger.info("No manifest found in '%s', bootstrapping from the single file master dataset", prefix)
+
+    manifest = {"version": 0, "snapshot": None, "deltas": [], "updated_at": utc_now()}
+    snapshot_key = f"{prefix}/snapshots/v{0:08d}_{uuid.uuid4().hex}.parquet"
+
+    if _object_exists(legacy_parquet_uri):
+        logger.info("Copying '%s' to snapshot '%s'", legacy_parquet_uri, snapshot_key)
+
+        legacy_bucket, legacy_key = legacy_parquet_uri.replace("s3://", "").split("/", 1)
+        s3.copy_object(Bucket=bucket, Key=snapshot_key, CopySource={"Bucket": legacy_bucket, "Key": legacy_key})
+
+        manifest["snapshot"] = {"key": snapshot_key, "rows": None, "committed_at": utc_now()}
+
+    elif _object_exists(legacy_csv_uri):
+        logger.info("Converting '%s' to snapshot '%s'", legacy_csv_uri, snapshot_key)
+
+        df = master_store.read_master(legacy_parquet_uri, csv_uri=legacy_csv_uri)
+        manifest["snapshot"] = write_parquet_file(bucket, snapshot_key, df)
+
+    try:
+        etag = put_manifest(bucket, prefix, manifest, None)
+    except ManifestConflictError:
+        logger.info("Another appender created the manifest first, using that one")
+
+        latest, latest_etag = read_manifest(bucket, prefix)
+
+        if manifest["snapshot"]:
+            discard_unreferenced(bucket, snapshot_key, latest)
+
+        return latest, latest_etag
+
+    return manifest, etag
+
+def commit_append(bucket, prefix, input_df, source_uri, legacy_parquet_uri, legacy_csv_uri):
+    """
+    Append new records to the master dataset with optimistic concurrency.
+
+    Parameters:
+    bucket (str): Output S3 bucket name.
+    prefix (str): Key prefix of the manifest/snapshot/delta files (see master_prefix()).
+    input_df (pandas.DataFrame): New records (master dataset column names).
+    source_uri (str): S3 URI the records came from (recorded in the manifest).
+    legacy_parquet_uri (str): S3 URI of the single file Parquet master (used to bootstrap the manifest).
+    legacy_csv_uri (str): S3 URI of the single file CSV master (used to bootstrap the manifest).
+
+    Returns:
+    dict: Commit stats ("appended", "retries", "version", "manifest", "etag").
+    """
+    check_botocore_version()
+
+    manifest, etag = read_manifest(bucket, prefix)
+
+    if manifest is None:
+        manifest, etag = bootstrap_manifest(bucket, prefix, legacy_parquet_uri, legacy_csv_uri)
+
+    logger.debug("Read manifest version %s", manifest['version'], deltas=len(manifest['deltas']))
+
+    # only read the columns needed for removing duplicates
+    master_keys_df = read_manifest_columns(bucket, manifest, master_store.DEDUP_COLUMNS)
+    new_df = master_store.drop_existing_records(input_df, master_keys_df)
+
+    logger.debug("Number of new records: %s (of %s input records)", len(new_df), len(input_df))
+
+    stats = {"appended": 0, "retries": 0, "version": manifest["version"], "manifest": manifest, "etag": etag}
+
+    if len(new_df) == 0:
+        return stats
+
+    new_df = master_schema.coerce_to_schema(new_df)
+
+    # write the delta file, this does not conflict with other appenders
+    delta_key   = f"{prefix}/deltas/{uuid.uuid4().hex}.parquet"
+    delta_entry = write_parquet_file(bucket, delta_key, new_df)
+    delta_entry["source"] = source_uri
+
+    for attempt in range(MAX_COMMIT_RETRIES + 1):
+        new_manifest = {
+            "version": manifest["version"] + 1,
+            "snapshot": manifest["snapshot"],
+            "deltas": manifest["deltas"] + [delta_entry],
+            "compacted_from": manifest.get("compacted_from"),
+            "garbage": manifest.get("garbage", []),
+            "updated_at": utc_now()
+            }
+
+        try:
+            etag = put_manifest(bucket, prefix, new_manifest, etag)
+        except ManifestConflictError as e:
+            logger.info("Commit attempt %s failed: %s", attempt + 1, e)
+
+            if attempt == MAX_COMMIT_RETRIES:
+                discard_unreferenced(bucket, delta_key, read_manifest(bucket, prefix)[0])
+                raise
+
+            stats["retries"] += 1
+
+            backoff(attempt)
+
+            latest, latest_etag = read_manifest(bucket, prefix)
+
+            # the conditional write can fail on a retry of a request that did go through (e.g. the response was lost)
+            if delta_key in {entry["key"] for entry in latest["deltas"]}:
+                logger.info("Delta '%s' is already in manifest version %s", delta_key, latest['version'])
+                stats.update(appended=len(new_df), version=latest["version"], manifest=latest, etag=latest_etag)
+                return stats
+
+            # a compaction folds deltas we may not have seen into a new snapshot, so re-check against everything,
+            # otherwise only the deltas committed since the manifest we checked against need to be read
+            if latest["snapshot"] != manifest["snapshot"]:
+                added_keys_df = read_manifest_columns(bucket, latest, master_store.DEDUP_COLUMNS)
+            else:
+                seen = {entry["key"] for entry in manifest["deltas"]}
+                added = [entry for entry in latest["deltas"] if entry["key"] not in seen]
+                added_keys_df = read_manifest_columns(bucket, latest, master_store.DEDUP_COLUMNS, entries=added)
+
+            remaining_df = master_store.drop_existing_records(new_df, added_keys_df)
+
+            if len(remaining_df) == 0:
+                logger.info("All new records were committed by another appender, nothing to commit")
+                discard_unreferenced(bucket, delta_key, latest)
+                stats.update(version=latest["version"], manifest=latest, etag=latest_etag)
+                return stats
+
+            # some of the records were committed by another appender, rewrite the delta without them
+            if len(remaining_df) < len(new_df):
+                logger.info("%s records were committed by another appender, rewriting delta", len(new_df) - len(remaining_df))
+                discard_unreferenced(bucket, delta_key, latest)
+                new_df      = remaining_df
+                delta_key   = f"{prefix}/deltas/{uuid.uuid4().hex}.parquet"
+                delta_entry = write_parquet_file(bucket, delta_key, new_df)
+                delta_entry["source"] = source_uri
+
+            manifest, etag = latest, latest_etag
+            continue
+
+        logger.info("Committed manifest version %s with delta '%s'", new_manifest['version'], delta_key, rows=len(new_df))
+
+        stats.update(appended=len(new_df), version=new_manifest["version"], manifest=new_manifest, etag=etag)
+        return stats
+
+def compact(bucket, prefix, manifest, etag):
+    """
+    Fold the snapshot and all deltas in the manifest into a new snapshot and commit it.
+    Deltas committed by other appenders while compacting are kept in the new manifest.
+    The folded files are added to the manifest garbage, garbage older than GC_GRACE_SECONDS is deleted.
+
+    Returns:
+    tuple: (compacted (typed) master dataset, manifest version it was committed as),
+           or (None, None) if another appender compacted first.
+    """
+    logger.info("Compacting manifest version %s", manifest['version'], deltas=len(manifest['deltas']))
+
+    master_df = read_manifest_columns(bucket, manifest, None)
+    master_df = master_schema.coerce_to_schema(master_df)
+
+    # defensive: a record can only be in the master dataset once
+    master_df = master_df.drop_duplicates(subset=["record_hash"], keep="first").reset_index(drop=True)
+
+    snapshot_key   = f"{prefix}/snapshots/v{manifest['version'] + 1:08d}_{uuid.uuid4().hex}.parquet"
+    snapshot_entry = write_parquet_file(bucket, snapshot_key, master_df)
+
+    base_snapshot = manifest["snapshot"]
+    compacted     = [entry["key"] for entry in manifest["deltas"]]
+
+    # files that are no longer part of the master dataset once the new snapshot is committed
+    superseded = ([base_snapshot["key"]] if base_snapshot else []) + compacted
+
+    for attempt in range(MAX_COMMIT_RETRIES + 1):
+        garbage = manifest.get("garbage", [])
+        expired = [entry["key"] for entry in garbage if age_seconds(entry["superseded_at"]) >= GC_GRACE_SECONDS]
+
+        new_manifest = {
+            "version": manifest["version"] + 1,
+            "snapshot": snapshot_entry,
+            "deltas": manifest["deltas"][len(compacted):],
+            "compacted_from": {"snapshot": base_snapshot["key"] if base_snapshot else None, "deltas": compacted},
+            "garbage": [entry for entry in garbage if entry["key"] not in expired] +
+                       [{"key": key, "superseded_at": utc_now()} for key in superseded],
+            "updated_at": utc_now()
+            }
+
+        try:
+            put_manifest(bucket, prefix, new_manifest, etag)
+        except ManifestConflictError as e:
+            logger.info("Compaction commit attempt %s failed: %s", attempt + 1, e)
+
+            latest, latest_etag = read_manifest(bucket, prefix)
+
+            # the conditional write can fail on a retry of a request that did go through (e.g. the response was lost)
+            if latest["snapshot"] and latest["snapshot"]["key"] == snapshot_key:
+                logger.info("Snapshot '%s' is already in manifest version %s", snapshot_key, latest['version'])
+                delete_keys(bucket, set(expired) - referenced_keys(latest))
+                return master_df, new_manifest["version"]
+
+            if attempt == MAX_COMMIT_RETRIES:
+                discard_unreferenced(bucket, snapshot_key, latest)
+                raise
+
+            manifest, etag = latest, latest_etag
+
+            # give up if another appender compacted (the compacted deltas are no longer at the front of the manifest)
+            if manifest["snapshot"] != base_snapshot or \
+               [entry["key"] for entry in manifest["deltas"][:len(compacted)]] != compacted:
+                logger.info("Another appender compacted the manifest, dropping snapshot '%s'", snapshot_key)
+                discard_unreferenced(bucket, snapshot_key, manifest)
+                return None, None
+
+            backoff(attempt)
+            continue
+
+        logger.info("Committed compacted manifest version %s (snapshot '%s')", new_manifest['version'], snapshot_key)
+
+        # superseded files past the grace period (no appender can still be reading them)
+        delete_keys(bucket, expired)
+
+        return master_df, new_manifest["version"]
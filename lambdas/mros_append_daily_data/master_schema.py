@@ -0,0 +1,390 @@
+# Description: Declared column schema for the MRoS master dataset (the output of mros_append_daily_data).
+# Coerces a pandas dataframe to typed columns (numbers, timestamps, dictionary-encoded categoricals) and
+# serializes it to a compressed, time-sorted Parquet file.
+# Columns that are not declared (e.g. a new column added upstream before it is added here) are handled as set by
+# MASTER_UNKNOWN_COLUMNS: kept as string columns ("string", the default), dropped ("drop") or rejected with a
+# SchemaDriftError ("fail"). They are logged either way. Values of declared columns that can not be coerced to the
+# declared type always raise a SchemaDriftError.
+# Usage: from mros_append_daily_data import master_schema
+# Author: Angus Watters
+
+# general utility libraries
+import io
+import os
+import re
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# per-stage lineage timestamp columns
+from mros_common import lineage
+
+# leveled, structured logging
+from mros_common import log
+
+# Environment variables
+# What to do with columns that are not declared below: "string" (keep them as strings), "drop" or "fail"
+UNKNOWN_COLUMNS = os.environ.get('MASTER_UNKNOWN_COLUMNS', 'string').lower()
+
+UNKNOWN_COLUMN_MODES = ("string", "drop", "fail")
+
+# kind of the undeclared columns that are kept
+UNKNOWN_COLUMN_KIND = "string"
+
+logger = log.get_logger("master_schema")
+
+# Parquet writer settings for the master dataset
+PARQUET_COMPRESSION       = "zstd"
+PARQUET_COMPRESSION_LEVEL = 6
+PARQUET_ROW_GROUP_SIZE    = 50000
+
+# column the master dataset is sorted on (epoch seconds of the observation), ties broken by record_hash
+SORT_COLUMNS = ["timestamp", "record_hash"]
+
+# string values that mean "missing" (CSV round trips and the old astype(str) Parquet files produce these)
+NULL_TOKENS = {"", "nan", "NaN", "None", "NA", "<NA>", "NaT", "null"}
+
+# Column kinds:
+# - "string":    free text / identifiers
+# - "category":  low cardinality strings, dictionary encoded in Parquet
+# - "float":     float64
+# - "int":       nullable 32 bit integer
+# - "timestamp": UTC timestamp (millisecond precision)
+# - "epoch_ms":  UTC timestamp (millisecond precision) given as epoch milliseconds (ISO 8601 strings also accepted)
+
+# columns coming from Airtable (mros_airtable_to_sqs), in master dataset names
+OBSERVATION_COLUMNS = [
+    ("id", "string"),
+    ("timestamp", "float"),
+    ("createdtime", "timestamp"),
+    ("phase", "category"),
+    ("latitude", "float"),
+    ("user", "string"),
+    ("longitude", "float"),
+    ("time_submitted_utc", "string"),
+    ("time_submitted_local", "string"),
+    ("date_submitted_utc", "category"),
+    ("date_submitted_local", "category"),
+    ("comment", "string"),
+    ("datetime_received_pacific", "timestamp"),
+    ("device_type", "category"),
+    ("duplicate_id", "string"),
+    ("duplicate_count", "int"),
+    # id of the kept record of a near duplicate (see mros_airtable_to_sqs/near_duplicates.py), missing otherwise
+    ("near_duplicate_of", "string"),
+]
+
+# columns added by the add_climate_data R container (modeled meteorology, geography and QA/QC flags)
+ENRICHMENT_COLUMNS = [
+    ("temp_air_idw_lapse_const", "float"),
+    ("temp_air_idw_lapse_var", "float"),
+    ("temp_air_nearest_site_const", "float"),
+    ("temp_air_nearest_site_var", "float"),
+    ("temp_air_avg_obs", "float"),
+    ("temp_air_min_obs", "float"),
+    ("temp_air_max_obs", "float"),
+    ("temp_air_lapse_var", "float"),
+    ("temp_air_lapse_var_r2", "float"),
+    ("temp_air_lapse_var_pval", "float"),
+    ("temp_air_n_stations", "int"),
+    ("temp_air_avg_time_gap", "float"),
+    ("temp_air_avg_dist", "float"),
+    ("temp_air_nearest_id", "string"),
+    ("temp_air_nearest_elev", "float"),
+    ("temp_air_nearest_dist", "float"),
+    ("temp_air_nearest", "float"),
+    ("temp_dew_idw_lapse_const", "float"),
+    ("temp_dew_idw_lapse_var", "float"),
+    ("temp_dew_nearest_site_const", "float"),
+    ("temp_dew_nearest_site_var", "float"),
+    ("temp_dew_avg_obs", "float"),
+    ("temp_dew_min_obs", "float"),
+    ("temp_dew_max_obs", "float"),
+    ("temp_dew_lapse_var", "float"),
+    ("temp_dew_lapse_var_r2", "float"),
+    ("temp_dew_lapse_var_pval", "float"),
+    ("temp_dew_n_stations", "int"),
+    ("temp_dew_avg_time_gap", "float"),
+    ("temp_dew_avg_dist", "float"),
+    ("temp_dew_nearest_id", "string"),
+    ("temp_dew_nearest_elev", "float"),
+    ("temp_dew_nearest_dist", "float"),
+    ("temp_dew_nearest", "float"),
+    ("rh", "float"),
+    ("temp_wet", "float"),
+    ("hads_counts", "int"),
+    ("lcd_counts", "int"),
+    ("wcc_counts", "int"),
+    ("madis_counts", "int"),
+    ("plp", "float"),
+    ("elevation", "float"),
+    ("eco_level3", "category"),
+    ("eco_level4", "category"),
+    ("state", "category"),
+    ("temp_air_flag", "category"),
+    ("rh_flag", "category"),
+    ("dist_temp_air_flag", "category"),
+    ("dist_temp_dew_flag", "category"),
+    ("closest_temp_air_flag", "category"),
+    ("closest_temp_dew_flag", "category"),
+    ("nstation_temp_air_flag", "category"),
+    ("nstation_temp_dew_flag", "category"),
+    ("pval_temp_air_flag", "category"),
+    ("pval_temp_dew_flag", "category"),
+    ("phase_flag", "category"),
+    ("CONUS", "category"),
+    ("comment_flag", "category"),
+]
+
+# columns added by mros_stage_to_prod
+STAGE_COLUMNS = [
+    ("geohash5", "category"),
+    ("geohash12", "string"),
+    ("date_key", "category"),
+    ("record_hash", "string"),
+]
+
+# per-stage lineage timestamps (see mros_common/lineage.py), missing in records from before they were added
+LINEAGE_COLUMNS = [(col, "epoch_ms") for col in lineage.MASTER_COLUMNS]
+
+# declared columns, in output order
+MASTER_COLUMNS = OBSERVATION_COLUMNS + ENRICHMENT_COLUMNS + STAGE_COLUMNS + LINEAGE_COLUMNS
+MASTER_KINDS   = dict(MASTER_COLUMNS)
+
+# The validation station columns ("met1_*", and "met2_*" in older records) mirror the modeled columns
+# of a randomly selected station, these are typed by pattern instead of being listed one by one
+PATTERN_KINDS = [
+    (re.compile(r"^met\d+_(id|id_raw|datetime_raw|temp_air_nearest_id|temp_dew_nearest_id)$"), "string"),
+    (re.compile(r"^met\d+_(temp_air_n_stations|temp_dew_n_stations|hads_counts|lcd_counts|wcc_counts|madis_counts)$"), "int"),
+    (re.compile(r"^met\d+_[a-z0-9_]+$"), "float"),
+]
+
+# pyarrow types for each column kind
+ARROW_TYPES = {
+    "string": pa.string(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+    "float": pa.float64(),
+    "int": pa.int32(),
+    "timestamp": pa.timestamp("ms", tz="UTC"),
+    "epoch_ms": pa.timestamp("ms", tz="UTC"),
+}
+
+class SchemaDriftError(ValueError):
+    """
+    Raised when a dataframe does not fit the declared master dataset schema
+    (unknown columns, or values that can not be coerced to the declared type).
+    """
+    pass
+
+def column_kind(column):
+    """
+    Get the declared kind of a master dataset column.
+
+    Parameters:
+    column (str): Column name.
+
+    Returns:
+    str: Column kind ("string", "category", "float", "int", "timestamp" or "epoch_ms"), or None if the column is not
+    declared.
+    """
+    if column in MASTER_KINDS:
+        return MASTER_KINDS[column]
+
+    for pattern, kind in PATTERN_KINDS:
+        if pattern.match(column):
+            return kind
+
+    return None
+
+def arrow_schema(columns):
+    """
+    Build the pyarrow schema for a list of master dataset columns.
+
+    Parameters:
+    columns (list): Column names (undeclared columns are strings, see column_kind()).
+
+    Returns:
+    pyarrow.Schema: Schema with a typed field for each column.
+    """
+    return pa.schema([pa.field(col, ARROW_TYPES[column_kind(col) or UNKNOWN_COLUMN_KIND]) for col in columns])
+
+def ordered_columns(columns):
+    """
+    Order columns as declared in MASTER_COLUMNS, with the pattern typed (met*_) columns
+    placed before the stage and lineage columns in the order they were given.
+    """
+    stage_cols = [col for col, _ in STAGE_COLUMNS + LINEAGE_COLUMNS]
+    declared   = [col for col, _ in OBSERVATION_COLUMNS + ENRICHMENT_COLUMNS]
+    extra      = [col for col in columns if col not in MASTER_KINDS]
+
+    return declared + extra + stage_cols
+
+def _null_tokens_to_na(series):
+    """Replace the string spellings of missing values with NA (only for object/string columns)."""
+    if series.dtype == object or pd.api.types.is_string_dtype(series):
+        return series.mask(series.isin(NULL_TOKENS))
+    return series
+
+def _raise_on_coerce_failures(column, original, coerced):
+    """Raise a SchemaDriftError if any non-missing value was lost in the coercion."""
+    failed = original.notna() & coerced.isna()
+
+    if failed.any():
+        examples = original[failed].astype(str).unique()[:5].tolist()
+        raise SchemaDriftError(
+            f"{failed.sum()} value(s) in column '{column}' can not be coerced to '{column_kind(column)}' (e.g. {examples})"
+            )
+
+def _epoch_ms_to_datetime(series):
+    """Convert epoch milliseconds (numbers or numeric strings) to UTC timestamps, keeping typed/ISO 8601 values."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return pd.to_datetime(series, utc=True)
+
+    numeric = pd.to_numeric(series, errors="coerce")
+    valid   = numeric.notna()
+
+    # only the non-missing values are converted: older records have no lineage columns, so those are all NaN and
+    # are skipped entirely (the rest of the column stays NaT)
+    coerced = pd.Series(pd.NaT, index=series.index, dtype="datetime64[ns, UTC]", name=series.name)
+
+    if valid.any():
+        coerced[valid] = pd.to_datetime(numeric[valid], unit="ms", utc=True)
+
+    # the CSV export writes these columns as ISO 8601 strings
+    text = series.notna() & numeric.isna()
+
+    if text.any():
+        coerced[text] = pd.to_datetime(series[text], errors="coerce", utc=True, format="ISO8601")
+
+    return coerced
+
+def coerce_column(column, series):
+    """
+    Coerce a single column to its declared kind (undeclared columns to strings).
+
+    Parameters:
+    column (str): Column name.
+    series (pandas.Series): Column values.
+
+    Returns:
+    pandas.Series: Typed column values.
+    """
+    kind   = column_kind(column) or UNKNOWN_COLUMN_KIND
+    series = _null_tokens_to_na(series)
+
+    if kind == "float":
+        coerced = pd.to_numeric(series, errors="coerce").astype("float64")
+
+    elif kind == "int":
+        numeric = pd.to_numeric(series, errors="coerce")
+
+        # integer columns must hold whole numbers (R writes counts as doubles, e.g. "3.0")
+        fractional = numeric.notna() & (numeric % 1 != 0)
+        if fractional.any():
+            raise SchemaDriftError(f"Column '{column}' has non-integer values (e.g. {numeric[fractional].unique()[:5].tolist()})")
+
+        coerced = numeric.astype("Int32")
+
+    elif kind == "timestamp":
+        coerced = pd.to_datetime(series, errors="coerce", utc=True, format="ISO8601")
+
+    elif kind == "epoch_ms":
+        coerced = _epoch_ms_to_datetime(series)
+
+    elif kind == "category":
+        coerced = series.astype("string").astype("category")
+
+    else:
+        coerced = series.astype("string")
+
+    _raise_on_coerce_failures(column, series, coerced)
+
+    return coerced
+
+def handle_unknown_columns(df, mode=None):
+    """
+    Keep, drop or reject the columns of a dataframe that are not part of the declared schema.
+
+    Parameters:
+    df (pandas.DataFrame): Dataframe with master dataset column names.
+    mode (str): "string", "drop" or "fail" (defaults to MASTER_UNKNOWN_COLUMNS).
+
+    Returns:
+    pandas.DataFrame: The dataframe, without the undeclared columns in "drop" mode.
+    """
+    mode = (mode or UNKNOWN_COLUMNS).lower()
+
+    if mode not in UNKNOWN_COLUMN_MODES:
+        raise ValueError(f"Unknown MASTER_UNKNOWN_COLUMNS mode '{mode}', must be one of {UNKNOWN_COLUMN_MODES}")
+
+    unknown_cols = [col for col in df.columns if column_kind(col) is None]
+
+    if not unknown_cols:
+        return df
+
+    if mode == "fail":
+        raise SchemaDriftError(f"Columns not in the master dataset schema: {unknown_cols}")
+
+    logger.warning("Columns not in the master dataset schema (%s)", "dropped" if mode == "drop" else "kept as strings",
+                   columns=unknown_cols, mode=mode)
+
+    if mode == "drop":
+        return df.drop(columns=unknown_cols)
+
+    return df
+
+def coerce_to_schema(df, unknown_columns=None):
+    """
+    Coerce a dataframe to the declared master dataset schema.
+    Declared columns missing from the dataframe are added as all-missing columns,
+    columns that are not declared are kept as strings, dropped or rejected (see handle_unknown_columns()).
+
+    Parameters:
+    df (pandas.DataFrame): Master dataset (or a batch of new records) with master dataset column names.
+    unknown_columns (str): Handling of undeclared columns (defaults to MASTER_UNKNOWN_COLUMNS).
+
+    Returns:
+    pandas.DataFrame: Typed dataframe, columns in declared order, sorted by time.
+    """
+    df = handle_unknown_columns(df, unknown_columns)
+
+    columns = ordered_columns(df.columns)
+
+    typed_df = pd.DataFrame(
+        {col: coerce_column(col, df[col]) if col in df.columns else coerce_column(col, pd.Series([None] * len(df), index=df.index, dtype=object))
+         for col in columns},
+        index=df.index
+        )
+
+    # sort by observation time
+    typed_df = typed_df.sort_values(SORT_COLUMNS, kind="stable", na_position="last").reset_index(drop=True)
+
+    return typed_df
+
+def to_parquet_bytes(df):
+    """
+    Serialize a dataframe to Parquet bytes using the master dataset schema, codec and row group size.
+
+    Parameters:
+    df (pandas.DataFrame): Dataframe, already coerced via coerce_to_schema().
+
+    Returns:
+    bytes: Parquet file contents.
+    """
+    schema = arrow_schema(df.columns)
+    table  = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    buffer = io.BytesIO()
+
+    pq.write_table(
+        table,
+        buffer,
+        compression       = PARQUET_COMPRESSION,
+        compression_level = PARQUET_COMPRESSION_LEVEL,
+        row_group_size    = PARQUET_ROW_GROUP_SIZE,
+        use_dictionary    = [col for col in df.columns if column_kind(col) == "category"],
+        write_statistics  = True
+        )
+
+    return buffer.getvalue()
@@ -0,0 +1,304 @@
+# Description: Read/write helpers for the MRoS master dataset in S3.
+# The Parquet file is the source of truth for the master dataset, reads only pull the columns a step needs
+# and the CSV file is a derived export that is written from the typed Parquet data.
+#
+# NOTE: the single file exports (mros_output.parquet, mros_output.csv) are only rewritten when the master dataset is
+# NOTE: compacted (see master_manifest.py), so they lag the master dataset by up to MASTER_COMPACT_DELTAS - 1 appends.
+# NOTE: Each export carries the manifest version it was written from in its "master-version" object metadata
+# NOTE: (x-amz-meta-master-version) and is only overwritten by a newer version, so a slow compaction can not roll an
+# NOTE: export back. Consumers that need the latest records read the manifest (mros_output/_manifest.json) instead.
+# Usage: from mros_append_daily_data import master_store
+# Author: Angus Watters
+
+# general utility libraries
+import pandas as pd
+import awswrangler as wr
+
+# AWS SDK for Python (Boto3) exceptions, lazily created boto3 clients, leveled, structured logging
+from botocore.exceptions import ClientError
+from mros_common import aws
+from mros_common import log
+
+# declared (typed) schema of the master dataset
+from mros_append_daily_data import master_schema
+
+# /tmp cache of the master dataset files for warm containers
+from mros_append_daily_data import master_cache
+
+# columns needed to check new records against the master dataset
+DEDUP_COLUMNS = ["duplicate_id", "record_hash"]
+
+# NOTE: the first time this remapping happens, it will change the column names in the S3 bucket and
+# NOTE: the subsequent times it will not as theyll have already been updated that first time
+COLUMN_RENAME_MAP = {
+    'name' : 'phase',
+    'submitted_date' : 'date_submitted_utc',
+    'submitted_time' : 'time_submitted_utc',
+    'local_time' : 'time_submitted_local',
+    'local_date' : 'date_submitted_local',
+    'time' : 'datetime_received_pacific'
+    }
+
+# object metadata key holding the manifest version a single file export was written from
+EXPORT_VERSION_METADATA = "master-version"
+
+# S3 error codes returned when a conditional write loses the race
+CONFLICT_ERROR_CODES = {"PreconditionFailed", "ConditionalRequestConflict"}
+
+# attempts of a versioned export write that keeps losing the race against other appenders
+EXPORT_WRITE_ATTEMPTS = 5
+
+# S3 client (created on first use)
+s3 = aws.LazyClient('s3')
+
+logger = log.get_logger("master_store")
+
+# timestamp format used in the CSV export (matches the Airtable ISO 8601 strings, e.g. "2024-06-15T00:00:00.000Z")
+CSV_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+def parquet_uri_for(csv_uri):
+    """
+    Get the S3 URI of the Parquet master dataset that goes with a CSV export URI.
+
+    Parameters:
+    csv_uri (str): S3 URI of the CSV export (e.g. "s3://bucket/mros_output.csv").
+
+    Returns:
+    str: S3 URI of the Parquet master (e.g. "s3://bucket/mros_output.parquet").
+    """
+    return csv_uri.replace('.csv', '.parquet')
+
+def read_parquet_columns(parquet_uri, columns=None):
+    """
+    Read a subset of columns from a master dataset Parquet file and coerce them to their declared types.
+
+    Parameters:
+    parquet_uri (str): S3 URI of the Parquet file.
+    columns (list): Columns to read (None reads all columns).
+
+    Returns:
+    pandas.DataFrame: Typed columns.
+    """
+    logger.debug("Reading columns %s from Parquet file '%s'", columns if columns else 'ALL', parquet_uri)
+
+    # local copy from the /tmp cache (None if the cache is disabled, the file is too large to cache, or it is not
+    # cached and only some columns are read: those are read from S3 without downloading the other columns)
+    local_path = master_cache.fetch(parquet_uri, columns=columns)
+
+    if local_path:
+        df = pd.read_parquet(local_path, columns=columns)
+    else:
+        df = wr.s3.read_parquet(parquet_uri, columns=columns)
+
+    # old Parquet files were written with every column as strings, coerce each column to its declared type
+    return pd.DataFrame({col: master_schema.coerce_column(col, df[col]) for col in df.columns}, index=df.index)
+
+def read_master_columns(parquet_uri, columns, csv_uri=None):
+    """
+    Read a subset of columns from the Parquet master dataset.
+    If the Parquet file does not exist yet and a CSV URI is given, the columns are read from the CSV file instead.
+
+    Parameters:
+    parquet_uri (str): S3 URI of the Parquet master dataset.
+    columns (list): Columns to read (None reads all columns).
+    csv_uri (str): Optional S3 URI of the legacy CSV master dataset used as a fallback.
+
+    Returns:
+    pandas.DataFrame: Typed master dataset columns.
+    """
+    if wr.s3.does_object_exist(parquet_uri):
+        return read_parquet_columns(parquet_uri, columns)
+
+    if not csv_uri:
+        raise FileNotFoundError(f"Master dataset not found at '{parquet_uri}'")
+
+    logger.info("Parquet master '%s' not found, reading CSV master '%s'", parquet_uri, csv_uri)
+
+    df = wr.s3.read_csv(csv_uri, usecols=lambda col: columns is None or COLUMN_RENAME_MAP.get(col, col) in columns)
+    df = df.rename(columns=COLUMN_RENAME_MAP)
+
+    return pd.DataFrame({col: master_schema.coerce_column(col, df[col]) for col in df.columns}, index=df.index)
+
+def drop_existing_records(input_df, master_keys_df):
+    """
+    Remove records that are already in the master dataset (same duplicate_id or record_hash)
+    and records without a record_hash.
+
+    Parameters:
+    input_df (pandas.DataFrame): New records.
+    master_keys_df (pandas.DataFrame): The DEDUP_COLUMNS of the master dataset.
+
+    Returns:
+    pandas.DataFrame: Records of input_df that are not in the master dataset yet.
+    """
+    input_df = input_df[~input_df["duplicate_id"].isin(master_keys_df["duplicate_id"])]
+    input_df = input_df[~input_df["record_hash"].isna() & ~input_df["record_hash"].isin(master_keys_df["record_hash"])]
+
+    return input_df
+
+def read_master(parquet_uri, csv_uri=None):
+    """
+    Read the full master dataset and coerce it to the declared schema.
+
+    Parameters:
+    parquet_uri (str): S3 URI of the Parquet master dataset.
+    csv_uri (str): Optional S3 URI of the legacy CSV master dataset used as a fallback.
+
+    Returns:
+    pandas.DataFrame: Typed master dataset.
+    """
+    df = read_master_columns(parquet_uri, None, csv_uri)
+
+    return master_schema.coerce_to_schema(df)
+
+def write_master(df, parquet_uri):
+    """
+    Write the (already coerced) master dataset to S3 as Parquet.
+
+    Parameters:
+    df (pandas.DataFrame): Typed master dataset (see master_schema.coerce_to_schema()).
+    parquet_uri (str): S3 URI to write to.
+
+    Returns:
+    int: Number of bytes written.
+    """
+    parquet_bytes = master_schema.to_parquet_bytes(df)
+    bucket, key   = _split_uri(parquet_uri)
+
+    response = s3.put_object(Bucket=bucket, Key=key, Body=parquet_bytes, ContentType="application/octet-stream")
+
+    # keep a local copy so reading the file back in this container does not download it again
+    master_cache.store(parquet_uri, parquet_bytes, response["ETag"])
+
+    return len(parquet_bytes)
+
+def _split_uri(uri):
+    bucket, key = uri.replace("s3://", "").split("/", 1)
+    return bucket, key
+
+def export_version(uri):
+    """
+    Get the manifest version a single file export was written from.
+
+    Returns:
+    tuple: (version, ETag), version is -1 for an export without version metadata, (None, None) if there is no export.
+    """
+    bucket, key = _split_uri(uri)
+
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, None
+        raise
+
+    return int(head.get("Metadata", {}).get(EXPORT_VERSION_METADATA, -1)), head["ETag"]
+
+def put_export(uri, body, version, content_type):
+    """
+    Write a single file export of the master dataset, unless the export in S3 was written from the same or a newer
+    manifest version. The write is conditional on the ETag of the export that was checked, so another appender
+    can not replace it in between.
+
+    Parameters:
+    uri (str): S3 URI of the export.
+    body (bytes): Export contents.
+    version (int): Manifest version the export was written from.
+    content_type (str): Content type of the export.
+
+    Returns:
+    str: ETag of the written export, or None if a newer export is already in S3.
+    """
+    bucket, key = _split_uri(uri)
+
+    for attempt in range(EXPORT_WRITE_ATTEMPTS):
+        current_version, etag = export_version(uri)
+
+        if current_version is not None and current_version >= version:
+            logger.info("'%s' was already written from manifest version %s, not writing version %s", uri, current_version, version)
+            return None
+
+        condition = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+
+        try:
+            response = s3.put_object(
+                Bucket      = bucket,
+                Key         = key,
+                Body        = body,
+                ContentType = content_type,
+                Metadata    = {EXPORT_VERSION_METADATA: str(version)},
+                **condition
+                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in CONFLICT_ERROR_CODES:
+                logger.info("'%s' was changed by another appender while writing version %s, checking again", uri, version)
+                continue
+            raise
+
+        return response["ETag"]
+
+    logger.warning("'%s' kept changing, gave up writing manifest version %s after %s attempts", uri, version, EXPORT_WRITE_ATTEMPTS)
+
+    return None
+
+def write_parquet_export(df, parquet_uri, version):
+    """
+    Write the single file Parquet export of the (already coerced) master dataset (see put_export()).
+
+    Parameters:
+    df (pandas.DataFrame): Typed master dataset.
+    parquet_uri (str): S3 URI of the export.
+    version (int): Manifest version the master dataset was read from.
+
+    Returns:
+    int: Number of bytes written, or None if a newer export is already in S3.
+    """
+    parquet_bytes = master_schema.to_parquet_bytes(df)
+
+    etag = put_export(parquet_uri, parquet_bytes, version, "application/octet-stream")
+
+    if etag is None:
+        return None
+
+    # keep a local copy so reading the file back in this container does not download it again
+    master_cache.store(parquet_uri, parquet_bytes, etag)
+
+    return len(parquet_bytes)
+
+def to_export_frame(df):
+    """
+    Convert the typed master dataset into the CSV export layout (timestamps as ISO 8601 strings).
+
+    Parameters:
+    df (pandas.DataFrame): Typed master dataset.
+
+    Returns:
+    pandas.DataFrame: Dataframe ready to write as CSV.
+    """
+    export_df = df.copy()
+
+    for col in export_df.columns:
+        if master_schema.column_kind(col) in ("timestamp", "epoch_ms"):
+            # millisecond precision, "Z" suffix for UTC
+            export_df[col] = export_df[col].dt.strftime(CSV_TIMESTAMP_FORMAT).str[:-3] + "Z"
+
+    return export_df
+
+def write_csv_export(df, csv_uri, version):
+    """
+    Write the derived CSV export of the master dataset to S3 (see put_export()).
+
+    Parameters:
+    df (pandas.DataFrame): Typed master dataset.
+    csv_uri (str): S3 URI to write to.
+    version (int): Manifest version the master dataset was read from.
+
+    Returns:
+    int: Number of bytes written, or None if a newer export is already in S3.
+    """
+    csv_bytes = to_export_frame(df).to_csv(index = False).encode("utf-8")
+
+    if put_export(csv_uri, csv_bytes, version, "text/csv") is None:
+        return None
+
+    return len(csv_bytes)
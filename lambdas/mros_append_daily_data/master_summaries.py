@@ -0,0 +1,263 @@
+# Description: Pre-aggregated summary tables of the MRoS master dataset, maintained incrementally by mros_append_daily_data.
+# Each table holds observation counts (n_obs) grouped by a few low cardinality columns, so dashboards and
+# common queries read a few KB of Parquet instead of scanning the full master dataset.
+#
+# The tables are updated from the delta files listed in the master manifest (see master_manifest.py). The master
+# dataset already guarantees that every record_hash is in exactly one delta (or the snapshot), so counting each
+# delta once counts each record_hash once. The deltas that were counted are recorded in the summary state,
+# which makes an update idempotent: redelivered SQS messages, retries and concurrent appenders never count a
+# record twice, and deltas that a failed invocation did not count are picked up by the next one.
+# When the deltas are compacted into a new snapshot, the counts are kept as is if every compacted delta was
+# already counted, otherwise the tables are rebuilt from the master dataset (only the grouping columns are read).
+#
+# Every update writes new table files. The files of the replaced state are listed in the state "garbage" and deleted
+# by a later update once they are MASTER_GC_GRACE_S seconds old (readers of the older state may still be reading
+# them), the files of an update that lost the race are deleted right away. Their old versions in the versioned
+# bucket are expired by the lifecycle rule of the "mros_output/" prefix (infra/s3.tf).
+#
+# S3 layout (for OUTPUT_OBJECT_KEY = "mros_output.csv"):
+#   mros_output/summaries/_summaries.json                 <- summary state (tables, counted deltas, garbage)
+#   mros_output/summaries/daily_counts/<uuid>.parquet
+#   mros_output/summaries/geohash5_counts/<uuid>.parquet
+#   mros_output/summaries/phase_counts/<uuid>.parquet
+#   mros_output/summaries/device_type_counts/<uuid>.parquet
+#
+# Usage: from mros_append_daily_data import master_summaries
+# Author: Angus Watters
+
+# general utility libraries
+import uuid
+
+import pandas as pd
+import awswrangler as wr
+
+# commit protocol of the master dataset (manifest reads, conditional JSON writes and retries)
+from mros_append_daily_data import master_manifest
+
+# leveled, structured logging
+from mros_common import log
+
+SUMMARIES_NAME = "_summaries.json"
+
+logger = log.get_logger("master_summaries")
+
+# summary table name -> columns the observation counts are grouped by
+SUMMARY_TABLES = {
+    "daily_counts": ["date_key", "phase"],
+    "geohash5_counts": ["geohash5", "phase"],
+    "phase_counts": ["phase"],
+    "device_type_counts": ["date_key", "device_type"],
+}
+
+# columns of the master dataset needed to build the summary tables
+SUMMARY_COLUMNS = sorted({col for cols in SUMMARY_TABLES.values() for col in cols}) + ["record_hash"]
+
+# group value used for missing values (Parquet and groupby() are simpler without nulls in the group columns)
+MISSING_GROUP = "unknown"
+
+def summaries_prefix(prefix):
+    """Get the S3 key prefix of the summary files from the master dataset prefix (e.g. "mros_output/summaries")."""
+    return f"{prefix}/summaries"
+
+def summaries_key(prefix):
+    """Get the S3 key of the summary state JSON file."""
+    return f"{summaries_prefix(prefix)}/{SUMMARIES_NAME}"
+
+def count_records(records_df):
+    """
+    Count observations for each summary table.
+
+    Parameters:
+    records_df (pandas.DataFrame): Master dataset records (at least the SUMMARY_COLUMNS).
+
+    Returns:
+    dict: Summary table name -> pandas.DataFrame of group columns and "n_obs".
+    """
+    # a record_hash is only ever counted once
+    records_df = records_df.drop_duplicates(subset=["record_hash"])
+
+    tables = {}
+
+    for name, group_cols in SUMMARY_TABLES.items():
+        groups = records_df[group_cols].astype("string").fillna(MISSING_GROUP)
+        tables[name] = groups.value_counts(sort=False).rename("n_obs").reset_index()
+
+    return tables
+
+def merge_counts(tables, new_tables):
+    """
+    Add the counts of new_tables to tables.
+
+    Returns:
+    dict: Summary table name -> pandas.DataFrame with the summed counts, sorted by the group columns.
+    """
+    merged = {}
+
+    for name, group_cols in SUMMARY_TABLES.items():
+        df = pd.concat([tables[name], new_tables[name]], axis=0, ignore_index=True)
+
+        merged[name] = (
+            df.groupby(group_cols, as_index=False)["n_obs"]
+            .sum()
+            .astype({"n_obs": "int64"})
+            .sort_values(group_cols, ignore_index=True)
+            )
+
+    return merged
+
+def read_tables(bucket, state):
+    """Read all summary tables listed in the summary state."""
+    return {name: wr.s3.read_parquet(f"s3://{bucket}/{state['tables'][name]}") for name in SUMMARY_TABLES}
+
+def write_tables(bucket, prefix, tables):
+    """
+    Write each summary table to a new Parquet file (files are never overwritten, the state points to the current ones).
+
+    Returns:
+    dict: Summary table name -> S3 key.
+    """
+    keys = {}
+
+    for name, df in tables.items():
+        keys[name] = f"{summaries_prefix(prefix)}/{name}/{uuid.uuid4().hex}.parquet"
+        wr.s3.to_parquet(df, f"s3://{bucket}/{keys[name]}", index=False, compression="zstd")
+
+    return keys
+
+def state_keys(state):
+    """Get the keys of every table file a summary state refers to (current tables and garbage waiting to be deleted)."""
+    if state is None:
+        return set()
+
+    return set(state["tables"].values()) | {entry["key"] for entry in state.get("garbage", [])}
+
+def read_summary(bucket, prefix, table):
+    """
+    Read a summary table.
+
+    Parameters:
+    bucket (str): Output S3 bucket name.
+    prefix (str): Key prefix of the master dataset files (see master_manifest.master_prefix()).
+    table (str): Summary table name (a key of SUMMARY_TABLES).
+
+    Returns:
+    pandas.DataFrame: Group columns and "n_obs", or None if the summaries were not built yet.
+    """
+    state, _ = master_manifest.read_json(bucket, summaries_key(prefix))
+
+    if state is None:
+        return None
+
+    return wr.s3.read_parquet(f"s3://{bucket}/{state['tables'][table]}")
+
+def _plan_update(bucket, state, manifest):
+    """
+    Work out how to bring the summary state up to date with the manifest.
+
+    Returns:
+    tuple: (tables dict, list of counted delta keys, list of delta entries still to count),
+           tables is None when the summaries have to be rebuilt from the whole master dataset.
+    """
+    snapshot_key = manifest["snapshot"]["key"] if manifest["snapshot"] else None
+
+    if state is None:
+        logger.info("No summary state found, building summaries from the master dataset")
+        return None, [], []
+
+    if state["snapshot"] != snapshot_key:
+        compacted_from = manifest.get("compacted_from") or {}
+
+        # the summaries already count everything that was compacted into the new snapshot
+        if compacted_from.get("snapshot") == state["snapshot"] and \
+           set(compacted_from.get("deltas", [])) <= set(state["deltas"]):
+            logger.debug("Master dataset was compacted, keeping summary counts")
+            counted = [key for key in state["deltas"] if key not in compacted_from["deltas"]]
+        else:
+            logger.info("Summaries are behind the master dataset snapshot '%s', rebuilding summaries", snapshot_key)
+            return None, [], []
+    else:
+        counted = list(state["deltas"])
+
+    missing = [entry for entry in manifest["deltas"] if entry["key"] not in counted]
+
+    return read_tables(bucket, state), counted, missing
+
+def update_summaries(bucket, prefix, manifest):
+    """
+    Bring the summary tables up to date with a committed version of the master dataset manifest.
+
+    Parameters:
+    bucket (str): Output S3 bucket name.
+    prefix (str): Key prefix of the master dataset files (see master_manifest.master_prefix()).
+    manifest (dict): Committed master dataset manifest.
+
+    Returns:
+    dict: Update stats ("counted_deltas", "rebuilt", "retries", "version").
+    """
+    stats = {"counted_deltas": 0, "rebuilt": False, "retries": 0, "version": None}
+
+    for attempt in range(master_manifest.MAX_COMMIT_RETRIES + 1):
+        state, etag = master_manifest.read_json(bucket, summaries_key(prefix))
+
+        # another appender already brought the summaries up to (or past) this manifest version
+        if state is not None and state["manifest_version"] >= manifest["version"]:
+            logger.debug("Summaries are at manifest version %s, nothing to update", state['manifest_version'])
+            stats["version"] = state["manifest_version"]
+            return stats
+
+        tables, counted, missing = _plan_update(bucket, state, manifest)
+
+        if tables is None:
+            records_df = master_manifest.read_manifest_columns(bucket, manifest, SUMMARY_COLUMNS)
+            tables     = count_records(records_df)
+            counted    = [entry["key"] for entry in manifest["deltas"]]
+            stats["rebuilt"] = True
+
+        elif missing:
+            logger.debug("Counting %s new delta(s) into the summaries", len(missing))
+            records_df = master_manifest.read_manifest_columns(bucket, manifest, SUMMARY_COLUMNS, entries=missing)
+            tables     = merge_counts(tables, count_records(records_df))
+            counted    = counted + [entry["key"] for entry in missing]
+
+        # table files of the current state are superseded by the new ones, garbage past the grace period is deleted
+        garbage = state.get("garbage", []) if state else []
+        expired = [entry["key"] for entry in garbage
+                   if master_manifest.age_seconds(entry["superseded_at"]) >= master_manifest.GC_GRACE_SECONDS]
+
+        new_state = {
+            "version": (state["version"] + 1) if state else 0,
+            "manifest_version": manifest["version"],
+            "snapshot": manifest["snapshot"]["key"] if manifest["snapshot"] else None,
+            "deltas": counted,
+            "tables": write_tables(bucket, prefix, tables),
+            "rows": {name: len(df) for name, df in tables.items()},
+            "garbage": [entry for entry in garbage if entry["key"] not in expired] +
+                       [{"key": key, "superseded_at": master_manifest.utc_now()}
+                        for key in (state["tables"].values() if state else [])],
+            "updated_at": master_manifest.utc_now()
+            }
+
+        try:
+            master_manifest.put_json(bucket, summaries_key(prefix), new_state, etag)
+        except master_manifest.ManifestConflictError as e:
+            logger.info("Summary commit attempt %s failed: %s", attempt + 1, e)
+
+            # drop the table files of this attempt, unless the write did go through (e.g. the response was lost)
+            latest, _ = master_manifest.read_json(bucket, summaries_key(prefix))
+            master_manifest.delete_keys(bucket, set(new_state["tables"].values()) - state_keys(latest))
+
+            if attempt == master_manifest.MAX_COMMIT_RETRIES:
+                raise
+
+            stats["retries"] += 1
+            stats["rebuilt"]  = False
+
+            master_manifest.backoff(attempt)
+            continue
+
+        logger.info("Committed summaries for manifest version %s", manifest['version'], rows=new_state['rows'])
+
+        master_manifest.delete_keys(bucket, expired)
+
+        stats.update(counted_deltas=len(missing), version=manifest["version"])
+        return stats
@@ -1,5 +1,9 @@
 # Description: Lambda function runs when new messages appear in SQS queue and takes the S3 event notification info from the message,
-#  downloads the new input dataset, and appends it to the existing stationary CSV file in S3 and writes a new CSV and new parquet file back to the output S3 bucket.
+#  downloads the new input dataset, and appends it to the master dataset in the output S3 bucket as a delta Parquet file
+#  committed to the master dataset manifest (see master_manifest.py). Once enough deltas pile up, they are compacted
+#  into a new snapshot and the single file Parquet (and a derived CSV export) are rewritten. The exports are
+#  therefore up to MASTER_COMPACT_DELTAS - 1 appends behind the manifest (see master_store.py).
+#  Pre-aggregated summary tables (see master_summaries.py) are updated after each commit.
 # Usage: python mros_append_daily_data.py
 # Author: Angus Watters
 
@@ -16,6 +20,27 @@ import json
 
 import awswrangler as wr
 
+# declared (typed) schema of the master dataset and S3 read/write helpers
+from mros_append_daily_data import master_schema
+from mros_append_daily_data import master_store
+
+# snapshot/delta manifest commit protocol (lets several appenders run at once)
+from mros_append_daily_data import master_manifest
+
+# pre-aggregated daily/geohash5/phase/device type counts of the master dataset
+from mros_append_daily_data import master_summaries
+
+# /tmp cache of the master dataset files (hit/miss metrics are logged per invocation)
+from mros_append_daily_data import master_cache
+
+# per-invocation phase timers and counters (CloudWatch EMF), leveled, sampled logging and opt-in profiling
+from mros_common import metrics
+from mros_common import log
+from mros_common import profiling
+
+# per-stage lineage timestamps
+from mros_common import lineage
+
 # # NOTE: for debugging
 # import boto3
 # boto3_session = boto3.Session(profile_name="my-aws-profile-name")
@@ -27,42 +52,36 @@ import awswrangler as wr
 OUTPUT_S3_BUCKET  = os.environ.get('OUTPUT_S3_BUCKET')
 OUTPUT_OBJECT_KEY = os.environ.get('OUTPUT_OBJECT_KEY')
 
+# Write the derived CSV export of the master dataset after each append (set to "false" to only keep the Parquet master)
+WRITE_CSV_EXPORT  = os.environ.get('WRITE_CSV_EXPORT', 'true').lower() == 'true'
+
+logger = log.get_logger("mros_append_daily_data")
+
 # lambda handler function
+@metrics.instrumented("mros_append_daily_data")
+@profiling.profiled("mros_append_daily_data")
 def mros_append_daily_data(event, context):
-    print(f"===" * 5)
-    print(f"event: {event}")
-    print(f"===" * 5)
+    logger.debug("event: %s", event)
+
+    master_cache.reset_stats()
 
 
     # Get the SQS event message
     message = event['Records'][0]
 
-    print(f"message: {message}")
-
-    print(f"Extracting message body...")
-
     # Get the SQS event message body
     message_body = message["body"]
 
-    print(f"message_body: {message_body}")
-    print(f"Converting 'message_body' from JSON to dict...")
-
     message_body = json.loads(message_body)
 
-    print(f"Extracting 'inner_json' from message_body...")
-
     inner_json = message_body["Message"]
 
-    print(f"- inner_json: {inner_json}")
-    print(f"Converting 'inner_json' from JSON to dict...")
-
     # Convert the SQS event message from JSON to dict
     inner_json = json.loads(inner_json)
 
-    print(f"Extracting s3_event from inner_json...")
     s3_event = inner_json["Records"][0]
 
-    print(f"--> s3_event: {s3_event}")
+    logger.debug("s3_event: %s", s3_event)
 
     # # NOTE: testing with a hard-coded S3 event
     # OUTPUT_S3_BUCKET  = "mros-output-bucket" 
@@ -77,118 +96,142 @@ def mros_append_daily_data(event, context):
     INPUT_S3_URI = f"s3://{INPUT_S3_BUCKET}/{INPUT_OBJECT_KEY}"
     OUTPUT_S3_URI = f"s3://{OUTPUT_S3_BUCKET}/{OUTPUT_OBJECT_KEY}"
 
-    print(f"- INPUT_S3_BUCKET: {INPUT_S3_BUCKET}")
-    print(f"- INPUT_OBJECT_KEY: {INPUT_OBJECT_KEY}")
-    print(f"- INPUT_S3_URI: {INPUT_S3_URI}")
-    print(f"- OUTPUT_S3_BUCKET: {OUTPUT_S3_BUCKET}")
-    print(f"- OUTPUT_OBJECT_KEY: {OUTPUT_OBJECT_KEY}")
-    print(f"- OUTPUT_S3_URI: {OUTPUT_S3_URI}")
-  
+    # The master dataset is a snapshot + delta Parquet files listed in a manifest under MASTER_PREFIX,
+    # the single file Parquet and CSV files are derived exports written after each compaction
+    MASTER_PREFIX      = master_manifest.master_prefix(OUTPUT_OBJECT_KEY)
+    MASTER_PARQUET_URI = master_store.parquet_uri_for(OUTPUT_S3_URI)
+
+    logger.info("Appending '%s' to the master dataset", INPUT_S3_URI, OUTPUT_S3_URI=OUTPUT_S3_URI,
+                MASTER_PREFIX=MASTER_PREFIX, MASTER_PARQUET_URI=MASTER_PARQUET_URI, WRITE_CSV_EXPORT=WRITE_CSV_EXPORT)
+
     # Read the CSV file into a Pandas dataframe
     try:
         # Read the CSV file into a Pandas dataframe
-        input_df = wr.s3.read_csv(INPUT_S3_URI)
+        with metrics.phase("read_input"):
+            input_df = wr.s3.read_csv(INPUT_S3_URI)
         # input_df = wr.s3.read_csv(INPUT_S3_URI, boto3_session=boto3_session) # NOTE: for debugging
-        print(f"CSV file read into Pandas dataframe")
     except Exception as e:
-        print(f"Exception reading CSV file into Pandas dataframe: {e}")
-        print(f"Problem INPUT_S3_URI: {INPUT_S3_URI}")
+        logger.error("Exception reading CSV file into Pandas dataframe: %s", e, INPUT_S3_URI=INPUT_S3_URI)
         raise e
-    
+
+    # Rename the columns in the input dataframe to the master dataset column names
+    input_df.rename(columns=master_store.COLUMN_RENAME_MAP, inplace=True)
+
+    logger.debug("input_df dimensions", rows=len(input_df), columns=len(input_df.columns))
+
+    metrics.count("records_in", len(input_df))
+
+    # stamp the append time (records already in the master dataset keep the timestamps of their first append)
+    input_df[lineage.APPENDED] = lineage.now_ms()
+
+    # Remove records already in the master dataset, write the rest as a delta file and commit it to the manifest
+    # (retries if another appender committed in the meantime, raises a SchemaDriftError on values that do not fit
+    # the declared column types, undeclared columns are handled as set by MASTER_UNKNOWN_COLUMNS)
     try:
-        # Read the CSV file into a Pandas dataframe
-        output_df = wr.s3.read_csv(OUTPUT_S3_URI)
-        # output_df = wr.s3.read_csv(OUTPUT_S3_URI, boto3_session=boto3_session) # NOTE: for debugging
-        print(f"CSV file read into Pandas dataframe")
+        with metrics.phase("commit"):
+            commit = master_manifest.commit_append(
+                bucket             = OUTPUT_S3_BUCKET,
+                prefix             = MASTER_PREFIX,
+                input_df           = input_df,
+                source_uri         = INPUT_S3_URI,
+                legacy_parquet_uri = MASTER_PARQUET_URI,
+                legacy_csv_uri     = OUTPUT_S3_URI
+                )
+    except master_schema.SchemaDriftError as e:
+        logger.error("Master dataset schema drift, RAISING EXCEPTION ON SCHEMA COERCION: %s", e, INPUT_S3_URI=INPUT_S3_URI)
+        raise e
     except Exception as e:
-        print(f"Exception reading CSV file into Pandas dataframe: {e}")
-        print(f"Problem OUTPUT_S3_URI: {OUTPUT_S3_URI}")
+        logger.error("Exception committing new records to the master dataset, RAISING EXCEPTION ON MANIFEST COMMIT: %s", e,
+                     INPUT_S3_URI=INPUT_S3_URI, MASTER_PREFIX=MASTER_PREFIX)
         raise e
-    
-    # NOTE: This is where we convert the names of the columns into the new desired column names, if necessary
-    # NOTE: the first time this remapping happens, it will change the column names in the S3 bucket and 
-    # NOTE: the subsequent times it will not as theyll have already been updated that first time
-    column_rename_map = {
-                'name' : 'phase',
-                'submitted_date' : 'date_submitted_utc',
-                'submitted_time' : 'time_submitted_utc',
-                'local_time' : 'time_submitted_local',
-                'local_date' : 'date_submitted_local',
-                'time' : 'datetime_received_pacific'
-                }
-
-    # Rename the columns in the input dataframe
-    input_df.rename(columns=column_rename_map, inplace=True)
-
-    # rename the columns in the output dataframe
-    output_df.rename(columns=column_rename_map, inplace=True)
-
-    # Print out INPUT / OUTPUT dataframe dimensions
-    print(f"- input_df.shape: {input_df.shape}")
-    print(f"- Number of columns in input_df: {len(input_df.columns)}")
-    print(f"- Number of rows in input_df: {len(input_df)}")
-    print(f"- output_df.shape: {output_df.shape}")
-    print(f"- Number of columns in output_df: {len(output_df.columns)}")
-    print(f"- Number of rows in output_df: {len(output_df)}")
-    
-    print(f"Number of rows in input_df: {len(input_df)} (BEFORE removing duplicate record_hash values)")
 
-    # Remove rows of the "input_df" that have a "duplicate_count" that is already in the "output_df"
-    # This is to prevent duplicate rows from being added to the output file
-    input_df = input_df[-input_df["duplicate_id"].isin(output_df["duplicate_id"])]
-    input_df = input_df[~input_df["record_hash"].isna() & ~input_df["record_hash"].isin(output_df["record_hash"])]
+    metrics.count("records_appended", commit["appended"])
+    metrics.count("commit_retries", commit["retries"])
 
-    print(f"Number of rows in input_df: {len(input_df)} (AFTER removing duplicate record_hash values)")
-    print(f"Concatenating dataframes...")
+    # summary of the invocation, logged once on every return path
+    summary = {
+        "records_in": len(input_df),
+        "appended": commit["appended"],
+        "commit_retries": commit["retries"],
+        "manifest_version": commit["version"]
+    }
 
-    # Concatenate the input file to the output file
-    output_df = wr.pandas.concat([output_df, input_df], axis=0)
-    # output_df = pd.concat([output_df, input_df], axis=0)
-    
-    print(f"FINAL OUTPUT dataframe dimensions:")
-    print(f"--> (Final) output_df.shape: {output_df.shape}")
-    print(f"--> (Final) Number of columns in output_df: {len(output_df.columns)}")
-    print(f"--> (Final) Number of rows in output_df: {len(output_df)}")
+    # Count the committed deltas into the summary tables (also catches up on deltas a failed invocation did not count)
+    try:
+        with metrics.phase("summaries"):
+            summaries = master_summaries.update_summaries(OUTPUT_S3_BUCKET, MASTER_PREFIX, commit["manifest"])
+        summary.update(summary_deltas=summaries['counted_deltas'], summaries_rebuilt=summaries['rebuilt'])
+    except Exception as e:
+        # the records are already committed, the next invocation brings the summaries up to date
+        logger.error("Exception updating the summary tables: %s", e, MASTER_PREFIX=MASTER_PREFIX)
+
+    # Nothing new to add, leave the master dataset (and the exports) untouched
+    if commit["appended"] == 0:
+        logger.summary("No new records in '%s', master dataset unchanged", INPUT_S3_URI,
+                       master_cache=master_cache.cache_stats(), **summary)
 
-    # Create the S3 URI for the output CSV and PARQUET files
-    UPDATED_S3_CSV_URI = f"s3://{OUTPUT_S3_BUCKET}/{OUTPUT_OBJECT_KEY}"
-    UPDATED_S3_PARQUET_URI = f"s3://{OUTPUT_S3_BUCKET}/{OUTPUT_OBJECT_KEY.replace('.csv', '.parquet')}"
+        return {"statusCode": 200, "body": json.dumps({"message": "No new records, master dataset unchanged"})}
 
-    print(f"Saving dataframe as CSV to {UPDATED_S3_CSV_URI}")
-    print(f"- UPDATED_S3_CSV_URI: {UPDATED_S3_CSV_URI}")
+    # Only compact (and rewrite the single file exports) once enough deltas have piled up
+    if len(commit["manifest"]["deltas"]) < master_manifest.COMPACT_EVERY_N_DELTAS:
+        logger.summary("Appended '%s' as a delta file, %s deltas in manifest (compacting at %s)", INPUT_S3_URI,
+                       len(commit['manifest']['deltas']), master_manifest.COMPACT_EVERY_N_DELTAS,
+                       master_cache=master_cache.cache_stats(), **summary)
+
+        return {"statusCode": 200, "body": json.dumps({"message": "Daily data added to the master dataset as a delta file"})}
 
-    # write the dataframe to S3 as CSV
     try:
-        # # save the dataframe as a CSV to S3
-        wr.s3.to_csv(output_df, UPDATED_S3_CSV_URI, index = False)
+        with metrics.phase("compact"):
+            output_df, master_version = master_manifest.compact(OUTPUT_S3_BUCKET, MASTER_PREFIX, commit["manifest"],
+                                                                commit["etag"])
     except Exception as e:
-        print(f"Exception saving dataframe to S3: {e}")
-        print(f"- Problem INPUT_S3_URI: {INPUT_S3_URI}")
-        print(f"- Problem OUTPUT_S3_URI: {OUTPUT_S3_URI}")
-        print(f"- Problem UPDATED_S3_CSV_URI: {UPDATED_S3_CSV_URI}")
-        print(f"-----> RAISING EXCEPTION ON CSV UPLOAD TO S3 <-----")
+        logger.error("Exception compacting the master dataset, RAISING EXCEPTION ON COMPACTION: %s", e, MASTER_PREFIX=MASTER_PREFIX)
         raise e
 
+    if output_df is None:
+        logger.summary("Appended '%s' as a delta file (another appender compacted the manifest)", INPUT_S3_URI,
+                       master_cache=master_cache.cache_stats(), **summary)
+
+        return {"statusCode": 200, "body": json.dumps({"message": "Daily data added to the master dataset as a delta file"})}
+
+    summary.update(master_rows=len(output_df), master_columns=len(output_df.columns), master_version=master_version)
+
+    logger.info("Saving dataframe as PARQUET to %s", MASTER_PARQUET_URI, master_version=master_version)
+
+    # write the single file Parquet export (skipped if an appender already exported a newer manifest version)
+    try:
+        # # save the dataframe as a parquet to S3 (typed, compressed, sorted by time)
+        with metrics.phase("write_parquet"):
+            parquet_size = master_store.write_parquet_export(output_df, MASTER_PARQUET_URI, master_version)
 
-    print(f"Converting all dataframe columns to strings...")
+        if parquet_size is not None:
+            metrics.count("parquet_bytes", parquet_size)
+        summary.update(parquet_bytes=parquet_size)
+    except Exception as e:
+        logger.error("Exception saving dataframe to S3, RAISING EXCEPTION ON PARQUET UPLOAD TO S3: %s", e,
+                     INPUT_S3_URI=INPUT_S3_URI, MASTER_PARQUET_URI=MASTER_PARQUET_URI)
+        raise e
 
-    # convert all of the dataframe columns to strings
-    output_df = output_df.astype(str)
+    if not WRITE_CSV_EXPORT:
+        logger.summary("Appended '%s' and compacted the master dataset (CSV export disabled)", INPUT_S3_URI,
+                       master_cache=master_cache.cache_stats(), **summary)
 
-    print(f"Saving dataframe as PARQUET to {UPDATED_S3_PARQUET_URI}")
-    print(f"- UPDATED_S3_PARQUET_URI: {UPDATED_S3_PARQUET_URI}")
+        return {"statusCode": 200, "body": json.dumps({"message": "Daily data added and data written as a Parquet file to S3"})}
 
-    # write the dataframe to S3 as Parquet
+    logger.info("Saving CSV export to %s", OUTPUT_S3_URI)
+
+    # write the derived CSV export to S3
     try:
-        # # save the dataframe as a parquet to S3
-        wr.s3.to_parquet(output_df, UPDATED_S3_PARQUET_URI, index = False)
+        with metrics.phase("write_csv"):
+            csv_size = master_store.write_csv_export(output_df, OUTPUT_S3_URI, master_version)
+
+        summary.update(csv_bytes=csv_size)
     except Exception as e:
-        print(f"Exception saving dataframe to S3: {e}")
-        print(f"- Problem INPUT_S3_URI: {INPUT_S3_URI}")
-        print(f"- Problem UPDATED_S3_PARQUET_URI: {UPDATED_S3_PARQUET_URI}")
-        print(f"-----> RAISING EXCEPTION ON PARQUET UPLOAD TO S3 <-----")
+        logger.error("Exception saving dataframe to S3, RAISING EXCEPTION ON CSV UPLOAD TO S3: %s", e,
+                     INPUT_S3_URI=INPUT_S3_URI, OUTPUT_S3_URI=OUTPUT_S3_URI)
         raise e
     
-    print(f"===" * 5)
+    logger.summary("Appended '%s', compacted the master dataset and wrote the CSV export", INPUT_S3_URI,
+                   master_cache=master_cache.cache_stats(), **summary)
 
-    return {"statusCode": 200, "body": json.dumps({"message": "Daily data added and data written as CSV and Parquet files to S3"})}
\ No newline at end of file
+    return {"statusCode": 200, "body": json.dumps({"message": "Daily data added and data written as CSV and Parquet files to S3"})}
@@ -0,0 +1,52 @@
+# Description: Lazily created boto3 clients shared by the MRoS lambdas. Importing boto3 and building a client
+# (loading the service model) costs ~100-300 ms, which module level "s3 = boto3.client('s3')" lines paid on every
+# cold start, also for clients an invocation never uses. A LazyClient stands in for the client at module level and
+# imports boto3 / creates the real client on its first method call (thread safe), so call sites stay unchanged:
+#   s3 = aws.LazyClient('s3')
+#   s3.get_object(Bucket=..., Key=...)
+# Usage: from mros_common import aws
+# Author: Angus Watters
+
+# general utility libraries
+import threading
+
+class LazyClient:
+    """
+    boto3 client created on first use.
+
+    Parameters:
+    service_name (str): AWS service name, e.g. "s3".
+    **client_kwargs: Keyword arguments of boto3.client() (e.g. config).
+    """
+    def __init__(self, service_name, **client_kwargs):
+        self.service_name  = service_name
+        self.client_kwargs = client_kwargs
+        self._client       = None
+        self._lock         = threading.Lock()
+
+    @property
+    def created(self):
+        """Whether the real client has been created."""
+        return self._client is not None
+
+    def get(self):
+        """The real boto3 client (created on the first call)."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+
+                    self._client = boto3.client(self.service_name, **self.client_kwargs)
+
+        return self._client
+
+    def reset(self):
+        """Drop the real client, the next method call creates a new one (e.g. after boto3.client was patched)."""
+        with self._lock:
+            self._client = None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        return f"LazyClient({self.service_name!r}, created={self.created})"
@@ -0,0 +1,69 @@
+# Description: Per-stage lineage timestamps of MRoS records. Each stage stamps the records it handles with the time
+# (UTC epoch milliseconds) it passed them on, as "ts_<stage>" fields that travel with the record (SQS message body ->
+# staging JSON -> prod CSV -> master dataset / DynamoDB item), so every record carries its own timeline next to its
+# record_hash:
+#   createdtime    the observation was submitted (Airtable record creation, already in the record)
+#   ts_enqueued    mros_airtable_to_sqs sent the record to SQS
+#   ts_staged      add_climate_data wrote the enriched record to the staging bucket (S3 event time of the file)
+#   ts_prod        mros_stage_to_prod wrote the record to a prod CSV
+#   ts_appended    mros_append_daily_data appended the record to the master dataset
+#   ts_inserted    mros_insert_into_dynamodb wrote the record to DynamoDB (DynamoDB items only)
+# The timestamps are not part of the record_hash (it is computed before ts_enqueued is added) or of the DynamoDB
+# item_hash, so a record that is sent again keeps its record_hash, and the master dataset/DynamoDB keep the timestamps
+# of its first pass. See tools/reports/latency_report.py for the latency percentiles.
+# Usage: from mros_common import lineage
+# Author: Angus Watters
+
+# general utility libraries
+import time
+from datetime import timezone
+
+ENQUEUED = "ts_enqueued"
+STAGED   = "ts_staged"
+PROD     = "ts_prod"
+APPENDED = "ts_appended"
+INSERTED = "ts_inserted"
+
+# lineage timestamp columns, in pipeline order
+COLUMNS = [ENQUEUED, STAGED, PROD, APPENDED, INSERTED]
+
+# columns stored in the master dataset (DynamoDB inserts happen alongside the append, not before it)
+MASTER_COLUMNS = [ENQUEUED, STAGED, PROD, APPENDED]
+
+def now_ms():
+    """Current time as UTC epoch milliseconds."""
+    return int(time.time() * 1000)
+
+def datetime_to_ms(dt):
+    """
+    UTC epoch milliseconds of a datetime (naive datetimes are taken as UTC, like the S3 event times).
+
+    Parameters:
+    dt (datetime): Date and time.
+
+    Returns:
+    int: Epoch milliseconds.
+    """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return int(dt.timestamp() * 1000)
+
+def stamp(records, column, ts_ms=None):
+    """
+    Set a lineage timestamp on records (dicts, in place).
+
+    Parameters:
+    records (list): Records.
+    column (str): Lineage column, e.g. lineage.PROD.
+    ts_ms (int): Timestamp (defaults to now).
+
+    Returns:
+    list: The records.
+    """
+    ts_ms = now_ms() if ts_ms is None else ts_ms
+
+    for record in records:
+        record[column] = ts_ms
+
+    return records
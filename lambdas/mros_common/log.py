@@ -0,0 +1,127 @@
+# Description: Leveled, lazily formatted, structured logging shared by the MRoS lambdas.
+#   - one JSON line per message ({"level", "logger", "message", ...fields}), printed to stdout like the rest of
+#     the lambda output (CloudWatch Logs)
+#   - messages below LOG_LEVEL cost a level check: "%s" arguments are only formatted (and callables only called)
+#     when the message is printed, e.g. log.debug("event: %s", event) or log.debug("items: %s", lambda: dump(items))
+#   - formatted arguments and string fields are truncated to LOG_MAX_CHARS characters
+#   - per-record detail is sampled: log.sample() is true for 1 in LOG_SAMPLE_EVERY records at INFO (every record
+#     at DEBUG), the handlers only log the detail of sampled records
+#   - errors (log.error()) and summaries (log.summary()) are always printed, whatever the level
+# Usage: from mros_common import log
+#        logger = log.get_logger("mros_stage_to_prod")
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import json
+
+# Environment variables
+# Lowest level printed (DEBUG, INFO, WARNING or ERROR)
+LOG_LEVEL        = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Log the per-record detail of 1 in LOG_SAMPLE_EVERY records (at INFO level, every record is logged at DEBUG)
+LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', '100'))
+
+# Max characters of a formatted argument or string field (longer values are cut and marked as truncated)
+LOG_MAX_CHARS    = int(os.environ.get('LOG_MAX_CHARS', '1000'))
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+def truncate(text, max_chars=None):
+    """Cut a string to max_chars characters (defaults to LOG_MAX_CHARS), noting how much was cut."""
+    max_chars = LOG_MAX_CHARS if max_chars is None else max_chars
+
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text
+
+    return f"{text[:max_chars]}...[truncated {len(text) - max_chars} chars]"
+
+class Logger:
+    """
+    Logger of one lambda (or module).
+
+    Parameters:
+    name (str): Logger name (the "logger" field of each line).
+    level (str): Lowest level printed (defaults to LOG_LEVEL).
+    sample_every (int): Per-record detail sampling rate (defaults to LOG_SAMPLE_EVERY).
+    max_chars (int): Truncation length (defaults to LOG_MAX_CHARS).
+    """
+    def __init__(self, name, level=None, sample_every=None, max_chars=None):
+        self.name         = name
+        self.level        = LEVELS.get((level or LOG_LEVEL).upper(), LEVELS["INFO"])
+        self.sample_every = max(1, LOG_SAMPLE_EVERY if sample_every is None else sample_every)
+        self.max_chars    = LOG_MAX_CHARS if max_chars is None else max_chars
+        self.samples      = 0
+
+    def enabled(self, level):
+        """Check if messages of a level are printed."""
+        return LEVELS[level] >= self.level
+
+    def _arg(self, value):
+        if callable(value):
+            value = value()
+
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+
+        return truncate(str(value), self.max_chars)
+
+    def _emit(self, level, message, args, fields):
+        record = {"level": level, "logger": self.name}
+
+        try:
+            record["message"] = message % tuple(self._arg(arg) for arg in args) if args else message
+        except (TypeError, ValueError):
+            record["message"] = " ".join([message] + [str(self._arg(arg)) for arg in args])
+
+        for key, value in fields.items():
+            record[key] = self._arg(value)
+
+        print(json.dumps(record, default=str))
+
+    def debug(self, message, *args, **fields):
+        if self.level <= LEVELS["DEBUG"]:
+            self._emit("DEBUG", message, args, fields)
+
+    def info(self, message, *args, **fields):
+        if self.level <= LEVELS["INFO"]:
+            self._emit("INFO", message, args, fields)
+
+    def warning(self, message, *args, **fields):
+        if self.level <= LEVELS["WARNING"]:
+            self._emit("WARNING", message, args, fields)
+
+    def error(self, message, *args, **fields):
+        """Always printed."""
+        self._emit("ERROR", message, args, fields)
+
+    def summary(self, message, *args, **fields):
+        """Per-invocation summary, always printed."""
+        self._emit("SUMMARY", message, args, fields)
+
+    def sample(self):
+        """
+        Decide if the detail of the next record is logged: always at DEBUG, for 1 in sample_every records at INFO
+        (starting with the first), never above INFO.
+
+        Returns:
+        bool: Whether to log the record's detail.
+        """
+        if self.level <= LEVELS["DEBUG"]:
+            return True
+
+        if self.level > LEVELS["INFO"]:
+            return False
+
+        self.samples += 1
+
+        return (self.samples - 1) % self.sample_every == 0
+
+_loggers = {}
+
+def get_logger(name):
+    """Get (or create) the logger of a name."""
+    if name not in _loggers:
+        _loggers[name] = Logger(name)
+
+    return _loggers[name]
@@ -0,0 +1,186 @@
+# Description: Per-invocation instrumentation shared by the MRoS lambdas: phase timers, counters and one
+# CloudWatch Embedded Metric Format (EMF) log line per invocation. CloudWatch turns the EMF line into metrics
+# (dimension FunctionName) without any API calls, so the instrumentation can stay on in production.
+#   - handlers are wrapped with @metrics.instrumented("<function name>"), which times the invocation, counts errors
+#     and cold starts and prints the EMF line when the invocation ends (also when it raises)
+#   - code anywhere in the lambda times phases with "with metrics.phase('s3_get'):" (milliseconds, summed over
+#     repeated phases) and counts things with metrics.count('records', n) (names ending in "_bytes" are bytes)
+# Timers and counters are thread safe. Outside of an instrumented handler (tests, benchmarks) they go to a
+# detached collector that is never printed.
+# The shared package is added to every lambda zip by sh/package_lambdas.sh.
+# Usage: from mros_common import metrics
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import json
+import time
+import resource
+import threading
+import functools
+
+# Environment variables
+# Print the EMF metrics line of each invocation (set to "false" to turn it off)
+METRICS_ENABLED   = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# CloudWatch namespace of the metrics
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'MRoS')
+
+# max number of metrics in one EMF directive (CloudWatch limit)
+MAX_EMF_METRICS = 100
+
+class Metrics:
+    """
+    Timers and counters of one invocation.
+
+    Parameters:
+    function_name (str): Lambda function name (the FunctionName dimension of the metrics).
+    """
+    def __init__(self, function_name=None):
+        self.function_name = function_name
+        self.timings       = {}
+        self.counters      = {}
+        self.properties    = {}
+        self.lock          = threading.Lock()
+
+    def phase(self, name):
+        """Context manager adding the time spent in the block to the "<name>_ms" timer."""
+        return _Phase(self, name)
+
+    def add_time(self, name, ms):
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0.0) + ms
+
+    def count(self, name, value=1):
+        """Add value to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_property(self, name, value):
+        """Attach a (non metric) value to the EMF line, e.g. a request id."""
+        self.properties[name] = value
+
+    def emf_record(self):
+        """
+        The invocation's metrics as a CloudWatch Embedded Metric Format document.
+
+        Returns:
+        dict: EMF document (print it as a single JSON line).
+        """
+        values = {f"{name}_ms": round(ms, 3) for name, ms in self.timings.items()}
+        values.update(self.counters)
+
+        definitions = [{"Name": name, "Unit": _unit(name)} for name in values]
+
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [["FunctionName"]],
+                        "Metrics": definitions[i:i + MAX_EMF_METRICS]
+                    }
+                    for i in range(0, len(definitions), MAX_EMF_METRICS)
+                ]
+            },
+            "FunctionName": self.function_name or "unknown"
+        }
+
+        record.update(self.properties)
+        record.update(values)
+
+        return record
+
+    def flush(self):
+        """Print the EMF line (unless METRICS_ENABLED is "false")."""
+        if METRICS_ENABLED:
+            print(json.dumps(self.emf_record(), default=str))
+
+class _Phase:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name    = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.add_time(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+def _unit(name):
+    if name.endswith("_ms"):
+        return "Milliseconds"
+
+    if name.endswith("_bytes"):
+        return "Bytes"
+
+    return "Count"
+
+def max_rss_bytes():
+    """Peak resident set size of the process (Linux reports ru_maxrss in KB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# collector of the running invocation (a detached one outside of instrumented handlers)
+_current    = Metrics()
+_cold_start = True
+
+def current():
+    """The Metrics of the running invocation."""
+    return _current
+
+def phase(name):
+    """Time a block into the "<name>_ms" timer of the running invocation (see Metrics.phase())."""
+    return _Phase(_current, name)
+
+def count(name, value=1):
+    """Add value to a counter of the running invocation."""
+    _current.count(name, value)
+
+def set_property(name, value):
+    """Attach a (non metric) value to the running invocation's EMF line."""
+    _current.set_property(name, value)
+
+def instrumented(function_name):
+    """
+    Decorator for a lambda handler: collects the timers and counters of each invocation and prints them as an EMF
+    line when it ends. Adds the "duration_ms" timer, the "errors", "cold_start" and "max_rss_bytes" metrics and the
+    request id.
+
+    Parameters:
+    function_name (str): Lambda function name (the FunctionName dimension).
+
+    Returns:
+    function: Decorator.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _current, _cold_start
+
+            invocation = Metrics(function_name)
+            invocation.count("cold_start", int(_cold_start))
+            invocation.count("errors", 0)
+            invocation.set_property("request_id", getattr(context, "aws_request_id", None))
+
+            _current, _cold_start = invocation, False
+
+            try:
+                with invocation.phase("duration"):
+                    return handler(event, context)
+            except Exception:
+                invocation.count("errors")
+                raise
+            finally:
+                invocation.count("max_rss_bytes", max_rss_bytes())
+                invocation.flush()
+
+                _current = Metrics()
+
+        return wrapper
+
+    return decorator
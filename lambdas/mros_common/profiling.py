@@ -0,0 +1,220 @@
+# Description: Opt-in CPU (cProfile) and memory (tracemalloc) profiling of single lambda invocations.
+# Handlers are wrapped with @profiling.profiled("<function name>"). Profiling is off unless it is switched on:
+#   - for every invocation with the PROFILE_INVOCATIONS environment variable ("cpu", "memory" or "cpu,memory"/"true")
+#   - for one invocation with a "profile" key in the event (same values, e.g. {"profile": "memory", ...} in a test
+#     event from the console)
+# A profiled invocation writes to PROFILE_DIR (/tmp):
+#   - <function>_<request id>.prof   cProfile stats (open with pstats or snakeviz)
+#   - <function>_<request id>.txt    top functions by cumulative time, top allocation sites, traced and RSS peaks
+# and uploads both files under PROFILE_S3_URI when it is set. When profiling is off the wrapper only checks the
+# event for the flag.
+# NOTE: cProfile only profiles the thread that runs the handler. The work of the batch_writer worker threads (S3/DynamoDB
+# writes) and of the csv_stream prefetch thread is not in the CPU profile, the handler thread's time waiting on them is.
+# tracemalloc traces the allocations of every thread.
+# NOTE: the RSS peak is ru_maxrss, the peak of the whole process since the container started (warm containers keep it
+# across invocations). The report shows it as the process peak, plus how much this invocation raised it (0 when an
+# earlier invocation already reached a higher peak).
+# Usage: from mros_common import profiling
+# Author: Angus Watters
+
+# general utility libraries
+import io
+import os
+import time
+import pstats
+import cProfile
+import functools
+import tracemalloc
+
+# per-invocation counters (CloudWatch EMF) and peak RSS, leveled logging
+from mros_common import metrics
+from mros_common import log
+
+# Environment variables
+# Profile every invocation ("cpu", "memory", "cpu,memory" or "true" for both, empty/unset for off)
+PROFILE_INVOCATIONS = os.environ.get('PROFILE_INVOCATIONS', '')
+
+# Local directory of the profile files (Lambda containers can only write to /tmp)
+PROFILE_DIR         = os.environ.get('PROFILE_DIR', '/tmp/mros_profiles')
+
+# Optional S3 URI prefix the profile files are uploaded to (e.g. "s3://my-bucket/profiles")
+PROFILE_S3_URI      = os.environ.get('PROFILE_S3_URI')
+
+# Number of functions/allocation sites in the text report
+PROFILE_TOP_N       = int(os.environ.get('PROFILE_TOP_N', '40'))
+
+# Number of stack frames tracemalloc keeps per allocation (more frames cost more memory and time)
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', '10'))
+
+# event key that switches profiling on for one invocation
+EVENT_FLAG = "profile"
+
+logger = log.get_logger("profiling")
+
+def parse_modes(value):
+    """
+    Profiling modes of a PROFILE_INVOCATIONS / event flag value.
+
+    Returns:
+    set: Subset of {"cpu", "memory"} (empty when profiling is off).
+    """
+    if value is True:
+        return {"cpu", "memory"}
+
+    if not value:
+        return set()
+
+    modes = {mode.strip().lower() for mode in str(value).split(",")}
+
+    if modes & {"true", "1", "all"}:
+        return {"cpu", "memory"}
+
+    return modes & {"cpu", "memory"}
+
+# modes switched on for every invocation
+DEFAULT_MODES = parse_modes(PROFILE_INVOCATIONS)
+
+def invocation_modes(event):
+    """Profiling modes of an invocation (the event flag overrides PROFILE_INVOCATIONS)."""
+    if isinstance(event, dict) and EVENT_FLAG in event:
+        return parse_modes(event[EVENT_FLAG])
+
+    return DEFAULT_MODES
+
+def cpu_report(profiler, top_n):
+    """Top top_n functions by cumulative time of a cProfile.Profile, as text."""
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(top_n)
+
+    return out.getvalue()
+
+def memory_report(snapshot, top_n):
+    """Top top_n allocation sites (by size) of a tracemalloc snapshot, as text."""
+    lines = [f"Top {top_n} allocation sites (size of the blocks still allocated at the end of the invocation):"]
+
+    for i, stat in enumerate(snapshot.statistics("lineno")[:top_n], start=1):
+        frame = stat.traceback[0]
+        lines.append(f"{i:>3}. {frame.filename}:{frame.lineno}: {stat.size / 1024:.1f} KiB in {stat.count} blocks")
+
+    return "\n".join(lines)
+
+def upload(paths):
+    """Upload the profile files under PROFILE_S3_URI (best effort, a failed upload is only logged)."""
+    import boto3
+
+    bucket, _, prefix = PROFILE_S3_URI.replace("s3://", "").partition("/")
+    s3                = boto3.client("s3")
+
+    for path in paths:
+        key = f"{prefix.rstrip('/')}/{os.path.basename(path)}".lstrip("/")
+
+        try:
+            with open(path, "rb") as f:
+                s3.put_object(Bucket=bucket, Key=key, Body=f.read())
+        except Exception as e:
+            logger.error("Exception uploading profile '%s' to s3://%s/%s: %s", path, bucket, key, e)
+
+def profiled(function_name):
+    """
+    Decorator for a lambda handler: profiles the invocations that have profiling switched on
+    (see PROFILE_INVOCATIONS and the "profile" event flag).
+
+    Parameters:
+    function_name (str): Lambda function name (prefix of the profile file names).
+
+    Returns:
+    function: Decorator.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            modes = invocation_modes(event)
+
+            if not modes:
+                return handler(event, context)
+
+            profiler = cProfile.Profile() if "cpu" in modes else None
+
+            if "memory" in modes:
+                tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+            # process RSS peak before the invocation, to tell how much this invocation raised it
+            rss_start = metrics.max_rss_bytes()
+
+            if profiler:
+                profiler.enable()
+
+            start = time.perf_counter()
+
+            try:
+                return handler(event, context)
+            finally:
+                seconds = time.perf_counter() - start
+
+                if profiler:
+                    profiler.disable()
+
+                # a failed profile write must not fail (or mask the exception of) the invocation
+                try:
+                    write_profile(function_name, context, modes, profiler, seconds, rss_start)
+                except Exception as e:
+                    logger.error("Exception writing the invocation profile: %s", e)
+                finally:
+                    if tracemalloc.is_tracing():
+                        tracemalloc.stop()
+
+        return wrapper
+
+    return decorator
+
+def write_profile(function_name, context, modes, profiler, seconds, rss_start=0):
+    """
+    Write (and optionally upload) the profile files of an invocation and stop tracemalloc.
+
+    Parameters:
+    function_name (str): Lambda function name (prefix of the profile file names).
+    context (LambdaContext): Lambda context (the request id names the files).
+    modes (set): Profiling modes of the invocation.
+    profiler (cProfile.Profile): Profiler of the handler thread, or None when the CPU is not profiled.
+    seconds (float): Duration of the invocation.
+    rss_start (int): Process RSS peak (metrics.max_rss_bytes()) before the invocation.
+    """
+    request_id = getattr(context, "aws_request_id", None) or str(int(time.time() * 1000))
+    base_path  = os.path.join(PROFILE_DIR, f"{function_name}_{request_id}")
+    report     = [f"{function_name} invocation {request_id}: {seconds:.3f} s, profiled: {', '.join(sorted(modes))}"]
+    paths      = []
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    if tracemalloc.is_tracing():
+        snapshot      = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        metrics.count("profile_traced_peak_bytes", peak)
+
+        report.append(f"tracemalloc peak: {peak / 1024 ** 2:.1f} MiB (still allocated at the end: {current / 1024 ** 2:.1f} MiB)")
+        report.append(memory_report(snapshot, PROFILE_TOP_N))
+
+    # ru_maxrss is the peak of the process since the container started, not of this invocation
+    rss_bytes  = metrics.max_rss_bytes()
+    rss_raised = max(rss_bytes - rss_start, 0)
+    report.insert(1, f"process peak RSS (since the container started): {rss_bytes / 1024 ** 2:.1f} MiB, "
+                     f"raised by this invocation: {rss_raised / 1024 ** 2:.1f} MiB")
+
+    if profiler:
+        profiler.dump_stats(f"{base_path}.prof")
+        paths.append(f"{base_path}.prof")
+        report.append("CPU profile of the handler thread only (batch_writer and csv_stream threads are not included):\n" +
+                      cpu_report(profiler, PROFILE_TOP_N))
+
+    with open(f"{base_path}.txt", "w") as f:
+        f.write("\n\n".join(report))
+
+    paths.append(f"{base_path}.txt")
+
+    if PROFILE_S3_URI:
+        upload(paths)
+
+    logger.summary("Wrote invocation profile", files=paths, uploaded_to=PROFILE_S3_URI,
+                   process_peak_rss_bytes=rss_bytes, rss_raised_bytes=rss_raised)
@@ -0,0 +1,186 @@
+# Description: Parallel DynamoDB BatchWriteItem writer for mros_insert_into_dynamodb.
+# Items are split into 25 item BatchWriteItem requests that are sent from a bounded pool of worker threads.
+# UnprocessedItems and throttling errors are retried with jittered exponential backoff, and all workers share
+# a rate limiter that halves the write rate when DynamoDB throttles and slowly raises it again after successful writes.
+# Each call reports items/s, requests, retries, throttles and consumed write capacity units (WCU).
+# Usage: from mros_insert_into_dynamodb import batch_writer
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# AWS SDK for Python (Boto3) client config and exceptions, lazily created boto3 clients, leveled, structured logging
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from mros_common import aws
+from mros_common import log
+
+# Environment variables
+# Number of worker threads sending BatchWriteItem requests
+MAX_WORKERS       = int(os.environ.get('DYNAMODB_WRITE_WORKERS', '8'))
+
+# Max number of retries of a single request (UnprocessedItems or throttling errors)
+MAX_RETRIES       = int(os.environ.get('DYNAMODB_WRITE_RETRIES', '10'))
+
+# Starting write rate (items/second) of the rate limiter, the rate adapts to throttling from there
+INITIAL_RATE      = float(os.environ.get('DYNAMODB_WRITE_RATE', '1000'))
+
+# max number of items in a single BatchWriteItem request
+BATCH_WRITE_SIZE = 25
+
+# lower/upper bounds of the adaptive write rate (items/second)
+MIN_RATE = 25.0
+MAX_RATE = 20000.0
+
+# rate limiter: multiply the rate by RATE_DECREASE on throttling, add RATE_INCREASE after each successful request
+RATE_DECREASE = 0.5
+RATE_INCREASE = 25.0
+
+# base/max sleep (seconds) between retries (full jitter)
+RETRY_BASE_SLEEP = 0.05
+RETRY_MAX_SLEEP  = 5.0
+
+# DynamoDB error codes that mean "slow down and retry"
+THROTTLE_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "InternalServerError",
+}
+
+# DynamoDB client (boto3 clients are thread safe, created on first use), one connection per worker thread
+dynamodb = aws.LazyClient('dynamodb', config=Config(max_pool_connections=max(10, MAX_WORKERS), retries={"max_attempts": 1}))
+
+logger = log.get_logger("batch_writer")
+
+class RateLimiter:
+    """
+    Token bucket shared by all worker threads, with an additive increase / multiplicative decrease write rate.
+    """
+    def __init__(self, rate):
+        self.rate   = rate
+        self.tokens = rate
+        self.last   = time.monotonic()
+        self.lock   = threading.Lock()
+
+    def acquire(self, n):
+        """Block until n items can be written at the current rate."""
+        while True:
+            with self.lock:
+                now         = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last   = now
+
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+
+                wait = (n - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def throttled(self):
+        """Cut the write rate after DynamoDB throttled a request."""
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate * RATE_DECREASE)
+
+    def succeeded(self):
+        """Raise the write rate a little after a request was fully processed."""
+        with self.lock:
+            self.rate = min(MAX_RATE, self.rate + RATE_INCREASE)
+
+def backoff(attempt):
+    """Sleep for a jittered, exponentially increasing amount of time."""
+    time.sleep(random.uniform(0, min(RETRY_MAX_SLEEP, RETRY_BASE_SLEEP * (2 ** attempt))))
+
+def _write_batch(table_name, items, limiter):
+    """
+    Write up to 25 items with BatchWriteItem, retrying UnprocessedItems and throttling errors.
+
+    Returns:
+    dict: Stats of this batch ("requests", "retries", "throttles", "wcu").
+    """
+    stats    = {"requests": 0, "retries": 0, "throttles": 0, "wcu": 0.0}
+    requests = [{"PutRequest": {"Item": item}} for item in items]
+
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire(len(requests))
+
+        try:
+            response = dynamodb.batch_write_item(
+                RequestItems           = {table_name: requests},
+                ReturnConsumedCapacity = "TOTAL"
+                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in THROTTLE_ERROR_CODES or attempt == MAX_RETRIES:
+                raise
+
+            stats["requests"]  += 1
+            stats["retries"]   += 1
+            stats["throttles"] += 1
+
+            limiter.throttled()
+            backoff(attempt)
+            continue
+
+        stats["requests"] += 1
+        stats["wcu"]      += sum(capacity.get("CapacityUnits", 0) for capacity in response.get("ConsumedCapacity", []))
+
+        requests = response.get("UnprocessedItems", {}).get(table_name, [])
+
+        if not requests:
+            limiter.succeeded()
+            return stats
+
+        # DynamoDB did not process some of the items (throttling), slow down and resend them
+        stats["retries"]   += 1
+        stats["throttles"] += 1
+
+        limiter.throttled()
+        backoff(attempt)
+
+    raise RuntimeError(f"{len(requests)} items were still unprocessed after {MAX_RETRIES} retries")
+
+def write_items(items, table_name, max_workers=None):
+    """
+    Write DynamoDB items in parallel 25 item BatchWriteItem requests.
+
+    Parameters:
+    items (list): DynamoDB items in low level AttributeValue format (see dynamodb_items.dataframe_to_items()).
+    table_name (str): DynamoDB table name.
+    max_workers (int): Number of worker threads (defaults to DYNAMODB_WRITE_WORKERS).
+
+    Returns:
+    dict: Write stats ("items", "requests", "retries", "throttles", "wcu", "seconds", "items_per_second", "final_rate").
+    """
+    max_workers = max_workers or MAX_WORKERS
+    limiter     = RateLimiter(INITIAL_RATE)
+    start       = time.monotonic()
+
+    stats = {"items": len(items), "requests": 0, "retries": 0, "throttles": 0, "wcu": 0.0}
+
+    batches = [items[i:i + BATCH_WRITE_SIZE] for i in range(0, len(items), BATCH_WRITE_SIZE)]
+
+    logger.debug("Writing %s items to '%s' in %s BatchWriteItem requests", len(items), table_name, len(batches),
+                 workers=max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_write_batch, table_name, batch, limiter) for batch in batches]
+
+        for future in as_completed(futures):
+            for key, value in future.result().items():
+                stats[key] += value
+
+    seconds = time.monotonic() - start
+
+    stats.update(
+        seconds          = round(seconds, 3),
+        items_per_second = round(len(items) / seconds, 1) if seconds > 0 else None,
+        final_rate       = round(limiter.rate, 1)
+        )
+
+    return stats
@@ -0,0 +1,194 @@
+# Description: Chunked, checkpointed reading of the CSV files that mros_insert_into_dynamodb writes to DynamoDB.
+# The CSV is read from S3 in fixed size row chunks (the next chunk downloads in a background thread while the current
+# one is written), so memory stays flat regardless of the file size. After each chunk, the number of rows written is
+# saved to a checkpoint object in S3, keyed by the CSV object key and ETag, so a retried invocation resumes after
+# the last written chunk instead of starting over. Checkpoints are JSON files (the prod bucket only notifies on ".csv").
+#
+# S3 layout:
+#   s3://<bucket>/_checkpoints/mros_insert_into_dynamodb/<csv object key>.json
+#
+# Usage: from mros_insert_into_dynamodb import csv_stream
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import json
+import queue
+import threading
+from datetime import datetime, timezone
+
+# pandas reads the CSV stream directly (awswrangler, and the pyarrow it imports, added ~1 s to cold starts)
+import pandas as pd
+
+# AWS SDK for Python (Boto3) exceptions, lazily created boto3 clients, leveled, structured logging
+from botocore.exceptions import ClientError
+from mros_common import aws
+from mros_common import log
+
+# Environment variables
+# Number of CSV rows read, serialized and written at a time
+CHUNK_ROWS = int(os.environ.get('DYNAMODB_CHUNK_ROWS', '5000'))
+
+CHECKPOINT_PREFIX = "_checkpoints/mros_insert_into_dynamodb"
+
+# how often (seconds) the prefetch reader thread checks whether the caller stopped
+PREFETCH_POLL_S = 0.1
+
+# columns always read as strings (DynamoDB key/index attributes must keep their "S" type in every chunk). The prod CSVs
+# carry the phase as "name" (it is only renamed to "phase" in the master dataset), both are listed
+STRING_COLUMNS = ["id", "user", "comment", "duplicate_id", "record_hash", "name", "phase", "state", "geohash5", "geohash12", "date_key"]
+
+# S3 client (created on first use)
+s3 = aws.LazyClient('s3')
+
+logger = log.get_logger("csv_stream")
+
+def checkpoint_key(object_key):
+    """Get the S3 key of the checkpoint of a CSV object."""
+    return f"{CHECKPOINT_PREFIX}/{object_key}.json"
+
+def object_etag(bucket, object_key):
+    """Get the ETag of an S3 object."""
+    return s3.head_object(Bucket=bucket, Key=object_key)["ETag"]
+
+def read_checkpoint(bucket, object_key, etag):
+    """
+    Read the checkpoint of a CSV object.
+
+    Parameters:
+    bucket (str): S3 bucket name of the CSV object (the checkpoint is stored in the same bucket).
+    object_key (str): S3 key of the CSV object.
+    etag (str): Current ETag of the CSV object, checkpoints of an older version of the object are ignored.
+
+    Returns:
+    dict: Checkpoint ("rows_done", "complete"), starting from row 0 if there is no (matching) checkpoint.
+    """
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=checkpoint_key(object_key))
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return {"rows_done": 0, "complete": False}
+        raise
+
+    checkpoint = json.load(obj["Body"])
+
+    if checkpoint.get("etag") != etag:
+        logger.info("Checkpoint is for an older version of '%s', starting from row 0", object_key)
+        return {"rows_done": 0, "complete": False}
+
+    return checkpoint
+
+def write_checkpoint(bucket, object_key, etag, rows_done, complete=False):
+    """Save the number of rows of a CSV object that were written to DynamoDB."""
+    checkpoint = {
+        "etag": etag,
+        "rows_done": rows_done,
+        "complete": complete,
+        "updated_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        }
+
+    s3.put_object(
+        Bucket      = bucket,
+        Key         = checkpoint_key(object_key),
+        Body        = json.dumps(checkpoint).encode("utf-8"),
+        ContentType = "application/json"
+        )
+
+    return checkpoint
+
+def read_csv_chunks(s3_uri, chunk_rows=None, skip_rows=0):
+    """
+    Read a CSV file from S3 in chunks of rows.
+
+    Parameters:
+    s3_uri (str): S3 URI of the CSV file.
+    chunk_rows (int): Number of rows per chunk (defaults to DYNAMODB_CHUNK_ROWS).
+    skip_rows (int): Number of data rows (after the header) to skip, e.g. rows written before a checkpoint.
+
+    Returns:
+    iterator: pandas.DataFrame chunks (closing it closes the S3 body stream).
+    """
+    chunk_rows = chunk_rows or CHUNK_ROWS
+
+    bucket, _, object_key = s3_uri.replace("s3://", "").partition("/")
+
+    # the object body is streamed, only the rows of the current chunk (and the parser's buffer) are in memory
+    body = s3.get_object(Bucket=bucket, Key=object_key)["Body"]
+
+    reader = pd.read_csv(
+        body,
+        chunksize = chunk_rows,
+        skiprows  = range(1, skip_rows + 1) if skip_rows else None,
+        dtype     = {col: "string" for col in STRING_COLUMNS}
+        )
+
+    return _close_after(reader, body)
+
+def _close_after(reader, body):
+    """Chunks of a read_csv reader, closing the reader and the S3 body stream when done or closed early."""
+    try:
+        yield from reader
+    finally:
+        reader.close()
+        body.close()
+
+def prefetch(chunks):
+    """
+    Read the next chunk in a background thread while the caller works on the current one.
+    When the caller stops early (an error, or the stop before the Lambda timeout), the reader thread is stopped and
+    the chunk iterator closed, so a warm container does not keep a parsed chunk and the open S3 body stream.
+
+    Parameters:
+    chunks (iterator): Chunk iterator (see read_csv_chunks()).
+
+    Returns:
+    iterator: The same chunks, in order. Errors raised while reading are raised in the caller.
+    """
+    buffer = queue.Queue(maxsize=1)
+    done   = object()
+    stop   = threading.Event()
+
+    def put(item):
+        """Hand an item to the caller, gives up (returns False) once the caller stopped."""
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=PREFETCH_POLL_S)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        finally:
+            # closes the CSV reader and the S3 body stream (the iterator is closed by the thread that runs it)
+            if hasattr(chunks, "close"):
+                chunks.close()
+        put(done)
+
+    threading.Thread(target=reader, daemon=True).start()
+
+    try:
+        while True:
+            chunk = buffer.get()
+
+            if chunk is done:
+                return
+
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            yield chunk
+    finally:
+        # a reader thread that is still parsing a chunk stops at its next put(), a chunk it already handed over is
+        # dropped here
+        stop.set()
+
+        while not buffer.empty():
+            buffer.get_nowait()
@@ -0,0 +1,104 @@
+# Description: Convert a pandas dataframe into DynamoDB items (low level AttributeValue format, e.g. {"N": "1.5"})
+# in one pass over each column. Each column gets a type plan ("N", "S" or "BOOL") from its dtype, numbers are written
+# with the shortest string that round trips the float64 value (whole numbers without a trailing ".0"),
+# and missing values (NaN, None, inf) are left out of the item instead of being written as zeros.
+# Usage: from mros_insert_into_dynamodb import dynamodb_items
+# Author: Angus Watters
+
+# general utility libraries
+import numpy as np
+import pandas as pd
+
+# largest integer a float64 holds exactly (larger whole numbers keep their float formatting)
+MAX_EXACT_INT = 2 ** 53
+
+def column_plan(series):
+    """
+    Get the DynamoDB attribute type used for a column.
+
+    Parameters:
+    series (pandas.Series): Column values.
+
+    Returns:
+    str: "N" (numbers), "BOOL" (booleans) or "S" (everything else, written as strings).
+    """
+    if pd.api.types.is_bool_dtype(series):
+        return "BOOL"
+
+    if pd.api.types.is_numeric_dtype(series):
+        return "N"
+
+    return "S"
+
+def format_numbers(values):
+    """
+    Format finite float64 values as DynamoDB number strings.
+    Columns where every value is a whole number (e.g. counts read as floats because of missing values)
+    are written as integers, other columns use the shortest string that round trips the float64 value
+    (the same digits as Decimal(str(x))).
+
+    Parameters:
+    values (numpy.ndarray): Finite float64 values.
+
+    Returns:
+    list: Number strings.
+    """
+    if len(values) and np.all(values % 1 == 0) and np.all(np.abs(values) < MAX_EXACT_INT):
+        return list(map(str, values.astype(np.int64).tolist()))
+
+    # repr() of a Python float is the shortest round trip string (faster than numpy's astype(str))
+    return list(map(repr, values.tolist()))
+
+def serialize_column(series, plan=None):
+    """
+    Convert a column into DynamoDB attribute values.
+
+    Parameters:
+    series (pandas.Series): Column values.
+    plan (str): Attribute type (see column_plan()), derived from the dtype if None.
+
+    Returns:
+    numpy.ndarray: Object array with an attribute value dict per row, or None where the value is missing.
+    """
+    plan = plan or column_plan(series)
+
+    out = np.full(len(series), None, dtype=object)
+
+    if plan == "N":
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+        valid  = np.isfinite(values)
+        out[valid] = [{"N": text} for text in format_numbers(values[valid])]
+
+    elif plan == "BOOL":
+        valid = series.notna().to_numpy()
+        out[valid] = [{"BOOL": bool(value)} for value in series[valid].tolist()]
+
+    else:
+        if pd.api.types.is_datetime64_any_dtype(series):
+            series = series.dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+        text  = series.astype("string")
+        valid = (text.notna() & (text != "")).to_numpy()
+        out[valid] = [{"S": value} for value in text[valid].tolist()]
+
+    return out
+
+def dataframe_to_items(df, plans=None):
+    """
+    Convert a dataframe into a list of DynamoDB items (one per row).
+
+    Parameters:
+    df (pandas.DataFrame): Records to write.
+    plans (dict): Optional column -> attribute type overrides (see column_plan()).
+
+    Returns:
+    list: DynamoDB items in low level AttributeValue format, without attributes for missing values.
+    """
+    plans   = plans or {}
+    names   = list(df.columns)
+    columns = [serialize_column(df[col], plans.get(col)) for col in names]
+
+    return [
+        {name: value for name, value in zip(names, row) if value is not None}
+        for row in zip(*columns)
+        ]
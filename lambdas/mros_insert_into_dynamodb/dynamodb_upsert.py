@@ -0,0 +1,200 @@
+# Description: Write-if-changed upserts for mros_insert_into_dynamodb.
+# Each item gets an "item_hash" attribute (a hash of all its other attributes). Before writing, the stored item_hash
+# of every record_hash is looked up with batched BatchGetItem requests, and only items that are new or have changed
+# are written. The lookup is projected to the key and the item_hash, which only cuts the bytes transferred: a read is
+# charged by the size of the whole stored item, i.e. 0.5 RCU (eventually consistent) per item of up to 4 KB, against
+# 1 WCU per 1 KB for a write. Reprocessing or redelivering a file then costs about half the capacity of a full rewrite
+# and leaves the stored items (and their lineage timestamps) as they are.
+# The hash is computed from normalized values, so it does not depend on the file a record was read from: numbers
+# are compared by value ("3", "3.0" and "3E+0" hash the same) and a value read as a number in one file and as a
+# string in another (read_csv infers the column types per file) hashes the same.
+# Usage: from mros_insert_into_dynamodb import dynamodb_upsert
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import re
+import json
+import hashlib
+from decimal import Decimal, InvalidOperation
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+# parallel BatchWriteItem writer (shares its DynamoDB client, worker count and retry settings)
+from mros_insert_into_dynamodb import batch_writer
+
+# per-stage lineage timestamps (not part of the item contents)
+from mros_common import lineage
+
+# Environment variables
+# Only write items that are new or changed (set to "false" to always write every item)
+WRITE_IF_CHANGED = os.environ.get('DYNAMODB_WRITE_IF_CHANGED', 'true').lower() == 'true'
+
+# partition key of the DynamoDB table and the attribute holding the hash of the item contents
+KEY_ATTRIBUTE       = "record_hash"
+ITEM_HASH_ATTRIBUTE = "item_hash"
+
+# attributes left out of the item_hash: a record sent through the pipeline again only differs in its lineage
+# timestamps, and the stored item should keep the timestamps of its first pass
+UNHASHED_ATTRIBUTES = {ITEM_HASH_ATTRIBUTE, *lineage.COLUMNS}
+
+# max number of keys in a single BatchGetItem request
+BATCH_GET_SIZE = 100
+
+# string values that are written as numbers when their column is read as numeric
+NUMBER_PATTERN = re.compile(r"[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?")
+
+def normalize_value(value):
+    """
+    Get the value of a DynamoDB attribute value independent of its formatting: numbers (and strings holding a number)
+    as the normalized Decimal string, e.g. {"N": "3.0"} and {"S": "3"} -> "3".
+
+    Parameters:
+    value (dict): Attribute value in low level format (e.g. {"N": "1.5"}).
+
+    Returns:
+    str or bool: Normalized value (other attribute types are returned as their JSON).
+    """
+    if "BOOL" in value:
+        return value["BOOL"]
+
+    text = value.get("N", value.get("S"))
+
+    if text is None:
+        return json.dumps(value, sort_keys=True)
+
+    if NUMBER_PATTERN.fullmatch(text):
+        try:
+            return str(Decimal(text).normalize())
+        except InvalidOperation:
+            pass
+
+    return text
+
+def item_hash(item):
+    """
+    Hash the normalized contents of a DynamoDB item (low level AttributeValue format, see normalize_value()),
+    ignoring the item_hash attribute and the lineage timestamps.
+
+    Returns:
+    str: sha256 hex digest.
+    """
+    contents = {name: normalize_value(value) for name, value in item.items() if name not in UNHASHED_ATTRIBUTES}
+
+    return hashlib.sha256(json.dumps(contents, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+def add_item_hashes(items):
+    """Add an item_hash attribute to each item (in place)."""
+    for item in items:
+        item[ITEM_HASH_ATTRIBUTE] = {"S": item_hash(item)}
+
+    return items
+
+def _get_batch(table_name, keys):
+    """
+    Look up the stored item_hash of up to 100 keys with BatchGetItem, retrying UnprocessedKeys.
+
+    Returns:
+    tuple: (dict of record_hash -> item_hash, number of retries, consumed RCU).
+    """
+    found   = {}
+    retries = 0
+    rcu     = 0.0
+
+    request = {
+        "Keys": [{KEY_ATTRIBUTE: {"S": key}} for key in keys],
+        "ProjectionExpression": "#k, #h",
+        "ExpressionAttributeNames": {"#k": KEY_ATTRIBUTE, "#h": ITEM_HASH_ATTRIBUTE},
+        }
+
+    for attempt in range(batch_writer.MAX_RETRIES + 1):
+        try:
+            response = batch_writer.dynamodb.batch_get_item(RequestItems={table_name: request}, ReturnConsumedCapacity="TOTAL")
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in batch_writer.THROTTLE_ERROR_CODES or attempt == batch_writer.MAX_RETRIES:
+                raise
+
+            retries += 1
+            batch_writer.backoff(attempt)
+            continue
+
+        rcu += sum(capacity.get("CapacityUnits", 0) for capacity in response.get("ConsumedCapacity", []))
+
+        for item in response.get("Responses", {}).get(table_name, []):
+            found[item[KEY_ATTRIBUTE]["S"]] = item.get(ITEM_HASH_ATTRIBUTE, {}).get("S")
+
+        request = response.get("UnprocessedKeys", {}).get(table_name)
+
+        if not request:
+            return found, retries, rcu
+
+        retries += 1
+        batch_writer.backoff(attempt)
+
+    raise RuntimeError(f"{len(request['Keys'])} keys were still unprocessed after {batch_writer.MAX_RETRIES} retries")
+
+def fetch_item_hashes(keys, table_name, max_workers=None):
+    """
+    Look up the stored item_hash of each key in parallel BatchGetItem requests.
+
+    Parameters:
+    keys (list): record_hash values.
+    table_name (str): DynamoDB table name.
+    max_workers (int): Number of worker threads (defaults to DYNAMODB_WRITE_WORKERS).
+
+    Returns:
+    tuple: (dict of record_hash -> stored item_hash (None for items written before item_hash existed),
+            lookup stats dict with "lookups", "lookup_retries" and "rcu").
+    """
+    max_workers = max_workers or batch_writer.MAX_WORKERS
+    batches     = [keys[i:i + BATCH_GET_SIZE] for i in range(0, len(keys), BATCH_GET_SIZE)]
+
+    stored = {}
+    stats  = {"lookups": len(batches), "lookup_retries": 0, "rcu": 0.0}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for found, retries, rcu in executor.map(lambda batch: _get_batch(table_name, batch), batches):
+            stored.update(found)
+            stats["lookup_retries"] += retries
+            stats["rcu"]            += rcu
+
+    return stored, stats
+
+def keyed_items(items):
+    """
+    Split off the items without a (string) record_hash. record_hash is the key of the table, BatchWriteItem rejects
+    a whole request (with a ValidationException) when one of its items does not have it.
+
+    Parameters:
+    items (list): DynamoDB items.
+
+    Returns:
+    tuple: (list of items with a record_hash, number of items without one).
+    """
+    keyed = [item for item in items if "S" in item.get(KEY_ATTRIBUTE, {})]
+
+    return keyed, len(items) - len(keyed)
+
+def changed_items(items, table_name):
+    """
+    Keep only the items that are not in the table yet or whose contents changed.
+    Items without a (string) record_hash can not be looked up or written and are dropped (see keyed_items()).
+
+    Parameters:
+    items (list): DynamoDB items with an item_hash attribute (see add_item_hashes()).
+    table_name (str): DynamoDB table name.
+
+    Returns:
+    tuple: (list of items to write, lookup stats dict with "skipped" and "unkeyed" added).
+    """
+    keyed, unkeyed = keyed_items(items)
+
+    stored, stats = fetch_item_hashes([item[KEY_ATTRIBUTE]["S"] for item in keyed], table_name)
+
+    changed = [item for item in keyed if stored.get(item[KEY_ATTRIBUTE]["S"]) != item[ITEM_HASH_ATTRIBUTE]["S"]]
+
+    stats["skipped"] = len(keyed) - len(changed)
+    stats["unkeyed"] = unkeyed
+
+    return changed, stats
@@ -1,6 +1,7 @@
 # Description: Lambda function runs when it is invoked by an SNS message. 
 # The SNS message is generated by the S3 event notification when a new file is uploaded to the S3 bucket.
-# The Lambda function then reads the CSV file from S3, converts it to a Pandas dataframe, and writes it to DynamoDB
+# The Lambda function then reads the CSV file from S3 in chunks of rows and writes each chunk to DynamoDB,
+# checkpointing its progress so a retried invocation resumes where the last one stopped
 # Usage: python mros_insert_into_dynamodb.py
 # Author: Angus Watters
 
@@ -9,123 +10,181 @@ import os
 import re
 from datetime import datetime
 import json
-from decimal import Decimal
 
 # # # AWS SDK for Python (Boto3) and S3fs for S3 file system support
 # import boto3
 # import s3fs
 # import pandas as pd
 
-# AWS SDK for Pandas
-import awswrangler as wr
+# dataframe -> DynamoDB item serializer
+from mros_insert_into_dynamodb import dynamodb_items
+
+# parallel BatchWriteItem writer (retries, adaptive rate, throughput metrics)
+from mros_insert_into_dynamodb import batch_writer
+
+# write-if-changed lookups on record_hash
+from mros_insert_into_dynamodb import dynamodb_upsert
+
+# chunked, checkpointed CSV reads from S3
+from mros_insert_into_dynamodb import csv_stream
+
+# per-invocation phase timers and counters (CloudWatch EMF), leveled, sampled logging and opt-in profiling
+from mros_common import metrics
+from mros_common import log
+from mros_common import profiling
+
+# per-stage lineage timestamps
+from mros_common import lineage
 
 # Environment variables
 
 # Full bucket URIs
 DYNAMODB_TABLE  = os.environ.get('DYNAMODB_TABLE')
 
+# stop (and let the retry resume from the checkpoint) when less than this much time is left in the invocation
+STOP_BEFORE_TIMEOUT_MS = int(os.environ.get('STOP_BEFORE_TIMEOUT_MS', '60000'))
+
+logger = log.get_logger("mros_insert_into_dynamodb")
+
 # s3 = session.client('s3')
 # dynamodb = session.client('dynamodb')
 
 # # # S3 client
 # s3 = boto3.client('s3')
 
-# # DynamoDB client
-# dynamodb = boto3.client('dynamodb')
+def pandas_to_dynamodb(df, table_name):
+    """
+    Write a dataframe to DynamoDB, one item per row. Missing values are left out of the items (not written as 0).
+    Unless DYNAMODB_WRITE_IF_CHANGED is "false", items that are already in the table unchanged are skipped.
+    Rows without a record_hash (the key of the table) are dropped and counted ("items_without_key").
+
+    Parameters:
+    df (pandas.DataFrame): Records to write.
+    table_name (str): DynamoDB table name.
 
-def float_to_decimal(num):
-    return Decimal(str(num))
+    Returns:
+    dict: Write stats (see batch_writer.write_items()).
+    """
+    # a BatchWriteItem request can not hold two items with the same key
+    if "record_hash" in df.columns:
+        df = df.drop_duplicates(subset=["record_hash"], keep="last")
 
-def pandas_to_dynamodb(df, table_name):
+    # convert the dataframe into typed DynamoDB items in one pass over each column
+    with metrics.phase("serialize"):
+        items = dynamodb_items.dataframe_to_items(df)
 
-    df = df.fillna(0)
-    
-    # convert any floats to decimals
-    for i in df.columns:
+    # items without a record_hash (the table's key) would make BatchWriteItem reject their whole request
+    items, unkeyed = dynamodb_upsert.keyed_items(items)
+
+    if unkeyed:
+        metrics.count("items_without_key", unkeyed)
+        logger.warning("Dropping %s items without a record_hash", unkeyed, table_name=table_name)
 
-        datatype = df[i].dtype
-        # print(f"i: {i}")
-        # print(f"datatype: {datatype}")
+    upsert_stats = {"skipped": 0, "unkeyed": unkeyed}
+
+    # only write items that are new or changed since they were last written
+    if dynamodb_upsert.WRITE_IF_CHANGED:
+        with metrics.phase("upsert_lookup"):
+            dynamodb_upsert.add_item_hashes(items)
+            items, lookup_stats = dynamodb_upsert.changed_items(items, table_name)
+            upsert_stats.update(lookup_stats, unkeyed=unkeyed)
+
+    # stamp the insert time on the items that are written (after the item_hash, which leaves it out)
+    inserted_at = {"N": str(lineage.now_ms())}
+
+    for item in items:
+        item[lineage.INSERTED] = inserted_at
 
-        if datatype == 'float64':
-            # print(f"datatype is float64")
-            df[i] = df[i].apply(float_to_decimal)
     # write to dynamodb
-    wr.dynamodb.put_df(df=df, table_name=table_name)
-        # print(f"===" * 5)
-    return df 
+    with metrics.phase("dynamodb_write"):
+        stats = batch_writer.write_items(items, table_name)
+
+    stats.update(written=stats["items"], **upsert_stats)
+
+    metrics.count("records", len(df))
+    for key in ["written", "skipped", "requests", "retries", "throttles", "wcu", "rcu"]:
+        metrics.count(f"dynamodb_{key}", stats.get(key, 0))
+
+    logger.info("DynamoDB write stats", **stats)
+
+    return stats
 
 # lambda handler function
+@metrics.instrumented("mros_insert_into_dynamodb")
+@profiling.profiled("mros_insert_into_dynamodb")
 def mros_insert_into_dynamodb(event, context):
 
-    print(f"===" * 5)
-    print(f"event: {event}")
-    print(f"===" * 5)
-
-    print(f"Extracting SNS message from event...")
+    logger.debug("event: %s", event)
 
     # get the SNS message from the event
     sns_message = json.loads(event['Records'][0]['Sns']['Message'])
     
-    print(f"---> sns_message: {sns_message}")
-
-    print(f"Extracting S3 bucket name and object key from SNS message...")
+    logger.debug("sns_message: %s", sns_message)
 
     # Extract S3 bucket name and object key from SNS event
     S3_BUCKET     = sns_message['Records'][0]['s3']['bucket']['name']
     S3_OBJECT_KEY = sns_message['Records'][0]['s3']['object']['key']
 
-    print(f"- S3_BUCKET: {S3_BUCKET}")
-    print(f"- S3_OBJECT_KEY: {S3_OBJECT_KEY}")
-    print(f"Extracting S3 object filename from S3 object key...")
     # Get the S3 object filename
     S3_OBJ_FILENAME = os.path.basename(S3_OBJECT_KEY)
 
-    print(f"- S3_OBJ_FILENAME: {S3_OBJ_FILENAME}")
+    S3_FULL_PATH = f"s3://{S3_BUCKET}/{S3_OBJECT_KEY}"
+
+    logger.info("Writing '%s' to DynamoDB", S3_FULL_PATH)
+
+    # resume from the checkpoint of an earlier (failed or timed out) invocation on the same version of the file
+    try:
+        etag       = csv_stream.object_etag(S3_BUCKET, S3_OBJECT_KEY)
+        checkpoint = csv_stream.read_checkpoint(S3_BUCKET, S3_OBJECT_KEY, etag)
+    except Exception as e:
+        logger.error("Exception reading S3_OBJECT_KEY metadata/checkpoint from S3: %s", e,
+                     S3_FULL_PATH=S3_FULL_PATH, S3_OBJECT_KEY=S3_OBJECT_KEY, S3_OBJ_FILENAME=S3_OBJ_FILENAME)
+        raise e
 
-    # Create local file path in /tmp
-    local_file_path = f"/tmp/{S3_OBJ_FILENAME}"
+    if checkpoint["complete"]:
+        logger.summary("All %s rows of '%s' were already written to DynamoDB, nothing to do", checkpoint['rows_done'], S3_FULL_PATH)
+        return
 
-    print(f"- local_file_path: {local_file_path}")
+    rows_done = checkpoint["rows_done"]
+    totals    = {"chunks": 0, "rows": 0, "written": 0, "skipped": 0, "retries": 0, "throttles": 0, "wcu": 0.0, "rcu": 0.0}
 
-    # Download the S3 object
-    print(f"Downloading S3 object...")
-    
-    S3_FULL_PATH = f"s3://{S3_BUCKET}/{S3_OBJECT_KEY}"
+    logger.info("Reading CSV file in chunks of %s rows (starting after row %s)...", csv_stream.CHUNK_ROWS, rows_done)
+
+    chunks = None
 
-    print(f"- S3_FULL_PATH: {S3_FULL_PATH}")
-    print(f"Reading CSV file into Pandas dataframe...")
     try:
-        # s3.download_file(S3_BUCKET, S3_OBJECT_KEY, local_file_path)
-        # wr.s3.download(path=S3_FULL_PATH, local_file=local_file_path)
-        df = wr.s3.read_csv(S3_FULL_PATH)
-    except Exception as e:
-        print(f"Exception downloading S3_OBJECT_KEY file from S3: {e}")
-        print(f"- Problem S3_FULL_PATH: {S3_FULL_PATH}")
-        print(f"- Problem S3_OBJECT_KEY: {S3_OBJECT_KEY}")
-        print(f"- Problem S3_OBJ_FILENAME: {S3_OBJ_FILENAME}")
-        print(f"- Problem local_file_path: {local_file_path}")
+        chunks = csv_stream.prefetch(csv_stream.read_csv_chunks(S3_FULL_PATH, skip_rows=rows_done))
+
+        for df in chunks:
+            logger.debug("Chunk %s: rows %s to %s (%s columns)", totals['chunks'] + 1, rows_done + 1, rows_done + len(df), len(df.columns))
+
+            # write the chunk to DynamoDB
+            stats = pandas_to_dynamodb(df, DYNAMODB_TABLE)
 
-    # print(f"Reading CSV file into Pandas dataframe...")
-    # # Read the CSV file into a Pandas dataframe
-    # df = pd.read_csv(local_file_path)
+            rows_done += len(df)
+            csv_stream.write_checkpoint(S3_BUCKET, S3_OBJECT_KEY, etag, rows_done)
 
-    print(f"df.shape: {df.shape}")
-    print(f"Number of rows in dataframe: {len(df)}")
-    print(f"Number of columns in dataframe: {len(df.columns)}")
+            totals["chunks"] += 1
+            totals["rows"]   += len(df)
+            for key in ["written", "skipped", "retries", "throttles", "wcu"]:
+                totals[key] += stats[key]
+            totals["rcu"] += stats.get("rcu", 0.0)
 
-    print(f"Attempting to write dataframe to DynamoDB table...")
+            # stop before the Lambda times out, the retry resumes from the checkpoint
+            if context and context.get_remaining_time_in_millis() < STOP_BEFORE_TIMEOUT_MS:
+                raise TimeoutError(f"Stopping before the Lambda timeout after row {rows_done}, the next attempt resumes from there")
 
-    try: 
-        # write the dataframe to DynamoDB
-        pandas_to_dynamodb(df, DYNAMODB_TABLE)
     except Exception as e:
-        print(f"Exception writing dataframe to DynamoDB: {e}")
-        raise 
+        logger.error("Exception writing CSV chunks to DynamoDB: %s", e, S3_FULL_PATH=S3_FULL_PATH, rows_written=rows_done)
+        raise e
+    finally:
+        # stopping early (timeout, write error) also stops the prefetch thread and closes the S3 body stream
+        if chunks is not None:
+            chunks.close()
 
+    csv_stream.write_checkpoint(S3_BUCKET, S3_OBJECT_KEY, etag, rows_done, complete=True)
 
-    # # batch write the dataframe to DynamoDB
-    # pandas_to_dynamodb(df, DYNAMODB_TABLE)
+    logger.summary("DynamoDB totals for '%s'", S3_FULL_PATH, **totals)
 
     return
 
@@ -0,0 +1,145 @@
+# Description: pandas-free writer of the prod CSV files of mros_stage_to_prod. For the usual small SQS batches,
+# importing pandas (and s3fs) was most of the lambda's cold start, so batches of up to FAST_PATH_MAX_RECORDS records
+# are written with the csv module instead. The output is byte for byte what the pandas path writes
+# (pd.DataFrame(json_list) -> record_hash moved last -> groupby('date_key') -> to_csv(index=False)), which means
+# reproducing how pandas types each column over the whole batch:
+#   - all ints (none missing)                -> int64:   str(int)
+#   - ints/floats, or numbers with missing   -> float64: repr(float), missing as ""
+#   - all bools (none missing)               -> bool:    "True"/"False"
+#   - anything else                          -> object:  str(value), missing (None/NaN) as ""
+# Records that pandas would type differently (nested values, ints outside int64) are left to the pandas path:
+# group_csv_files() returns None for them.
+# Usage: from mros_stage_to_prod import prod_csv
+# Author: Angus Watters
+
+# general utility libraries
+import io
+import os
+import csv
+import math
+
+# Environment variables
+# Max number of records in a batch written without pandas (0 always uses pandas)
+FAST_PATH_MAX_RECORDS = int(os.environ.get('STAGE_CSV_FAST_PATH_MAX_RECORDS', '1000'))
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+def _is_missing(value):
+    return value is None or (type(value) is float and math.isnan(value))
+
+def _format_float(value):
+    return "" if value is None or math.isnan(value) else repr(float(value))
+
+def _format_object(value):
+    return "" if _is_missing(value) else str(value)
+
+def column_formatter(values):
+    """
+    Formatter of one column, typed over all of its values (missing values are None) like pandas types it.
+
+    Parameters:
+    values (list): Column values of every record of the batch.
+
+    Returns:
+    function: value -> CSV field string, or None if the column needs the pandas path.
+    """
+    kinds = set()
+
+    for value in values:
+        if value is None:
+            kinds.add("missing")
+            continue
+
+        kind = type(value)
+
+        if kind is bool:
+            kinds.add("bool")
+        elif kind is int:
+            if not INT64_MIN <= value <= INT64_MAX:
+                return None
+            kinds.add("int")
+        elif kind is float:
+            kinds.add("missing" if math.isnan(value) else "float")
+        elif kind is str:
+            kinds.add("str")
+        else:
+            return None
+
+    if kinds == {"int"}:
+        return str
+
+    if kinds == {"bool"}:
+        return str
+
+    if kinds and kinds <= {"int", "float", "missing"} and kinds & {"int", "float"}:
+        return _format_float
+
+    return _format_object
+
+def column_names(records):
+    """
+    Column names of the batch dataframe: keys in order of first appearance, with record_hash moved last.
+
+    Returns:
+    list: Column names, or None if no record has a record_hash (the pandas path raises on that).
+    """
+    columns = list(dict.fromkeys(key for record in records for key in record))
+
+    if "record_hash" not in columns:
+        return None
+
+    columns.remove("record_hash")
+    columns.append("record_hash")
+
+    return columns
+
+def group_csv_files(records):
+    """
+    Write a batch of processed staging records as one CSV text per date_key.
+
+    Parameters:
+    records (list): Processed staging records (dicts with "date_key" and "record_hash").
+
+    Returns:
+    dict: date_key -> (CSV text, row count), in date_key order, or None if the batch needs the pandas path.
+    """
+    columns = column_names(records)
+
+    if columns is None:
+        return None
+
+    formatters = []
+
+    for col in columns:
+        formatter = column_formatter([record.get(col) for record in records])
+
+        if formatter is None:
+            return None
+
+        formatters.append(formatter)
+
+    groups = {}
+
+    for record in records:
+        date_key = record.get("date_key")
+
+        # pandas' groupby drops rows with a missing key
+        if _is_missing(date_key):
+            continue
+
+        groups.setdefault(str(date_key), []).append(record)
+
+    files = {}
+
+    for date_key in sorted(groups):
+        out    = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n", quoting=csv.QUOTE_MINIMAL)
+
+        writer.writerow(columns)
+
+        for record in groups[date_key]:
+            writer.writerow([fmt(record.get(col)) for col, fmt in zip(columns, formatters)])
+
+        files[date_key] = (out.getvalue(), len(groups[date_key]))
+
+    return files
@@ -53,6 +53,10 @@ DEPLOY_DIR="$BASE_DIR/deploy"
 # Set the app directory name (where the lambda functions are located, each lambda function in its own subdirectory)
 APP_DIR="lambdas"
 
+# Shared Python package under "lambdas/" (e.g. metrics.py) that is added to every lambda ZIP file
+# instead of being packaged as a lambda function of its own
+SHARED_DIR="mros_common"
+
 echo "Creating deploy directory if it doesn't exist"
 echo "DEPLOY_DIR:\n --> $DEPLOY_DIR"
 
@@ -65,6 +69,12 @@ for SUBDIR in "$BASE_DIR/$APP_DIR"/*; do
         # Extract the directory name
         DIR_NAME=$(basename "$SUBDIR")
 
+        # Skip the shared package, it is added to each of the lambda ZIP files below
+        if [[ "$DIR_NAME" == "$SHARED_DIR" ]]; then
+            echo "Skipping shared package directory: '$DIR_NAME'"
+            continue
+        fi
+
         # Set the target directory and ZIP file for the current subdirectory
         PKG_DIR="$BASE_DIR/$APP_DIR/package"
         TARGET_DIR="$SUBDIR/package"
@@ -154,6 +164,10 @@ for SUBDIR in "$BASE_DIR/$APP_DIR"/*; do
         # Add the contents of the given lambdas/ subdirectory (DIR_NAME) to the ZIP file, (EXCLUDE the "config.py" file)
         zip -g "$ZIP_FILE" -r "$DIR_NAME" -x "$DIR_NAME/config.py"
 
+        # Add the shared package (imported as "from mros_common import ...") to the ZIP file
+        echo -e "Adding shared '$SHARED_DIR' package to:\n '$ZIP_FILE'"
+        zip -g "$ZIP_FILE" -r "$SHARED_DIR" -x "*/__pycache__/*"
+
         echo "Removing $PKG_DIR"
 
         # remove the PKG_DIR directory
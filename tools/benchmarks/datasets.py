@@ -0,0 +1,184 @@
+# Description: Synthetic inputs of the pipeline micro-benchmarks (see run_benchmarks.py), built at any row count
+# from a pool of generated records (pipeline_harness/synthetic.py) so that 1M row datasets build in seconds.
+# Usage: from benchmarks import datasets
+# Author: Angus Watters
+
+# general utility libraries
+import random
+
+import numpy as np
+import pandas as pd
+
+from pipeline_harness import synthetic
+
+# number of distinct generated records that larger datasets are tiled from
+POOL_SIZE = 1000
+
+# submission date of the synthetic Airtable records
+POOL_DATE = "01/15/24"
+
+def airtable_pool(seed=0):
+    """Pool of POOL_SIZE synthetic Airtable API records."""
+    return synthetic.airtable_records(POOL_DATE, POOL_SIZE, random.Random(seed))
+
+def airtable_records(n, seed=0):
+    """
+    n Airtable API records with unique ids and users (tiled from airtable_pool(), so the dedup in
+    records_to_dataframe() keeps every row).
+
+    Parameters:
+    n (int): Number of records.
+    seed (int): Random seed of the pool.
+
+    Returns:
+    list: Airtable records ({"id", "createdTime", "fields"}).
+    """
+    pool    = airtable_pool(seed)
+    records = []
+
+    for i in range(n):
+        base   = pool[i % POOL_SIZE]
+        fields = dict(base["fields"], user=f"user_{i}")
+
+        records.append({"id": f"rec{i:014d}", "createdTime": base["createdTime"], "fields": fields})
+
+    return records
+
+def coordinates(n, seed=0):
+    """
+    n (latitude, longitude) pairs clustered like the synthetic observations.
+
+    Returns:
+    tuple: numpy arrays of latitudes and longitudes.
+    """
+    rng     = np.random.default_rng(seed)
+    centers = np.array(synthetic.CLUSTER_CENTERS)[rng.integers(len(synthetic.CLUSTER_CENTERS), size=n)]
+
+    return centers[:, 0] + rng.normal(0, 0.3, n), centers[:, 1] + rng.normal(0, 0.3, n)
+
+def message_bodies(n, seed=0):
+    """
+    n SQS message bodies (all values strings, like build_messages() makes), tiled from a pool of distinct bodies.
+
+    Returns:
+    list: Message body dicts.
+    """
+    rng  = random.Random(seed)
+    pool = []
+
+    for record in airtable_pool(seed):
+        fields = record["fields"]
+
+        pool.append({
+            'id': record["id"],
+            'timestamp': fields["datetime_received_pacific"],
+            'createdtime': record["createdTime"],
+            'name': "nan",
+            'latitude': str(fields["latitude"]),
+            'user': fields["user"],
+            'longitude': str(fields["longitude"]),
+            'submitted_time': fields["time_submitted_utc"],
+            'local_time': fields["time_submitted_local"],
+            'submitted_date': fields["date_submitted_utc"],
+            'local_date': fields["date_submitted_local"],
+            'comment': fields.get("comment", "nan"),
+            'time': fields["datetime_received_pacific"],
+            'device_type': fields["DeviceType"],
+            'duplicate_id': str(rng.randrange(10 ** 9)),
+            'duplicate_count': "1"
+        })
+
+    return [pool[i % POOL_SIZE] for i in range(n)]
+
+def prod_frame(n, enrichment_columns, seed=0):
+    """
+    n enriched records as the prod CSV holds them (message body columns, record_hash and the enrichment columns),
+    the input of pandas_to_dynamodb().
+
+    Parameters:
+    n (int): Number of rows.
+    enrichment_columns (list): (column name, kind) tuples of the enrichment columns (see master_schema.py).
+    seed (int): Random seed.
+
+    Returns:
+    pandas.DataFrame: Enriched records.
+    """
+    rng   = np.random.default_rng(seed)
+    tiles = -(-n // POOL_SIZE)
+    df    = pd.DataFrame(message_bodies(POOL_SIZE, seed))
+
+    df = pd.concat([df] * tiles, ignore_index=True).iloc[:n]
+    df["id"]          = [f"rec{i:014d}" for i in range(n)]
+    df["record_hash"] = [f"{i:064x}" for i in range(n)]
+    df["latitude"]    = df["latitude"].astype(float)
+    df["longitude"]   = df["longitude"].astype(float)
+
+    for col, kind in enrichment_columns:
+        if kind == "float":
+            values = np.round(rng.uniform(-10, 30, n), 3)
+            values[rng.random(n) < 0.05] = np.nan
+            df[col] = values
+        elif kind == "int":
+            df[col] = rng.integers(10, size=n)
+        else:
+            df[col] = np.array([f"{col}_{x}" for x in range(5)], dtype=object)[rng.integers(5, size=n)]
+
+    return df
+
+def dedup_frames(n, n_input=1000, overlap=0.5, seed=0):
+    """
+    Inputs of the append stage dedup (master_store.drop_existing_records()): n_input new records, of which a
+    fraction `overlap` is already in a master dataset of n records.
+
+    Returns:
+    tuple: (input dataframe, master DEDUP_COLUMNS dataframe).
+    """
+    rng = np.random.default_rng(seed)
+
+    master_keys_df = pd.DataFrame({
+        "duplicate_id": [f"dup_{i}" for i in range(n)],
+        "record_hash": [f"{i:064x}" for i in range(n)]
+    })
+
+    n_old = min(n, int(n_input * overlap))
+    old   = rng.choice(n, size=n_old, replace=False)
+    new   = np.arange(n, n + n_input - n_old)
+
+    input_df = pd.DataFrame({
+        "duplicate_id": [f"dup_{i}" for i in np.concatenate([old, new])],
+        "record_hash": [f"{i:064x}" for i in np.concatenate([old, new])],
+        "phase": rng.choice(synthetic.PHASES, size=n_input)
+    })
+
+    return input_df, master_keys_df
+
+def near_duplicate_inputs(n, share=0.05, users=None, seed=0):
+    """
+    Inputs of near_duplicates.find_near_duplicates(): n observations of one day, a fraction `share` of which are
+    app double-taps (a copy of another observation of the same user a few seconds and meters later).
+
+    Parameters:
+    n (int): Number of observations (double-taps included).
+    share (float): Fraction of double-taps.
+    users (int): Number of distinct users (defaults to n // 4, like the synthetic Airtable records).
+    seed (int): Random seed.
+
+    Returns:
+    tuple: (users, latitudes, longitudes, epoch seconds) numpy arrays.
+    """
+    rng      = np.random.default_rng(seed)
+    n_taps   = int(n * share)
+    n_base   = n - n_taps
+    lat, lon = coordinates(n_base, seed)
+
+    user = rng.integers(max(1, (users or n // 4)), size=n_base)
+    time = 1705276800 + rng.uniform(0, 86400, n_base)
+
+    # double-taps: 1-10 seconds and ~1-10 meters after a random observation
+    src  = rng.integers(n_base, size=n_taps)
+    user = np.concatenate([user, user[src]])
+    lat  = np.concatenate([lat, lat[src] + rng.uniform(-1e-4, 1e-4, n_taps)])
+    lon  = np.concatenate([lon, lon[src] + rng.uniform(-1e-4, 1e-4, n_taps)])
+    time = np.concatenate([time, time[src] + rng.uniform(1, 10, n_taps)])
+
+    return np.array([f"user_{u}" for u in user], dtype=object), lat, lon, time
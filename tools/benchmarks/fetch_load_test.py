@@ -0,0 +1,169 @@
+# Description: Offline load test of the Airtable fetch path of mros_airtable_to_sqs (fetch_airtable_data()) against the
+# fake Airtable API (pipeline_harness/fake_airtable.py), so fetch concurrency and backoff changes can be compared
+# reproducibly without touching the real base. Each of --days dates (records_per_day records each) is fetched, up to
+# --concurrency dates at a time, and the report lists:
+#   - wall time, records/s and requests (200/429/5xx) against the server
+#   - the time the fetch code asked to sleep (pauses between pages and 429 backoff), which --sleep-scale shrinks so a
+#     run that would sleep for minutes takes seconds (the reported sleep is the unscaled one)
+#   - records fetched vs the records the server holds for each date, i.e. dates the fetch silently cut short
+#
+# Usage: python tools/benchmarks/fetch_load_test.py --records-per-day 2000 --days 4
+#        python tools/benchmarks/fetch_load_test.py --records-per-day 5000 --days 7 --concurrency 2 \
+#            --latency-ms 150 --jitter-ms 50 --error-rate-429 0.05 --error-rate-5xx 0.01 --rate-limit 5 --json fetch.json
+# NOTE: needs the Python packages of mros_airtable_to_sqs (lambdas/mros_airtable_to_sqs/requirements.txt), no network.
+# Author: Angus Watters
+
+# general utility libraries
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS_DIR      = os.path.dirname(BENCHMARKS_DIR)
+REPO_DIR       = os.path.dirname(TOOLS_DIR)
+
+# the lambdas are imported as packages (e.g. "from mros_append_daily_data import master_schema"), like in the zips
+sys.path.insert(0, os.path.join(REPO_DIR, "lambdas"))
+sys.path.insert(0, TOOLS_DIR)
+
+from pipeline_harness import fake_airtable
+
+class ScaledSleep:
+    """
+    Stand-in for the `time` module of the handler whose sleep() only waits `scale` times the requested time, and
+    adds up the requested time (thread safe).
+    """
+
+    def __init__(self, scale):
+        self.scale     = scale
+        self.requested = 0.0
+        self.lock      = threading.Lock()
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.requested += seconds
+
+        time.sleep(seconds * self.scale)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+def load_test(server, dates, concurrency=1, sleep_scale=0.01):
+    """
+    Fetch the dates from a running fake Airtable server with fetch_airtable_data().
+
+    Parameters:
+    server (fake_airtable.FakeAirtable): Running server.
+    dates (list): Dates to fetch ("MM/DD/YY").
+    concurrency (int): Dates fetched at the same time.
+    sleep_scale (float): Share of the requested sleep time the fetch code actually sleeps.
+
+    Returns:
+    dict: Report (see the module description).
+    """
+    from mros_airtable_to_sqs import mros_airtable_to_sqs as handler
+
+    sleeper = ScaledSleep(sleep_scale)
+
+    # point the handler at the fake server and scale its sleeps (module globals, restored afterwards)
+    saved = handler.AIRTABLE_API_URL, handler.time
+    handler.AIRTABLE_API_URL, handler.time = server.api_url, sleeper
+
+    def fetch(date):
+        started = time.perf_counter()
+        records = handler.fetch_airtable_data(date, server.base_id, server.table_id, server.token)
+        return date, records, time.perf_counter() - started
+
+    started = time.perf_counter()
+
+    try:
+        # the handler logs every page, keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+                results = list(pool.map(fetch, dates))
+    finally:
+        handler.AIRTABLE_API_URL, handler.time = saved
+
+    seconds = time.perf_counter() - started
+    stats   = dict(server.stats)
+
+    per_date = {}
+
+    for date, records, date_seconds in results:
+        expected = len(server.matching_records(f"{{{fake_airtable.DATE_FIELD}}}='{date}'") or [])
+        unique   = len({record["id"] for record in records})
+
+        per_date[date] = {"fetched": len(records), "unique": unique, "expected": expected,
+                          "complete": unique == expected and len(records) == expected, "seconds": round(date_seconds, 3)}
+
+    fetched = sum(entry["fetched"] for entry in per_date.values())
+
+    return {
+        "dates": len(dates),
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "records_fetched": fetched,
+        "records_expected": sum(entry["expected"] for entry in per_date.values()),
+        "records_per_second": round(fetched / seconds, 1) if seconds > 0 else None,
+        "requests": stats.get("requests", 0),
+        "responses": {key.replace("status_", ""): value for key, value in sorted(stats.items()) if key.startswith("status_")},
+        "requested_sleep_seconds": round(sleeper.requested, 2),
+        "sleep_scale": sleep_scale,
+        "incomplete_dates": [date for date, entry in per_date.items() if not entry["complete"]],
+        "per_date": per_date
+    }
+
+def print_report(report):
+    print(f"Fetched {report['records_fetched']}/{report['records_expected']} records of {report['dates']} dates "
+          f"in {report['seconds']:.2f} s ({report['records_per_second']} records/s, concurrency {report['concurrency']})")
+    print(f"Requests: {report['requests']}, responses: " + ", ".join(f"{code}={n}" for code, n in report["responses"].items()))
+    print(f"Requested sleep: {report['requested_sleep_seconds']:.1f} s (slept x{report['sleep_scale']})")
+
+    print(f"\n{'date':<10}{'fetched':>10}{'expected':>10}{'seconds':>10}  complete")
+    for date, entry in report["per_date"].items():
+        print(f"{date:<10}{entry['fetched']:>10}{entry['expected']:>10}{entry['seconds']:>10.2f}  {'yes' if entry['complete'] else 'NO'}")
+
+    if report["incomplete_dates"]:
+        print(f"\nIncomplete dates: {', '.join(report['incomplete_dates'])}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of the Airtable fetch path of mros_airtable_to_sqs.")
+    parser.add_argument("--start", default="06/01/24", help="First date (MM/DD/YY).")
+    parser.add_argument("--days", type=int, default=2, help="Number of dates to fetch.")
+    parser.add_argument("--records-per-day", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=1, help="Dates fetched at the same time.")
+    parser.add_argument("--sleep-scale", type=float, default=0.01, help="Share of the requested sleeps actually slept.")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate-429", type=float, default=0.0)
+    parser.add_argument("--error-rate-5xx", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=None, help="Requests per second (Airtable: 5).")
+    parser.add_argument("--penalty-s", type=float, default=0.0, help="429 lockout after exceeding the rate limit.")
+    parser.add_argument("--json", default=None, help="Write the report to this JSON file.")
+    args = parser.parse_args(argv)
+
+    server = fake_airtable.FakeAirtable(records_per_day=args.records_per_day, seed=args.seed,
+                                        error_rate_429=args.error_rate_429, error_rate_5xx=args.error_rate_5xx,
+                                        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                        rate_limit=args.rate_limit, penalty_s=args.penalty_s)
+
+    with server:
+        report = load_test(server, fake_airtable.date_range(args.start, args.days), args.concurrency, args.sleep_scale)
+
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+# Description: Import time report of the MRoS lambda handlers, i.e. the module import part of a cold start.
+# Each handler module is imported in fresh interpreters (`python -X importtime`, --runs times), and the import time
+# of the handler (median over the runs) is broken down by top-level package (pandas, boto3, mros_common, ...), so a
+# heavy library creeping back into a handler's import path shows up as a new row at the top of its table. Packages
+# imported before the handler (interpreter startup) are not counted.
+#
+# Usage: python tools/benchmarks/import_times.py
+#        python tools/benchmarks/import_times.py --only mros_stage_to_prod --runs 10 --top 15
+#        python tools/benchmarks/import_times.py --json import_times.json
+# NOTE: needs the Python packages of the lambdas (lambdas/*/requirements.txt). Timings are machine specific, the
+# Lambda runtime is usually slower than a laptop (and much slower for the first import from a fresh container).
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR       = os.path.dirname(os.path.dirname(BENCHMARKS_DIR))
+LAMBDAS_DIR    = os.path.join(REPO_DIR, "lambdas")
+
+# handler modules (lambda function name -> module imported by the Lambda runtime)
+HANDLERS = {
+    "mros_airtable_to_sqs": "mros_airtable_to_sqs.mros_airtable_to_sqs",
+    "mros_stage_to_prod": "mros_stage_to_prod.mros_stage_to_prod",
+    "mros_insert_into_dynamodb": "mros_insert_into_dynamodb.mros_insert_into_dynamodb",
+    "mros_append_daily_data": "mros_append_daily_data.mros_append_daily_data"
+}
+
+# "import time:  <self us> | <cumulative us> | <indent><module>" lines of -X importtime (2 spaces per nesting level)
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)\s*$")
+
+def parse_importtime(stderr, module):
+    """
+    Import time of a module, by top-level package, from the -X importtime output of an interpreter importing it.
+
+    Parameters:
+    stderr (str): -X importtime output (stderr of the interpreter).
+    module (str): Imported module, e.g. "mros_stage_to_prod.mros_stage_to_prod".
+
+    Returns:
+    tuple: (cumulative import time of the module in microseconds, {top-level package: self time in microseconds}).
+    """
+    entries = []
+
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((int(self_us), int(cumulative_us), (len(indent) - 1) // 2, name))
+
+    # -X importtime prints a module after everything it imported, so the handler's imports are the lines between
+    # the previous top-level line and the handler's own line
+    end = next(i for i, entry in enumerate(entries) if entry[2] == 0 and entry[3] == module)
+
+    start = end
+    while start > 0 and entries[start - 1][2] > 0:
+        start -= 1
+
+    packages = {}
+
+    for self_us, _, _, name in entries[start:end + 1]:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+
+    return entries[end][1], packages
+
+def import_once(module, python=None):
+    """Import a module in a fresh interpreter and parse its -X importtime output (see parse_importtime())."""
+    env = dict(os.environ, PYTHONPATH=LAMBDAS_DIR, PYTHONDONTWRITEBYTECODE="1")
+
+    # botocore needs a region for clients created at import time (the handlers create theirs lazily)
+    env.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+
+    result = subprocess.run([python or sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=LAMBDAS_DIR, env=env, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+
+    return parse_importtime(result.stderr, module)
+
+def handler_report(module, runs, python=None):
+    """
+    Median import time of a handler module over `runs` fresh interpreters.
+
+    Returns:
+    dict: "total_ms" and "packages" ({top-level package: ms}, slowest first).
+    """
+    totals   = []
+    packages = {}
+
+    for _ in range(runs):
+        total_us, run_packages = import_once(module, python)
+        totals.append(total_us)
+
+        for package, us in run_packages.items():
+            packages.setdefault(package, []).append(us)
+
+    # a package missing from a run counts as 0 ms in that run
+    medians = {package: statistics.median(values + [0] * (runs - len(values))) / 1000
+               for package, values in packages.items()}
+
+    return {
+        "module": module,
+        "total_ms": round(statistics.median(totals) / 1000, 2),
+        "packages": {package: round(ms, 2) for package, ms in sorted(medians.items(), key=lambda kv: -kv[1])}
+    }
+
+def print_report(name, report, top):
+    print(f"{name} ({report['module']}): {report['total_ms']:.1f} ms")
+
+    packages = list(report["packages"].items())
+
+    for package, ms in packages[:top]:
+        share = 100 * ms / report["total_ms"] if report["total_ms"] else 0
+        print(f"  {package:<28} {ms:>9.1f} ms {share:>5.1f}%")
+
+    if len(packages) > top:
+        rest = sum(ms for _, ms in packages[top:])
+        print(f"  {f'({len(packages) - top} more)':<28} {rest:>9.1f} ms")
+
+    print()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import time report of the MRoS lambda handlers.")
+    parser.add_argument("--only", default=None, help="Comma separated lambda names (default: all handlers).")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per handler (the median is reported).")
+    parser.add_argument("--top", type=int, default=10, help="Top-level packages listed per handler.")
+    parser.add_argument("--python", default=None, help="Python executable (default: the running interpreter).")
+    parser.add_argument("--json", default=None, help="Write the reports to this JSON file.")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else list(HANDLERS)
+
+    unknown = [name for name in names if name not in HANDLERS]
+    if unknown:
+        parser.error(f"unknown handlers: {', '.join(unknown)} (known: {', '.join(HANDLERS)})")
+
+    reports = {}
+
+    for name in names:
+        reports[name] = handler_report(HANDLERS[name], max(1, args.runs), args.python)
+        print_report(name, reports[name], args.top)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
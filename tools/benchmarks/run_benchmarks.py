@@ -0,0 +1,392 @@
+# Description: Micro-benchmarks of the per-record hot paths of the MRoS pipeline lambdas, over synthetic datasets
+# of 1k to 1M rows (see datasets.py):
+#   encode / decode_exactly     geohash encoding (precision 12 and 5) and decoding (mros_common/geohash.py)
+#   hash_dictionary             record_hash of an SQS message body
+#   records_to_dataframe        Airtable API records -> dataframe in mros_airtable_to_sqs
+#   build_messages              dataframe -> SQS message bodies in mros_airtable_to_sqs
+#   find_near_duplicates        near duplicate (double-tap) detection of n observations, 5% of them double-taps
+#   dynamodb_items              prod CSV rows -> DynamoDB items, column by column (dynamodb_items.py)
+#   dynamodb_items_decimal      the same with the old per-cell serializer (fillna(0), Decimal(str(x)) per float cell
+#                               and boto3's TypeSerializer per value, as wr.dynamodb.put_df did), for comparison
+#   pandas_to_dynamodb          prod CSV rows -> DynamoDB items -> (fake) BatchWriteItem, in chunks like the handler
+#   drop_existing_records       append stage dedup of 1000 new records against a master dataset of n records
+# AWS calls go to the in-process fakes of the pipeline harness (pipeline_harness/fake_aws.py), so the timings are
+# the Python cost of each function, not the network.
+#
+# Each benchmark/size is timed `--repeats` times (fewer when a single run is slow) and the best and median times
+# are reported. Timings are stored as a JSON baseline (--save-baseline) and every run is compared against it: a
+# benchmark regresses when its best time is more than --threshold times the baseline (per benchmark overrides with
+# --threshold-for) and slower by more than --min-seconds (the noise floor). The exit status is 1 on a regression.
+#
+# Usage: python tools/benchmarks/run_benchmarks.py --save-baseline
+#        python tools/benchmarks/run_benchmarks.py --sizes 1000,10000 --threshold 1.5 --threshold-for build_messages=2
+#        python tools/benchmarks/run_benchmarks.py --only encode_12,hash_dictionary --json results.json
+# NOTE: needs the Python packages of the lambdas (lambdas/*/requirements.txt). Baselines are machine specific,
+# compare runs made on the same machine.
+# Author: Angus Watters
+
+# general utility libraries
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import contextlib
+from datetime import datetime, timezone
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS_DIR      = os.path.dirname(BENCHMARKS_DIR)
+REPO_DIR       = os.path.dirname(TOOLS_DIR)
+
+# the lambdas are imported as packages (e.g. "from mros_append_daily_data import master_schema"), like in the zips
+sys.path.insert(0, os.path.join(REPO_DIR, "lambdas"))
+sys.path.insert(0, TOOLS_DIR)
+
+from pipeline_harness import fake_aws
+
+DEFAULT_SIZES    = [1000, 10000, 100000, 1000000]
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+# DynamoDB table of the fake pandas_to_dynamodb writes
+DYNAMODB_TABLE = "mros-benchmark-table"
+
+class Benchmark:
+    """
+    A benchmarked function.
+
+    Parameters:
+    name (str): Benchmark name (used in baselines and --only / --threshold-for).
+    setup (function): Builds the (untimed) input of a run from the number of rows.
+    run (function): The timed call, takes the output of setup.
+    """
+    def __init__(self, name, setup, run):
+        self.name  = name
+        self.setup = setup
+        self.run   = run
+
+def import_lambdas():
+    """
+    Import the lambda modules against the fake AWS services (they create their clients at import time).
+
+    Returns:
+    dict: Imported modules by name.
+    """
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-1")
+    os.environ["DYNAMODB_TABLE"] = DYNAMODB_TABLE
+
+    # only count the fake DynamoDB writes, a million stored items would not fit in memory
+    fake_aws.FakeAWS(keep_dynamodb_items=False).install()
+
+    from mros_airtable_to_sqs import mros_airtable_to_sqs, near_duplicates
+    from mros_common import geohash
+    from mros_insert_into_dynamodb import mros_insert_into_dynamodb, batch_writer, csv_stream, dynamodb_items
+    from mros_append_daily_data import master_schema, master_store
+
+    # no rate limiting against the fake table
+    batch_writer.INITIAL_RATE = 1e12
+    batch_writer.MAX_RATE     = 1e12
+
+    return {
+        "airtable_to_sqs": mros_airtable_to_sqs,
+        "near_duplicates": near_duplicates,
+        "geohash": geohash,
+        "insert_into_dynamodb": mros_insert_into_dynamodb,
+        "csv_stream": csv_stream,
+        "dynamodb_items": dynamodb_items,
+        "master_schema": master_schema,
+        "master_store": master_store
+    }
+
+def decimal_items(df):
+    """
+    The per-cell serializer dynamodb_items.dataframe_to_items() replaced: missing values written as 0, every float
+    cell converted with Decimal(str(x)), every value of every row through boto3's TypeSerializer.
+
+    Returns:
+    list: DynamoDB items in low level AttributeValue format.
+    """
+    from decimal import Decimal
+    from boto3.dynamodb.types import TypeSerializer
+
+    df = df.fillna(0)
+
+    for col in df.columns:
+        if df[col].dtype == "float64":
+            df[col] = df[col].apply(lambda num: Decimal(str(num)))
+
+    serializer = TypeSerializer()
+
+    return [{name: serializer.serialize(value) for name, value in row.items()} for row in df.to_dict("records")]
+
+def silent(func):
+    """Wrap a function so its prints (the lambda logs) are discarded."""
+    def wrapper(*args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func(*args)
+
+    return wrapper
+
+def make_benchmarks(modules):
+    """The benchmarks, in report order."""
+    from benchmarks import datasets
+
+    airtable    = modules["airtable_to_sqs"]
+    near_dups   = modules["near_duplicates"]
+    geohash     = modules["geohash"]
+    insert      = modules["insert_into_dynamodb"]
+    chunk_rows  = modules["csv_stream"].CHUNK_ROWS
+    enrichment  = modules["master_schema"].ENRICHMENT_COLUMNS
+    store       = modules["master_store"]
+    items       = modules["dynamodb_items"]
+
+    def encode_run(precision):
+        def run(coords):
+            encode = geohash.encode
+            return [encode(lat, lon, precision) for lat, lon in zip(*coords)]
+
+        return run
+
+    def geohashes(n):
+        lats, lons = datasets.coordinates(n)
+        return [geohash.encode(lat, lon, 12) for lat, lon in zip(lats, lons)]
+
+    def decode_run(hashes):
+        decode_exactly = geohash.decode_exactly
+        return [decode_exactly(cell) for cell in hashes]
+
+    def hash_run(bodies):
+        hash_dictionary = airtable.hash_dictionary
+        return [hash_dictionary(body) for body in bodies]
+
+    def near_duplicates_run(inputs):
+        return near_dups.find_near_duplicates(*inputs)
+
+    def dataframe_setup(n):
+        return datasets.airtable_records(n)
+
+    def messages_setup(n):
+        return silent(airtable.records_to_dataframe)(datasets.airtable_records(n))
+
+    # write in chunks of DYNAMODB_CHUNK_ROWS rows, like the handler reads the prod CSV
+    def dynamodb_run(df):
+        for start in range(0, len(df), chunk_rows):
+            insert.pandas_to_dynamodb(df.iloc[start:start + chunk_rows], DYNAMODB_TABLE)
+
+    def dedup_run(frames):
+        return store.drop_existing_records(*frames)
+
+    return [
+        Benchmark("encode_12", datasets.coordinates, encode_run(12)),
+        Benchmark("encode_5", datasets.coordinates, encode_run(5)),
+        Benchmark("decode_exactly", geohashes, decode_run),
+        Benchmark("hash_dictionary", datasets.message_bodies, hash_run),
+        Benchmark("records_to_dataframe", dataframe_setup, silent(airtable.records_to_dataframe)),
+        Benchmark("build_messages", messages_setup, airtable.build_messages),
+        Benchmark("find_near_duplicates", datasets.near_duplicate_inputs, near_duplicates_run),
+        Benchmark("dynamodb_items", lambda n: datasets.prod_frame(n, enrichment), items.dataframe_to_items),
+        Benchmark("dynamodb_items_decimal", lambda n: datasets.prod_frame(n, enrichment), decimal_items),
+        Benchmark("pandas_to_dynamodb", lambda n: datasets.prod_frame(n, enrichment), silent(dynamodb_run)),
+        Benchmark("drop_existing_records", datasets.dedup_frames, dedup_run)
+    ]
+
+def time_benchmark(benchmark, n, repeats, time_budget):
+    """
+    Time a benchmark at n rows.
+
+    Parameters:
+    benchmark (Benchmark): Benchmark to run.
+    n (int): Number of rows.
+    repeats (int): Max number of timed runs.
+    time_budget (float): Stop repeating once the timed runs took this many seconds (at least one run is made).
+
+    Returns:
+    dict: "best", "median" (seconds), "repeats" and "per_row_us" (best time per row in microseconds).
+    """
+    data  = benchmark.setup(n)
+    times = []
+
+    while len(times) < repeats and (not times or sum(times) < time_budget):
+        start = time.perf_counter()
+        benchmark.run(data)
+        times.append(time.perf_counter() - start)
+
+    best = min(times)
+
+    return {
+        "best": best,
+        "median": statistics.median(times),
+        "repeats": len(times),
+        "per_row_us": best / n * 1e6
+    }
+
+def run_metadata():
+    """Environment of a run, stored with baselines (timings are only comparable on the same machine/versions)."""
+    import numpy as np
+    import pandas as pd
+
+    return {
+        "created": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__
+    }
+
+def parse_thresholds(values):
+    """--threshold-for NAME=RATIO values -> {name: ratio}."""
+    thresholds = {}
+
+    for value in values or []:
+        name, sep, ratio = value.partition("=")
+
+        if not sep:
+            raise argparse.ArgumentTypeError(f"--threshold-for expects NAME=RATIO, got '{value}'")
+
+        thresholds[name] = float(ratio)
+
+    return thresholds
+
+def compare(results, baseline, threshold, thresholds, min_seconds):
+    """
+    Compare results against a baseline.
+
+    Parameters:
+    results (dict): {benchmark: {size: timing}} of this run.
+    baseline (dict): {benchmark: {size: timing}} of the baseline.
+    threshold (float): Default max ratio of the best time to the baseline best time.
+    thresholds (dict): Per benchmark max ratios.
+    min_seconds (float): Slowdowns smaller than this many seconds are noise, never regressions.
+
+    Returns:
+    list: Comparison rows ({"benchmark", "size", "ratio", "threshold", "regression"}).
+    """
+    rows = []
+
+    for name, sizes in results.items():
+        for size, timing in sizes.items():
+            base = baseline.get(name, {}).get(size)
+
+            if base is None:
+                continue
+
+            limit = thresholds.get(name, threshold)
+            ratio = timing["best"] / base["best"] if base["best"] > 0 else float("inf")
+
+            rows.append({
+                "benchmark": name,
+                "size": size,
+                "ratio": ratio,
+                "threshold": limit,
+                "regression": ratio > limit and timing["best"] - base["best"] > min_seconds
+            })
+
+    return rows
+
+def print_results(results, comparison):
+    """Print the timings (and their ratio to the baseline) as a table."""
+    ratios = {(row["benchmark"], row["size"]): row for row in comparison}
+
+    print(f"{'benchmark':<24}{'rows':>10}{'best s':>12}{'median s':>12}{'us/row':>10}{'runs':>6}{'vs base':>10}")
+
+    for name, sizes in results.items():
+        for size, timing in sizes.items():
+            row  = ratios.get((name, size))
+            note = ""
+
+            if row is not None:
+                note = f"{row['ratio']:.2f}x" + (" REGRESSION" if row["regression"] else "")
+
+            print(f"{name:<24}{int(size):>10}{timing['best']:>12.4f}{timing['median']:>12.4f}"
+                  f"{timing['per_row_us']:>10.2f}{timing['repeats']:>6}  {note}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the MRoS pipeline lambda hot paths.")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in DEFAULT_SIZES),
+                        help="Comma separated row counts (default: 1k, 10k, 100k and 1M).")
+    parser.add_argument("--only", default=None, help="Comma separated benchmark names to run (default: all).")
+    parser.add_argument("--list", action="store_true", help="List the benchmark names and exit.")
+    parser.add_argument("--repeats", type=int, default=5, help="Max timed runs per benchmark and size.")
+    parser.add_argument("--time-budget", type=float, default=30.0,
+                        help="Stop repeating a benchmark/size after this many seconds of timed runs.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store this run's timings in the baseline file (replacing the benchmark/sizes that ran).")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Max ratio of a best time to its baseline before it counts as a regression.")
+    parser.add_argument("--threshold-for", action="append", metavar="NAME=RATIO",
+                        help="Per benchmark threshold (repeatable).")
+    parser.add_argument("--min-seconds", type=float, default=0.005,
+                        help="Noise floor: slowdowns smaller than this are never regressions.")
+    parser.add_argument("--json", default=None, help="Write the timings and the comparison to this JSON file.")
+    args = parser.parse_args(argv)
+
+    benchmarks = make_benchmarks(import_lambdas())
+
+    if args.list:
+        print("\n".join(benchmark.name for benchmark in benchmarks))
+        return 0
+
+    if args.only:
+        names   = args.only.split(",")
+        unknown = set(names) - {benchmark.name for benchmark in benchmarks}
+
+        if unknown:
+            parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+        benchmarks = [benchmark for benchmark in benchmarks if benchmark.name in names]
+
+    sizes      = [int(size) for size in args.sizes.split(",")]
+    thresholds = parse_thresholds(args.threshold_for)
+
+    # sizes are strings in the results so they round trip through JSON
+    results = {}
+
+    for benchmark in benchmarks:
+        results[benchmark.name] = {}
+
+        for n in sizes:
+            print(f"Running {benchmark.name} ({n} rows)...", file=sys.stderr)
+            results[benchmark.name][str(n)] = time_benchmark(benchmark, n, args.repeats, args.time_budget)
+
+    baseline = {"meta": {}, "results": {}}
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    comparison = compare(results, baseline["results"], args.threshold, thresholds, args.min_seconds)
+
+    print_results(results, comparison)
+
+    regressions = [row for row in comparison if row["regression"]]
+
+    if comparison:
+        print(f"\nCompared {len(comparison)} timings against '{args.baseline}' ({baseline['meta'].get('created')}): "
+              f"{len(regressions)} regression(s)")
+    else:
+        print(f"\nNo baseline timings to compare against in '{args.baseline}'")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"meta": run_metadata(), "results": results, "comparison": comparison}, f, indent=2)
+
+    if args.save_baseline:
+        for name, timings in results.items():
+            baseline["results"].setdefault(name, {}).update(timings)
+
+        baseline["meta"] = run_metadata()
+
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+
+        print(f"Saved baseline to '{args.baseline}'")
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
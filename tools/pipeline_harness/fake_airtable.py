@@ -0,0 +1,359 @@
+# Description: Local stand-in for the Airtable REST API list records endpoint (GET /v0/<base>/<table>), so
+# fetch_airtable_data() in mros_airtable_to_sqs can be load tested offline against realistic volumes instead of the
+# real base (rate limited, real user data). Point the lambda at it with AIRTABLE_API_URL=<server url>/v0.
+# Like the real API it:
+#   - pages through the records with an opaque `offset` (at most pageSize, default and max 100, records per page)
+#   - filters on filterByFormula equality formulas, e.g. {date_submitted_utc}='06/15/24'
+#   - checks the bearer token (401), the base/table (404) and the formula/offset (422)
+#   - rate limits requests per second per base (429), optionally locking the client out for a penalty period
+#     (the real API: 5 requests/s, 30 s)
+# and on top of that injects latency (base + jitter) and random 429/5xx responses. The records are either a fixed
+# list (e.g. a JSON file) or generated per date with synthetic.observation_records() (the same records for the same
+# date and seed, so a load test knows how many records each date should return).
+#
+# Usage: python tools/pipeline_harness/fake_airtable.py serve --port 8787 --records-per-day 5000 \
+#            --latency-ms 150 --jitter-ms 50 --error-rate-429 0.02 --error-rate-5xx 0.01 --rate-limit 5
+#        python tools/pipeline_harness/fake_airtable.py generate --start 06/01/24 --days 7 --records-per-day 500 \
+#            --out records.json
+#        from pipeline_harness import fake_airtable
+#        with fake_airtable.FakeAirtable(records_per_day=2000, error_rate_429=0.05) as server: ... server.api_url
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HARNESS_DIR))
+
+from pipeline_harness import synthetic
+
+# max (and default) records per page of the real API
+MAX_PAGE_SIZE = 100
+
+# field the lambda filters on, generated tables can only be listed one date at a time
+DATE_FIELD = "date_submitted_utc"
+
+# {field}='value' (or "value") formulas
+EQUALITY_FORMULA = re.compile(r"""^\s*\{([^}]+)\}\s*=\s*(?:'([^']*)'|"([^"]*)")\s*$""")
+
+# status codes of the injected server errors
+SERVER_ERRORS = [500, 502, 503]
+
+def error_body(error_type, message):
+    """Error response body in the Airtable format."""
+    return {"error": {"type": error_type, "message": message}}
+
+class FakeAirtable:
+    """
+    Fake Airtable list records API served over HTTP from a background thread.
+
+    Parameters:
+    records (list): Fixed table of Airtable records (None generates records per date, see below).
+    records_per_day (int): Records generated for each date_submitted_utc that is asked for.
+    seed (int): Seed of the generated records and of the injected faults.
+    base_id, table_id (str): Base and table served (other ids get a 404).
+    token (str): Bearer token the requests must send.
+    page_size (int): Default records per page.
+    error_rate_429 (float): Share of the requests answered with a random 429.
+    error_rate_5xx (float): Share of the requests answered with a 500/502/503.
+    latency_ms, jitter_ms (float): Response latency (base + uniform jitter).
+    rate_limit (float): Max requests per second per base before 429s (None for no limit).
+    penalty_s (float): After a rate limit 429, answer every request of the base with 429 for this long.
+    host, port (str, int): Address to listen on (port 0 picks a free port).
+    """
+
+    def __init__(self, records=None, records_per_day=1000, seed=0, base_id="appFakeMRoS", table_id="tblFakeMRoS",
+                 token="fake-airtable-token", page_size=MAX_PAGE_SIZE, error_rate_429=0.0, error_rate_5xx=0.0,
+                 latency_ms=0.0, jitter_ms=0.0, rate_limit=None, penalty_s=0.0, host="127.0.0.1", port=0):
+        self.records         = records
+        self.records_per_day = records_per_day
+        self.seed            = seed
+        self.base_id         = base_id
+        self.table_id        = table_id
+        self.token           = token
+        self.page_size       = min(page_size, MAX_PAGE_SIZE)
+        self.error_rate_429  = error_rate_429
+        self.error_rate_5xx  = error_rate_5xx
+        self.latency_ms      = latency_ms
+        self.jitter_ms       = jitter_ms
+        self.rate_limit      = rate_limit
+        self.penalty_s       = penalty_s
+
+        self.rng          = random.Random(seed)
+        self.lock         = threading.Lock()
+        self.days         = {}
+        self.iterators    = {}
+        self.requests     = deque()
+        self.locked_until = 0.0
+        self.stats        = defaultdict(int)
+
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        """Root URL of the server, e.g. http://127.0.0.1:8787."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        """API base URL (AIRTABLE_API_URL of the lambda), e.g. http://127.0.0.1:8787/v0."""
+        return f"{self.url}/v0"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-airtable", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def day_records(self, date):
+        """Generated records of a date_submitted_utc ("MM/DD/YY"), cached."""
+        with self.lock:
+            if date not in self.days:
+                self.days[date] = synthetic.observation_records(date, self.records_per_day, self.seed)
+
+            return self.days[date]
+
+    def matching_records(self, formula):
+        """
+        Records matching a filterByFormula.
+
+        Returns:
+        list: Records, or None when the formula is not supported.
+        """
+        if not formula:
+            return self.records
+
+        match = EQUALITY_FORMULA.match(formula)
+
+        if not match:
+            return None
+
+        field, value = match.group(1), match.group(2) if match.group(2) is not None else match.group(3)
+
+        if self.records is not None:
+            return [record for record in self.records if str(record["fields"].get(field, "")) == value]
+
+        if field != DATE_FIELD:
+            return None
+
+        try:
+            datetime.strptime(value, "%m/%d/%y")
+        except ValueError:
+            return []
+
+        return self.day_records(value)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def _fault(self):
+        """Status code and body of an injected/rate limit error for a request arriving now, or None."""
+        now = time.monotonic()
+
+        with self.lock:
+            if now < self.locked_until:
+                return 429, error_body("RATE_LIMIT_REACHED", "Rate limit exceeded, still in the penalty period")
+
+            if self.rate_limit:
+                while self.requests and self.requests[0] <= now - 1:
+                    self.requests.popleft()
+
+                if len(self.requests) >= self.rate_limit:
+                    self.locked_until = now + self.penalty_s
+                    return 429, error_body("RATE_LIMIT_REACHED", f"Rate limit of {self.rate_limit} requests/s exceeded")
+
+                self.requests.append(now)
+
+            draw = self.rng.random()
+
+            if draw < self.error_rate_429:
+                return 429, error_body("RATE_LIMIT_REACHED", "Injected rate limit")
+
+            if draw < self.error_rate_429 + self.error_rate_5xx:
+                return self.rng.choice(SERVER_ERRORS), error_body("SERVER_ERROR", "Injected server error")
+
+        return None
+
+    def list_records(self, path, query, headers):
+        """
+        Answer a list records request.
+
+        Returns:
+        tuple: (status code, response body dict).
+        """
+        if self.latency_ms or self.jitter_ms:
+            time.sleep((self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000)
+
+        if headers.get("Authorization") != f"Bearer {self.token}":
+            return 401, error_body("AUTHENTICATION_REQUIRED", "Authentication required")
+
+        fault = self._fault()
+        if fault:
+            return fault
+
+        parts = [part for part in path.split("/") if part]
+
+        if len(parts) != 3 or parts[0] != "v0" or parts[1] != self.base_id or parts[2] != self.table_id:
+            return 404, error_body("NOT_FOUND", f"Could not find table {'/'.join(parts[1:])}")
+
+        formula = query.get("filterByFormula", [""])[0]
+        offset  = query.get("offset", [None])[0]
+
+        try:
+            page_size = min(int(query.get("pageSize", [self.page_size])[0]), MAX_PAGE_SIZE)
+        except ValueError:
+            return 422, error_body("INVALID_REQUEST_UNKNOWN", "pageSize must be an integer")
+
+        if offset:
+            with self.lock:
+                iterator = self.iterators.pop(offset, None)
+
+            if iterator is None or iterator[0] != formula:
+                return 422, error_body("LIST_RECORDS_ITERATOR_NOT_AVAILABLE", "Invalid or expired offset")
+
+            start = iterator[1]
+        else:
+            start = 0
+
+        records = self.matching_records(formula)
+
+        if records is None:
+            message = f"Unsupported formula: {formula}" if formula else f"Generated tables need a {{{DATE_FIELD}}}='MM/DD/YY' filter"
+            return 422, error_body("INVALID_FILTER_BY_FORMULA", message)
+
+        page = records[start:start + max(1, page_size)]
+        body = {"records": page}
+
+        if start + len(page) < len(records):
+            token = f"itr{uuid.uuid4().hex[:14]}/{page[-1]['id']}"
+
+            with self.lock:
+                self.iterators[token] = (formula, start + len(page))
+
+            body["offset"] = token
+
+        self.count("pages")
+        self.count("records", len(page))
+
+        return 200, body
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        fake  = self.server.fake
+        url   = urlsplit(self.path)
+        query = parse_qs(url.query)
+
+        status, body = fake.list_records(url.path, query, self.headers)
+
+        fake.count("requests")
+        fake.count(f"status_{status}")
+
+        data = json.dumps(body).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # no access log, the counters are in FakeAirtable.stats
+        pass
+
+def date_range(start, days):
+    """days dates in the Airtable filter format ("MM/DD/YY"), from start."""
+    first = datetime.strptime(start, "%m/%d/%y")
+    return [(first + timedelta(days=i)).strftime("%m/%d/%y") for i in range(days)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Airtable list records API (and record generator) for load tests.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Serve the fake API until interrupted.")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8787)
+    serve.add_argument("--records", default=None, help="JSON file of Airtable records to serve (default: generated).")
+    serve.add_argument("--records-per-day", type=int, default=1000, help="Records generated per date.")
+    serve.add_argument("--seed", type=int, default=0)
+    serve.add_argument("--base-id", default="appFakeMRoS")
+    serve.add_argument("--table-id", default="tblFakeMRoS")
+    serve.add_argument("--token", default="fake-airtable-token")
+    serve.add_argument("--page-size", type=int, default=MAX_PAGE_SIZE, help="Default records per page (max 100).")
+    serve.add_argument("--latency-ms", type=float, default=0.0, help="Base response latency.")
+    serve.add_argument("--jitter-ms", type=float, default=0.0, help="Extra uniform random latency.")
+    serve.add_argument("--error-rate-429", type=float, default=0.0, help="Share of random 429 responses.")
+    serve.add_argument("--error-rate-5xx", type=float, default=0.0, help="Share of random 500/502/503 responses.")
+    serve.add_argument("--rate-limit", type=float, default=None, help="Requests per second per base (Airtable: 5).")
+    serve.add_argument("--penalty-s", type=float, default=0.0, help="429 lockout after exceeding the rate limit (Airtable: 30).")
+
+    generate = commands.add_parser("generate", help="Write generated Airtable records to a JSON file.")
+    generate.add_argument("--start", required=True, help="First date (MM/DD/YY).")
+    generate.add_argument("--days", type=int, default=1)
+    generate.add_argument("--records-per-day", type=int, default=1000)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--out", required=True, help="Output JSON file (list of records).")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        records = [record for date in date_range(args.start, args.days)
+                   for record in synthetic.observation_records(date, args.records_per_day, args.seed)]
+
+        with open(args.out, "w") as f:
+            json.dump(records, f)
+
+        print(f"Wrote {len(records)} records to {args.out}")
+        return 0
+
+    records = None
+    if args.records:
+        with open(args.records) as f:
+            records = json.load(f)
+
+    server = FakeAirtable(records, args.records_per_day, args.seed, args.base_id, args.table_id, args.token,
+                          args.page_size, args.error_rate_429, args.error_rate_5xx, args.latency_ms, args.jitter_ms,
+                          args.rate_limit, args.penalty_s, args.host, args.port)
+
+    print(f"Fake Airtable API on {server.api_url}")
+    print(f"  AIRTABLE_API_URL={server.api_url} BASE_ID={args.base_id} TABLE_ID={args.table_id} AIRTABLE_TOKEN={args.token}")
+
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+        print(json.dumps(dict(server.stats), indent=2))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,607 @@
+# Description: In-process stand-ins for the AWS services used by the MRoS pipeline lambdas (S3, SQS, SNS envelopes
+# and DynamoDB), so the four Python handlers can run together on a laptop without live AWS.
+# - FakeS3:       objects in memory with ETags, conditional reads/writes (IfNoneMatch/IfMatch) and bucket
+#                 notifications (S3 event records, filtered by key suffix like the infra/s3_events.tf rules)
+# - FakeQueue:    SQS queue with batched receives, visibility (messages that are not deleted are redelivered)
+#                 and a dead-letter list after max_receives
+# - FakeDynamoDB: BatchWriteItem/BatchGetItem/PutItem/GetItem on in-memory tables, with optional throttling
+#                 (UnprocessedItems) to exercise the retry paths
+# - sns_envelope(): wraps an S3 event the way SNS delivers it to SQS and to Lambda
+# Every API call is counted per pipeline stage (ApiCounter), and install() patches boto3.client, the awswrangler
+# S3 helpers and the fsspec "s3" protocol (pandas to_csv("s3://...")) so the handlers talk to the fakes.
+# Usage: from pipeline_harness import fake_aws
+# Author: Angus Watters
+
+# general utility libraries
+import io
+import json
+import math
+import time
+import uuid
+import random
+import hashlib
+import threading
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from botocore.exceptions import ClientError
+
+def utc_now():
+    """Current UTC time in the millisecond ISO 8601 format S3 uses for eventTime."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def split_uri(uri):
+    """Split "s3://bucket/key" into (bucket, key)."""
+    bucket, key = uri.replace("s3://", "").replace("s3a://", "").split("/", 1)
+    return bucket, key
+
+def client_error(code, operation, message=""):
+    """Build a botocore ClientError with the given error code."""
+    return ClientError({"Error": {"Code": code, "Message": message or code}}, operation)
+
+class ApiCounter:
+    """
+    Counts API calls by pipeline stage and operation (e.g. {"mros_stage_to_prod": {"s3.GetObject": 40}}).
+    The harness sets the current stage before invoking each handler.
+    """
+    def __init__(self):
+        self.stage  = "harness"
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.lock   = threading.Lock()
+
+    def count(self, operation, n=1):
+        with self.lock:
+            self.counts[self.stage][operation] += n
+
+    def by_stage(self):
+        return {stage: dict(sorted(ops.items())) for stage, ops in self.counts.items()}
+
+class FakeBody(io.BytesIO):
+    """S3 StreamingBody stand-in (read(), iter_chunks() and close())."""
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+class FakeS3:
+    """
+    In-memory S3 with the subset of the client API used by the lambdas.
+
+    Parameters:
+    counter (ApiCounter): API call counter.
+    error_rate (float): Fraction of GetObject calls on notified objects that fail with an "InternalError"
+                        (exercises SQS redelivery and Lambda retries).
+    rng (random.Random): Random number generator for the injected errors.
+    """
+    def __init__(self, counter, error_rate=0.0, rng=None):
+        self.counter       = counter
+        self.error_rate    = error_rate
+        self.rng           = rng or random.Random(0)
+        self.objects       = {}
+        self.notifications = defaultdict(list)
+        self.lock          = threading.Lock()
+
+    # --- harness helpers ---
+    def add_notification(self, bucket, suffix, callback):
+        """Call callback(s3_event) for each object created in bucket with a key ending in suffix."""
+        self.notifications[bucket].append((suffix, callback))
+
+    def put_bytes(self, bucket, key, data, if_match=None, if_none_match=None, metadata=None):
+        """
+        Store an object and send its notifications, returns the new ETag.
+        if_match/if_none_match are checked atomically with the write (like S3 conditional writes).
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        data = bytes(data)
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+        with self.lock:
+            current = self.objects.get((bucket, key))
+
+            if if_none_match == "*" and current is not None:
+                raise client_error("PreconditionFailed", "PutObject")
+
+            if if_match is not None and (current is None or current["etag"] != if_match):
+                raise client_error("PreconditionFailed", "PutObject")
+
+            self.objects[(bucket, key)] = {"data": data, "etag": etag, "modified": datetime.now(timezone.utc),
+                                           "metadata": dict(metadata or {})}
+
+        for suffix, callback in self.notifications.get(bucket, []):
+            if key.endswith(suffix):
+                callback(s3_event(bucket, key, len(data), etag))
+
+        return etag
+
+    def get_bytes(self, bucket, key, operation="GetObject"):
+        with self.lock:
+            obj = self.objects.get((bucket, key))
+
+        if obj is None:
+            raise client_error("NoSuchKey", operation, f"s3://{bucket}/{key} does not exist")
+
+        if self.error_rate and self.notifications.get(bucket) and self.rng.random() < self.error_rate:
+            raise client_error("InternalError", operation, "injected error")
+
+        return obj
+
+    def exists(self, bucket, key):
+        with self.lock:
+            return (bucket, key) in self.objects
+
+    def keys(self, bucket, prefix=""):
+        with self.lock:
+            return sorted(key for b, key in self.objects if b == bucket and key.startswith(prefix))
+
+    # --- boto3 client API ---
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.counter.count("s3.GetObject")
+        obj = self.get_bytes(Bucket, Key)
+
+        if IfNoneMatch is not None and IfNoneMatch == obj["etag"]:
+            raise client_error("304", "GetObject", "Not Modified")
+
+        return {"Body": FakeBody(obj["data"]), "ETag": obj["etag"], "ContentLength": len(obj["data"]),
+                "LastModified": obj["modified"], "Metadata": dict(obj["metadata"])}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.counter.count("s3.HeadObject")
+
+        with self.lock:
+            obj = self.objects.get((Bucket, Key))
+
+        if obj is None:
+            raise client_error("404", "HeadObject", "Not Found")
+
+        return {"ETag": obj["etag"], "ContentLength": len(obj["data"]), "LastModified": obj["modified"],
+                "Metadata": dict(obj["metadata"])}
+
+    def put_object(self, Bucket, Key, Body=b"", IfMatch=None, IfNoneMatch=None, Metadata=None, **kwargs):
+        self.counter.count("s3.PutObject")
+
+        if hasattr(Body, "read"):
+            Body = Body.read()
+
+        return {"ETag": self.put_bytes(Bucket, Key, Body, if_match=IfMatch, if_none_match=IfNoneMatch,
+                                       metadata=Metadata)}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.counter.count("s3.CopyObject")
+        obj = self.get_bytes(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+
+        return {"CopyObjectResult": {"ETag": self.put_bytes(Bucket, Key, obj["data"])}}
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        self.counter.count("s3.ListObjectsV2")
+
+        with self.lock:
+            contents = [{"Key": key, "Size": len(obj["data"]), "ETag": obj["etag"], "LastModified": obj["modified"]}
+                        for (bucket, key), obj in sorted(self.objects.items())
+                        if bucket == Bucket and key.startswith(Prefix)]
+
+        return {"Contents": contents, "KeyCount": len(contents), "IsTruncated": False}
+
+    def list_objects(self, Bucket, Prefix="", **kwargs):
+        return self.list_objects_v2(Bucket, Prefix)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.counter.count("s3.DeleteObject")
+
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self.counter.count("s3.DeleteObjects")
+
+        if len(Delete["Objects"]) > 1000:
+            raise client_error("MalformedXML", "DeleteObjects")
+
+        with self.lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop((Bucket, obj["Key"]), None)
+
+        return {"Deleted": [] if Delete.get("Quiet") else [{"Key": obj["Key"]} for obj in Delete["Objects"]]}
+
+def s3_event(bucket, key, size, etag):
+    """S3 event notification (as sent to SQS/SNS) for a created object."""
+    return {
+        "Records": [{
+            "eventVersion": "2.1",
+            "eventSource": "aws:s3",
+            "eventTime": utc_now(),
+            "eventName": "ObjectCreated:Put",
+            "s3": {
+                "bucket": {"name": bucket, "arn": f"arn:aws:s3:::{bucket}"},
+                "object": {"key": key, "size": size, "eTag": etag.strip('"')}
+            }
+        }]
+    }
+
+def sns_envelope(topic_arn, message):
+    """SNS notification as delivered to an SQS subscriber (the message body)."""
+    return {
+        "Type": "Notification",
+        "MessageId": str(uuid.uuid4()),
+        "TopicArn": topic_arn,
+        "Subject": "Amazon S3 Notification",
+        "Message": json.dumps(message),
+        "Timestamp": utc_now()
+    }
+
+def sns_lambda_event(topic_arn, message):
+    """SNS notification as delivered to a Lambda subscriber (the event)."""
+    envelope = sns_envelope(topic_arn, message)
+
+    return {"Records": [{"EventSource": "aws:sns", "EventVersion": "1.0", "Sns": envelope}]}
+
+class FakeQueue:
+    """
+    SQS queue with batched receives and redelivery.
+    Received messages are in flight until they are deleted or released, released messages are received again
+    (ApproximateReceiveCount goes up) until max_receives, after which they go to the dead-letter list.
+    """
+    def __init__(self, name, max_receives=3):
+        self.name         = name
+        self.url          = f"https://sqs.us-west-1.amazonaws.com/000000000000/{name}"
+        self.arn          = f"arn:aws:sqs:us-west-1:000000000000:{name}"
+        self.max_receives = max_receives
+        self.visible      = deque()
+        self.in_flight    = {}
+        self.dead_letter  = []
+        self.sent         = 0
+        self.redelivered  = 0
+        self.lock         = threading.Lock()
+
+    def send(self, body):
+        message = {"messageId": str(uuid.uuid4()), "body": body, "receive_count": 0,
+                   "sent_timestamp": int(time.time() * 1000)}
+
+        with self.lock:
+            self.visible.append(message)
+            self.sent += 1
+
+        return message["messageId"]
+
+    def __len__(self):
+        return len(self.visible)
+
+    def receive(self, max_messages):
+        """Receive up to max_messages as Lambda SQS event records."""
+        records = []
+
+        with self.lock:
+            while self.visible and len(records) < max_messages:
+                message = self.visible.popleft()
+                message["receive_count"] += 1
+                receipt = uuid.uuid4().hex
+                self.in_flight[message["messageId"]] = message
+
+                records.append({
+                    "messageId": message["messageId"],
+                    "receiptHandle": receipt,
+                    "body": message["body"],
+                    "attributes": {
+                        "ApproximateReceiveCount": str(message["receive_count"]),
+                        "SentTimestamp": str(message["sent_timestamp"]),
+                        "ApproximateFirstReceiveTimestamp": str(int(time.time() * 1000))
+                    },
+                    "messageAttributes": {},
+                    "eventSource": "aws:sqs",
+                    "eventSourceARN": self.arn,
+                    "awsRegion": "us-west-1"
+                })
+
+        return records
+
+    def delete(self, message_ids):
+        with self.lock:
+            for message_id in message_ids:
+                self.in_flight.pop(message_id, None)
+
+    def release(self, message_ids):
+        """Make in-flight messages visible again (visibility timeout ran out), or dead-letter them."""
+        with self.lock:
+            for message_id in message_ids:
+                message = self.in_flight.pop(message_id, None)
+
+                if message is None:
+                    continue
+
+                if message["receive_count"] >= self.max_receives:
+                    self.dead_letter.append(message)
+                else:
+                    self.visible.append(message)
+                    self.redelivered += 1
+
+class FakeSQS:
+    """SQS client stand-in (send_message/send_message_batch) routing by queue URL."""
+    def __init__(self, counter):
+        self.counter = counter
+        self.queues  = {}
+
+    def add_queue(self, queue):
+        self.queues[queue.url] = queue
+        return queue
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.counter.count("sqs.SendMessage")
+
+        return {"MessageId": self.queues[QueueUrl].send(MessageBody)}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.counter.count("sqs.SendMessageBatch")
+
+        if len(Entries) > 10:
+            raise client_error("AWS.SimpleQueueService.TooManyEntriesInBatchRequest", "SendMessageBatch")
+
+        successful = [{"Id": entry["Id"], "MessageId": self.queues[QueueUrl].send(entry["MessageBody"])}
+                      for entry in Entries]
+
+        return {"Successful": successful, "Failed": []}
+
+def item_size(item):
+    """Approximate size (bytes) of a DynamoDB item in AttributeValue format."""
+    return len(json.dumps(item, separators=(",", ":")))
+
+class FakeDynamoDB:
+    """
+    DynamoDB client stand-in over in-memory tables (dict of key -> item).
+
+    Parameters:
+    counter (ApiCounter): API call counter.
+    key_attribute (str): Partition key attribute of every table.
+    unprocessed_rate (float): Fraction of BatchWriteItem items returned as UnprocessedItems (throttling).
+    rng (random.Random): Random number generator for the throttling.
+    keep_items (bool): Store written items (False only counts writes, e.g. for benchmarks of millions of items).
+    """
+    def __init__(self, counter, key_attribute="record_hash", unprocessed_rate=0.0, rng=None, keep_items=True):
+        self.counter          = counter
+        self.key_attribute    = key_attribute
+        self.unprocessed_rate = unprocessed_rate
+        self.rng              = rng or random.Random(0)
+        self.keep_items       = keep_items
+        self.tables           = defaultdict(dict)
+        self.write_times      = {}
+        self.lock             = threading.Lock()
+
+    def _key(self, item):
+        value = item[self.key_attribute]
+        return next(iter(value.values()))
+
+    def _put(self, table_name, item):
+        if not self.keep_items:
+            return math.ceil(item_size(item) / 1024)
+
+        key = self._key(item)
+
+        with self.lock:
+            self.tables[table_name][key] = item
+            self.write_times.setdefault(key, time.time())
+
+        return math.ceil(item_size(item) / 1024)
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.counter.count("dynamodb.BatchWriteItem")
+
+        unprocessed = defaultdict(list)
+        capacity    = []
+
+        for table_name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise client_error("ValidationException", "BatchWriteItem", "Too many items requested")
+
+            wcu = 0
+
+            for request in requests:
+                if self.unprocessed_rate and self.rng.random() < self.unprocessed_rate:
+                    unprocessed[table_name].append(request)
+                    continue
+
+                wcu += self._put(table_name, request["PutRequest"]["Item"])
+
+            capacity.append({"TableName": table_name, "CapacityUnits": float(wcu)})
+
+        return {"UnprocessedItems": dict(unprocessed), "ConsumedCapacity": capacity}
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.counter.count("dynamodb.PutItem")
+        wcu = self._put(TableName, Item)
+
+        return {"ConsumedCapacity": {"TableName": TableName, "CapacityUnits": float(wcu)}}
+
+    def _project(self, item, projection, names):
+        if not projection:
+            return item
+
+        attributes = [names.get(name.strip(), name.strip()) for name in projection.split(",")]
+
+        return {name: item[name] for name in attributes if name in item}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.counter.count("dynamodb.BatchGetItem")
+
+        responses = {}
+        capacity  = []
+
+        for table_name, request in RequestItems.items():
+            if len(request["Keys"]) > 100:
+                raise client_error("ValidationException", "BatchGetItem", "Too many items requested")
+
+            names = request.get("ExpressionAttributeNames", {})
+
+            with self.lock:
+                table = self.tables[table_name]
+                found = [table[self._key(key)] for key in request["Keys"] if self._key(key) in table]
+
+            responses[table_name] = [self._project(item, request.get("ProjectionExpression"), names) for item in found]
+            capacity.append({"TableName": table_name,
+                             "CapacityUnits": sum(math.ceil(item_size(item) / 4096) * 0.5 for item in found)})
+
+        return {"Responses": responses, "UnprocessedKeys": {}, "ConsumedCapacity": capacity}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.counter.count("dynamodb.GetItem")
+
+        with self.lock:
+            item = self.tables[TableName].get(self._key(Key))
+
+        return {"Item": item} if item is not None else {}
+
+class FakeWrangler:
+    """
+    Stand-ins for the awswrangler.s3 functions used by the lambdas, reading and writing FakeS3 objects.
+    """
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def _get(self, path):
+        bucket, key = split_uri(path)
+        self.s3.counter.count("s3.GetObject")
+        return io.BytesIO(self.s3.get_bytes(bucket, key)["data"])
+
+    def _put(self, path, data):
+        bucket, key = split_uri(path)
+        self.s3.counter.count("s3.PutObject")
+        self.s3.put_bytes(bucket, key, data)
+
+    def read_csv(self, path, boto3_session=None, **kwargs):
+        return pd.read_csv(self._get(path), **kwargs)
+
+    def read_parquet(self, path, columns=None, boto3_session=None, **kwargs):
+        return pd.read_parquet(self._get(path), columns=columns)
+
+    def to_csv(self, df, path, boto3_session=None, **kwargs):
+        self._put(path, df.to_csv(**kwargs).encode("utf-8"))
+        return {"paths": [path]}
+
+    def to_parquet(self, df, path, boto3_session=None, **kwargs):
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=kwargs.get("index", False), compression=kwargs.get("compression", "snappy"))
+        self._put(path, buffer.getvalue())
+        return {"paths": [path]}
+
+    def upload(self, local_file, path, boto3_session=None, **kwargs):
+        if isinstance(local_file, str):
+            with open(local_file, "rb") as f:
+                data = f.read()
+        else:
+            data = local_file.read()
+
+        self._put(path, data)
+
+    def does_object_exist(self, path, boto3_session=None, **kwargs):
+        bucket, key = split_uri(path)
+        self.s3.counter.count("s3.HeadObject")
+        return self.s3.exists(bucket, key)
+
+# functions of awswrangler.s3 replaced by install()
+WRANGLER_FUNCTIONS = ["read_csv", "read_parquet", "to_csv", "to_parquet", "upload", "does_object_exist"]
+
+def _fsspec_filesystem(s3):
+    """Build an fsspec filesystem class for the "s3" protocol backed by FakeS3 (used by pandas for "s3://" paths)."""
+    from fsspec.spec import AbstractFileSystem
+
+    class UploadOnClose(io.BytesIO):
+        def __init__(self, path):
+            super().__init__()
+            self.path = path
+
+        def close(self):
+            if not self.closed:
+                bucket, key = split_uri(self.path)
+                s3.counter.count("s3.PutObject")
+                s3.put_bytes(bucket, key, self.getvalue())
+            super().close()
+
+    class FakeS3FileSystem(AbstractFileSystem):
+        protocol = ("s3", "s3a")
+        cachable = False
+
+        def _open(self, path, mode="rb", **kwargs):
+            path = self._strip_protocol(path)
+
+            if "r" in mode:
+                bucket, key = split_uri(path)
+                s3.counter.count("s3.GetObject")
+                return io.BytesIO(s3.get_bytes(bucket, key)["data"])
+
+            return UploadOnClose(path)
+
+    return FakeS3FileSystem
+
+class FakeAWS:
+    """
+    The fake services of one harness run, and the patches that route the lambdas to them.
+
+    Parameters:
+    seed (int): Seed of the random number generator used for injected errors and throttling.
+    s3_error_rate (float): See FakeS3.
+    dynamodb_unprocessed_rate (float): See FakeDynamoDB.
+    keep_dynamodb_items (bool): See FakeDynamoDB keep_items.
+    """
+    def __init__(self, seed=0, s3_error_rate=0.0, dynamodb_unprocessed_rate=0.0, keep_dynamodb_items=True):
+        rng = random.Random(seed)
+
+        self.counter  = ApiCounter()
+        self.s3       = FakeS3(self.counter, s3_error_rate, rng)
+        self.sqs      = FakeSQS(self.counter)
+        self.dynamodb = FakeDynamoDB(self.counter, unprocessed_rate=dynamodb_unprocessed_rate, rng=rng,
+                                      keep_items=keep_dynamodb_items)
+        self.wrangler = FakeWrangler(self.s3)
+        self._undo    = []
+
+    def client(self, service_name, *args, **kwargs):
+        """boto3.client() replacement."""
+        clients = {"s3": self.s3, "sqs": self.sqs, "dynamodb": self.dynamodb}
+
+        if service_name not in clients:
+            raise ValueError(f"No fake client for AWS service '{service_name}'")
+
+        return clients[service_name]
+
+    def _patch(self, obj, name, value):
+        self._undo.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def install(self):
+        """
+        Route boto3 clients, awswrangler S3 functions and pandas "s3://" paths to the fakes.
+        Must be called before the lambda modules are imported (they create their clients at import time).
+        """
+        import boto3
+
+        self._patch(boto3, "client", self.client)
+
+        try:
+            import awswrangler as wr
+        except ImportError:
+            wr = None
+
+        if wr is not None:
+            for name in WRANGLER_FUNCTIONS:
+                self._patch(wr.s3, name, getattr(self.wrangler, name))
+
+        try:
+            import fsspec
+        except ImportError:
+            fsspec = None
+
+        if fsspec is not None:
+            fsspec.register_implementation("s3", _fsspec_filesystem(self.s3), clobber=True)
+            fsspec.register_implementation("s3a", _fsspec_filesystem(self.s3), clobber=True)
+
+        return self
+
+    def uninstall(self):
+        """Undo the boto3/awswrangler patches."""
+        while self._undo:
+            obj, name, value = self._undo.pop()
+            setattr(obj, name, value)
@@ -0,0 +1,435 @@
+# Description: Offline end-to-end run of the MRoS pipeline lambdas against in-process AWS stand-ins (see fake_aws.py).
+# Synthetic Airtable records go through the same hops as in production:
+#   mros_airtable_to_sqs -> SQS -> add_climate_data (stand-in, writes staging JSON) -> S3 event -> SQS (batches of 40)
+#   -> mros_stage_to_prod -> prod CSV -> SNS -> SQS -> mros_append_daily_data
+#                                            SNS -> mros_insert_into_dynamodb
+# Failed SQS messages (exceptions, batchItemFailures) are redelivered until they reach the dead-letter list,
+# and failed SNS invocations are retried twice like asynchronous Lambda invocations.
+# The report lists records/s, invocation latency percentiles, log volume and API calls per stage, plus the end to end
+# latency of each record (SQS enqueue to DynamoDB write), so throughput regressions show up before a deploy.
+#
+# Usage: python tools/pipeline_harness/run_pipeline.py --records-per-day 200 --seed 1
+#        python tools/pipeline_harness/run_pipeline.py --records-per-day 1000 --s3-error-rate 0.02 --json report.json
+# NOTE: needs the Python packages of the four lambdas (lambdas/*/requirements.txt), no AWS credentials or network.
+# Author: Angus Watters
+
+# general utility libraries
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import importlib
+import contextlib
+from datetime import datetime, timezone
+
+import pandas as pd
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR    = os.path.dirname(os.path.dirname(HARNESS_DIR))
+
+# the lambdas are imported as packages (e.g. "from mros_append_daily_data import master_schema"), like in the zips
+sys.path.insert(0, os.path.join(REPO_DIR, "lambdas"))
+sys.path.insert(0, os.path.dirname(HARNESS_DIR))
+
+from pipeline_harness import fake_aws
+from pipeline_harness import synthetic
+
+# names of the fake resources
+STAGE_BUCKET     = "mros-harness-stage"
+PROD_BUCKET      = "mros-harness-prod"
+OUTPUT_BUCKET    = "mros-harness-output"
+OUTPUT_KEY       = "mros_output.csv"
+DYNAMODB_TABLE   = "mros-harness-table"
+OUTPUT_TOPIC_ARN = "arn:aws:sns:us-west-1:000000000000:mros-harness-output-topic"
+
+# batch sizes of the SQS event source mappings (see infra/lambda.tf)
+ENRICH_BATCH_SIZE = 1
+STAGE_BATCH_SIZE  = 40
+APPEND_BATCH_SIZE = 1
+
+# retries of a failed asynchronous (SNS) Lambda invocation
+ASYNC_RETRIES = 2
+
+# stage names, in pipeline order
+STAGES = ["mros_airtable_to_sqs", "add_climate_data", "mros_stage_to_prod", "mros_append_daily_data", "mros_insert_into_dynamodb"]
+
+def percentile(values, q):
+    """Nearest-rank percentile (q in 0-100) of a list of numbers, None for an empty list."""
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    rank    = max(1, int(round(q / 100 * len(ordered) + 0.5)))
+
+    return ordered[min(rank, len(ordered)) - 1]
+
+class CountingWriter(io.TextIOBase):
+    """stdout replacement that only counts the bytes written (the log volume of a stage)."""
+    def __init__(self, echo=None):
+        self.bytes = 0
+        self.echo  = echo
+
+    def write(self, text):
+        self.bytes += len(text.encode("utf-8"))
+
+        if self.echo is not None:
+            self.echo.write(text)
+
+        return len(text)
+
+class FakeContext:
+    """Lambda context stand-in."""
+    def __init__(self, function_name, timeout_s=900, memory_mb=1024):
+        self.function_name        = function_name
+        self.function_version     = "$LATEST"
+        self.invoked_function_arn = f"arn:aws:lambda:us-west-1:000000000000:function:{function_name}"
+        self.memory_limit_in_mb   = memory_mb
+        self.aws_request_id       = uuid.uuid4().hex
+        self.log_group_name       = f"/aws/lambda/{function_name}"
+        self.log_stream_name      = "harness"
+        self._deadline            = time.monotonic() + timeout_s
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+class StageStats:
+    """Invocation durations, record counts, errors and log bytes of one stage."""
+    def __init__(self, name):
+        self.name        = name
+        self.invocations = 0
+        self.records     = 0
+        self.errors      = 0
+        self.seconds     = 0.0
+        self.log_bytes   = 0
+        self.durations   = []
+
+    def add(self, seconds, records, error, log_bytes):
+        self.invocations += 1
+        self.records     += records
+        self.errors      += int(error is not None)
+        self.seconds     += seconds
+        self.log_bytes   += log_bytes
+        self.durations.append(seconds)
+
+    def summary(self, api_calls):
+        ms = [d * 1000 for d in self.durations]
+
+        return {
+            "invocations": self.invocations,
+            "records": self.records,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+            "records_per_second": round(self.records / self.seconds, 1) if self.seconds > 0 else None,
+            "latency_ms": {f"p{q}": round(percentile(ms, q), 2) if ms else None for q in (50, 95, 99)},
+            "max_ms": round(max(ms), 2) if ms else None,
+            "log_bytes": self.log_bytes,
+            "api_calls": api_calls
+        }
+
+class PipelineHarness:
+    """
+    Wires the four lambda handlers to the fake AWS services and pumps synthetic records through them.
+
+    Parameters:
+    records_per_day (int): Number of Airtable records returned for each date the airtable stage fetches.
+    seed (int): Random seed (synthetic records, injected errors).
+    s3_error_rate (float): Fraction of reads of notified objects (staging JSON, prod CSV) that fail.
+    dynamodb_unprocessed_rate (float): Fraction of DynamoDB batch write items returned as unprocessed.
+    max_receives (int): SQS receives before a message goes to the dead-letter list.
+    verbose (bool): Show the handlers' own log output.
+    """
+    def __init__(self, records_per_day=100, seed=0, s3_error_rate=0.0, dynamodb_unprocessed_rate=0.0,
+                 max_receives=3, verbose=False):
+        self.records_per_day = records_per_day
+        self.rng             = random.Random(seed)
+        self.verbose         = verbose
+        self.aws             = fake_aws.FakeAWS(seed, s3_error_rate, dynamodb_unprocessed_rate)
+        self.stats           = {stage: StageStats(stage) for stage in STAGES}
+        self.sent_times      = {}
+        self.sns_invocations = []
+
+        self.enrich_queue = self.aws.sqs.add_queue(fake_aws.FakeQueue("mros-harness-enrich", max_receives))
+        self.stage_queue  = self.aws.sqs.add_queue(fake_aws.FakeQueue("mros-harness-stage", max_receives))
+        self.append_queue = self.aws.sqs.add_queue(fake_aws.FakeQueue("mros-harness-prod-to-output", max_receives))
+
+        # S3 event notifications (see infra/s3_events.tf and infra/sns.tf)
+        self.aws.s3.add_notification(STAGE_BUCKET, ".json", lambda event: self.stage_queue.send(json.dumps(event)))
+        self.aws.s3.add_notification(PROD_BUCKET, ".csv", self.publish_output_event)
+
+    def publish_output_event(self, event):
+        """SNS topic of the prod bucket: one SQS subscriber (append) and one Lambda subscriber (DynamoDB insert)."""
+        self.append_queue.send(json.dumps(fake_aws.sns_envelope(OUTPUT_TOPIC_ARN, event)))
+        self.sns_invocations.append(fake_aws.sns_lambda_event(OUTPUT_TOPIC_ARN, event))
+
+    def load_handlers(self):
+        """Set the lambda environment variables, install the fakes and import the handler modules."""
+        self.cache_dir = tempfile.mkdtemp(prefix="mros_harness_")
+
+        os.environ.update({
+            "AWS_DEFAULT_REGION": "us-west-1",
+            "BASE_ID": "harness_base",
+            "TABLE_ID": "harness_table",
+            "AIRTABLE_TOKEN": "harness_token",
+            "SQS_QUEUE_URL": self.enrich_queue.url,
+            "S3_STAGE_BUCKET": STAGE_BUCKET,
+            "S3_PROD_BUCKET": PROD_BUCKET,
+            "S3_STAGE_BUCKET_URI": f"s3://{STAGE_BUCKET}",
+            "S3_PROD_BUCKET_URI": f"s3://{PROD_BUCKET}",
+            "OUTPUT_S3_BUCKET": OUTPUT_BUCKET,
+            "OUTPUT_OBJECT_KEY": OUTPUT_KEY,
+            "DYNAMODB_TABLE": DYNAMODB_TABLE,
+            "MASTER_CACHE_DIR": os.path.join(self.cache_dir, "master_cache"),
+        })
+
+        self.aws.install()
+
+        self.modules = {stage: importlib.import_module(f"{stage}.{stage}") for stage in STAGES if stage.startswith("mros_")}
+
+        # stand-in for the Airtable API
+        airtable = self.modules["mros_airtable_to_sqs"]
+        airtable.fetch_airtable_data = lambda date, *args, **kwargs: synthetic.airtable_records(date, self.records_per_day, self.rng)
+
+        from mros_append_daily_data import master_schema
+        self.enrichment_columns = master_schema.ENRICHMENT_COLUMNS
+
+    def invoke(self, stage, event, records):
+        """
+        Invoke a handler, timing it and counting its log bytes and API calls under the stage name.
+
+        Returns:
+        tuple: (handler return value, exception or None).
+        """
+        handler = getattr(self.modules[stage], stage)
+        writer  = CountingWriter(sys.stdout if self.verbose else None)
+
+        self.aws.counter.stage = stage
+        start = time.perf_counter()
+
+        try:
+            with contextlib.redirect_stdout(writer):
+                result, error = handler(event, FakeContext(stage)), None
+        except Exception as e:
+            result, error = None, e
+
+        self.stats[stage].add(time.perf_counter() - start, records, error, writer.bytes)
+        self.aws.counter.stage = "harness"
+
+        if error is not None and self.verbose:
+            print(f"{stage} raised: {error!r}")
+
+        return result, error
+
+    def run_airtable(self):
+        """Run the airtable stage once (fetches the two dates 6 and 7 days before the event time)."""
+        event = {"time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}
+        self.invoke("mros_airtable_to_sqs", event, 2 * self.records_per_day)
+
+    def run_enrichment(self):
+        """Stand-in for the add_climate_data R container: write one enriched staging JSON file per message."""
+        records = self.enrich_queue.receive(ENRICH_BATCH_SIZE)
+
+        if not records:
+            return False
+
+        self.aws.counter.stage = "add_climate_data"
+        start = time.perf_counter()
+
+        for record in records:
+            body = json.loads(record["body"])
+            self.sent_times.setdefault(body["record_hash"], int(record["attributes"]["SentTimestamp"]) / 1000)
+
+            enriched = synthetic.enriched_record(body, self.enrichment_columns, self.rng)
+            key      = f"mros_staging_{body['record_hash']}_{body['submitted_date'].replace('/', '_')}.json"
+
+            self.aws.s3.put_object(Bucket=STAGE_BUCKET, Key=key, Body=synthetic.staging_file_contents(enriched))
+
+        self.enrich_queue.delete([record["messageId"] for record in records])
+        self.stats["add_climate_data"].add(time.perf_counter() - start, len(records), None, 0)
+        self.aws.counter.stage = "harness"
+
+        return True
+
+    def run_stage_to_prod(self):
+        """One mros_stage_to_prod invocation on a batch of staging events (partial batch failures are redelivered)."""
+        records = self.stage_queue.receive(STAGE_BATCH_SIZE)
+
+        if not records:
+            return False
+
+        result, error = self.invoke("mros_stage_to_prod", {"Records": records}, len(records))
+        ids = [record["messageId"] for record in records]
+
+        if error is not None:
+            self.stage_queue.release(ids)
+            return True
+
+        failed = {failure["itemIdentifier"] for failure in (result or {}).get("batchItemFailures", [])}
+
+        self.stage_queue.delete([i for i in ids if i not in failed])
+        self.stage_queue.release([i for i in ids if i in failed])
+
+        return True
+
+    def _csv_rows(self, event):
+        """Number of rows in the prod CSV file of an S3 event (read without counting it as an API call)."""
+        s3_record = event["Records"][0]["s3"]
+        data      = self.aws.s3.objects[(s3_record["bucket"]["name"], s3_record["object"]["key"])]["data"]
+
+        return len(pd.read_csv(io.BytesIO(data)))
+
+    def run_append(self):
+        """One mros_append_daily_data invocation on the next prod file event."""
+        records = self.append_queue.receive(APPEND_BATCH_SIZE)
+
+        if not records:
+            return False
+
+        rows = self._csv_rows(json.loads(json.loads(records[0]["body"])["Message"]))
+        _, error = self.invoke("mros_append_daily_data", {"Records": records}, rows)
+        ids = [record["messageId"] for record in records]
+
+        if error is not None:
+            self.append_queue.release(ids)
+        else:
+            self.append_queue.delete(ids)
+
+        return True
+
+    def run_insert(self):
+        """mros_insert_into_dynamodb invocation(s) for the next SNS notification, retried like an async invocation."""
+        if not self.sns_invocations:
+            return False
+
+        event = self.sns_invocations.pop(0)
+        rows  = self._csv_rows(json.loads(event["Records"][0]["Sns"]["Message"]))
+
+        for attempt in range(ASYNC_RETRIES + 1):
+            _, error = self.invoke("mros_insert_into_dynamodb", event, rows if attempt == 0 else 0)
+
+            if error is None:
+                break
+
+        return True
+
+    def run(self):
+        """Run the whole pipeline until every queue is drained, returns the report."""
+        self.load_handlers()
+
+        start = time.perf_counter()
+
+        self.run_airtable()
+
+        # drain the stages in pipeline order, then go around again for redelivered messages
+        while True:
+            progressed = False
+
+            while self.run_enrichment():
+                progressed = True
+
+            while self.run_stage_to_prod():
+                progressed = True
+
+            # the append and DynamoDB stages both subscribe to the prod bucket topic
+            while self.append_queue or self.sns_invocations:
+                self.run_append()
+                self.run_insert()
+                progressed = True
+
+            if not progressed:
+                break
+
+        return self.report(time.perf_counter() - start)
+
+    def master_rows(self):
+        """Number of records committed to the master dataset manifest (snapshot + deltas)."""
+        from mros_append_daily_data import master_manifest
+
+        key = master_manifest.manifest_key(master_manifest.master_prefix(OUTPUT_KEY))
+        obj = self.aws.s3.objects.get((OUTPUT_BUCKET, key))
+
+        if obj is None:
+            return 0
+
+        manifest = json.loads(obj["data"])
+        entries  = ([manifest["snapshot"]] if manifest.get("snapshot") else []) + manifest["deltas"]
+
+        return sum(entry.get("rows") or 0 for entry in entries)
+
+    def report(self, seconds):
+        api_calls = self.aws.counter.by_stage()
+        written   = self.aws.dynamodb.write_times
+
+        end_to_end = [written[key] - sent for key, sent in self.sent_times.items() if key in written]
+
+        return {
+            "records_fetched": self.stats["mros_airtable_to_sqs"].records,
+            "master_rows": self.master_rows(),
+            "dynamodb_items": len(self.aws.dynamodb.tables[DYNAMODB_TABLE]),
+            "dead_letter": {queue.name: len(queue.dead_letter) for queue in self.aws.sqs.queues.values()},
+            "redelivered": {queue.name: queue.redelivered for queue in self.aws.sqs.queues.values()},
+            "seconds": round(seconds, 3),
+            "records_per_second": round(self.stats["mros_airtable_to_sqs"].records / seconds, 1) if seconds > 0 else None,
+            "end_to_end_ms": {f"p{q}": round(percentile(end_to_end, q) * 1000, 2) if end_to_end else None for q in (50, 95, 99)},
+            "stages": {stage: self.stats[stage].summary(api_calls.get(stage, {})) for stage in STAGES}
+        }
+
+def print_report(report):
+    print(f"Records fetched: {report['records_fetched']}, in master dataset: {report['master_rows']}, "
+          f"in DynamoDB: {report['dynamodb_items']}")
+    print(f"Total: {report['seconds']} s ({report['records_per_second']} records/s), "
+          f"end to end latency: {json.dumps(report['end_to_end_ms'])}")
+    print(f"Redelivered: {json.dumps(report['redelivered'])}, dead-lettered: {json.dumps(report['dead_letter'])}")
+    print("")
+
+    header = f"{'stage':<28}{'calls':>7}{'records':>9}{'errors':>8}{'rec/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'log KB':>9}"
+    print(header)
+    print("-" * len(header))
+
+    for stage, s in report["stages"].items():
+        print(f"{stage:<28}{s['invocations']:>7}{s['records']:>9}{s['errors']:>8}{str(s['records_per_second']):>10}"
+              f"{str(s['latency_ms']['p50']):>10}{str(s['latency_ms']['p95']):>10}{str(s['latency_ms']['p99']):>10}"
+              f"{round(s['log_bytes'] / 1024, 1):>9}")
+
+    print("")
+    print("API calls per stage:")
+
+    for stage, s in report["stages"].items():
+        if s["api_calls"]:
+            print(f"- {stage}: " + ", ".join(f"{op}={n}" for op, n in s["api_calls"].items()))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the MRoS pipeline lambdas end to end against in-process AWS stand-ins.")
+    parser.add_argument("--records-per-day", type=int, default=100, help="Airtable records per fetched date (2 dates are fetched)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--s3-error-rate", type=float, default=0.0, help="fraction of staging/prod object reads that fail")
+    parser.add_argument("--dynamodb-unprocessed-rate", type=float, default=0.0, help="fraction of DynamoDB writes returned as unprocessed")
+    parser.add_argument("--max-receives", type=int, default=3, help="SQS receives before a message is dead-lettered")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the handlers' log output")
+    args = parser.parse_args(argv)
+
+    harness = PipelineHarness(
+        records_per_day           = args.records_per_day,
+        seed                      = args.seed,
+        s3_error_rate             = args.s3_error_rate,
+        dynamodb_unprocessed_rate = args.dynamodb_unprocessed_rate,
+        max_receives              = args.max_receives,
+        verbose                   = args.verbose
+        )
+
+    report = harness.run()
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# Description: Synthetic MRoS observation records for the pipeline harness, in the shapes each stage receives:
+# Airtable API records (what fetch_airtable_data() returns) and the enriched staging JSON files the add_climate_data
+# R container writes to the staging bucket (the harness stands in for the R stage with these).
+# observation_records() makes more realistic days of Airtable records for the fake Airtable API (fake_airtable.py):
+# the same records for the same date and seed, uneven cluster sizes, phases that follow the season and the cluster,
+# submissions mostly during the local day, and fields missing from some records like in real Airtable responses.
+# Usage: from pipeline_harness import synthetic
+# Author: Angus Watters
+
+# general utility libraries
+import json
+import random
+import string
+from datetime import datetime, timedelta, timezone
+
+PHASES       = ["Rain", "Snow", "Mixed"]
+DEVICE_TYPES = ["iOS", "Android", "Web"]
+
+# (latitude, longitude) centers that observations cluster around (Front Range, Sierra Nevada, Wasatch, Cascades)
+CLUSTER_CENTERS = [(40.0, -105.5), (39.0, -120.2), (40.6, -111.6), (47.4, -121.4)]
+
+def _record_id(rng):
+    return "rec" + "".join(rng.choice(string.ascii_letters + string.digits) for _ in range(14))
+
+def airtable_records(date, n, rng=None):
+    """
+    Generate Airtable API records submitted on a date.
+
+    Parameters:
+    date (str): Submission date in the Airtable filter format "MM/DD/YY" (see get_dates_before()).
+    n (int): Number of records.
+    rng (random.Random): Random number generator.
+
+    Returns:
+    list: Airtable records ({"id", "createdTime", "fields"}).
+    """
+    rng     = rng or random.Random(0)
+    day     = datetime.strptime(date, "%m/%d/%y").replace(tzinfo=timezone.utc)
+    records = []
+
+    for i in range(n):
+        lat_center, lon_center = rng.choice(CLUSTER_CENTERS)
+        submitted = day + timedelta(seconds=rng.randrange(86400))
+        local     = submitted - timedelta(hours=7)
+        iso_time  = submitted.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+        fields = {
+            "phase": rng.choice(PHASES),
+            "latitude": round(rng.gauss(lat_center, 0.3), 6),
+            "longitude": round(rng.gauss(lon_center, 0.3), 6),
+            "user": f"user_{rng.randrange(max(1, n // 4))}",
+            "time_submitted_local": local.strftime("%H:%M:%S"),
+            "date_submitted_local": local.strftime("%m/%d/%y"),
+            "time_submitted_utc": submitted.strftime("%H:%M:%S"),
+            "date_submitted_utc": date,
+            "datetime_received_pacific": iso_time,
+            "DeviceType": rng.choice(DEVICE_TYPES)
+        }
+
+        if rng.random() < 0.1:
+            fields["comment"] = "synthetic comment"
+
+        records.append({"id": _record_id(rng), "createdTime": iso_time, "fields": fields})
+
+    return records
+
+# relative number of observations of each cluster (same order as CLUSTER_CENTERS)
+CLUSTER_WEIGHTS = [0.4, 0.25, 0.2, 0.15]
+
+# share of the Rain/Snow/Mixed observations by month (1-12): mostly snow in winter, mostly rain in summer
+SNOW_SHARE_BY_MONTH = [0.7, 0.65, 0.55, 0.4, 0.2, 0.05, 0.02, 0.02, 0.1, 0.3, 0.5, 0.65]
+MIXED_SHARE         = 0.15
+
+# share of the observations from each device type (same order as DEVICE_TYPES)
+DEVICE_WEIGHTS = [0.5, 0.35, 0.15]
+
+# hour offset of the local time of the submissions (Mountain/Pacific standard time, roughly)
+LOCAL_UTC_OFFSET_HOURS = -7
+
+def observation_records(date, n, seed=0, missing_field_rate=0.02):
+    """
+    Generate a realistic day of Airtable API records, always the same for a date and seed.
+
+    Parameters:
+    date (str): Submission date in the Airtable filter format "MM/DD/YY".
+    n (int): Number of records.
+    seed (int): Random seed (combined with the date).
+    missing_field_rate (float): Share of the records without a DeviceType (Airtable leaves out empty fields).
+
+    Returns:
+    list: Airtable records ({"id", "createdTime", "fields"}), in createdTime order.
+    """
+    rng   = random.Random(f"{seed}:{date}")
+    day   = datetime.strptime(date, "%m/%d/%y").replace(tzinfo=timezone.utc)
+    snow  = SNOW_SHARE_BY_MONTH[day.month - 1]
+    users = max(1, n // 4)
+
+    records = []
+
+    for _ in range(n):
+        cluster                = rng.choices(range(len(CLUSTER_CENTERS)), weights=CLUSTER_WEIGHTS)[0]
+        lat_center, lon_center = CLUSTER_CENTERS[cluster]
+
+        # local daytime peak (~13:00), a few night time submissions
+        local_hour = min(max(rng.gauss(13, 3.5), 0), 23.999)
+        submitted  = day + timedelta(hours=local_hour - LOCAL_UTC_OFFSET_HOURS) % timedelta(days=1)
+        submitted  = submitted.replace(microsecond=0)
+        local      = submitted + timedelta(hours=LOCAL_UTC_OFFSET_HOURS)
+        iso_time   = submitted.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+        # higher (more northern/colder) clusters see a bit more snow
+        cluster_snow = min(1, snow * (1.2 if cluster in (0, 3) else 0.9))
+        draw         = rng.random()
+        phase        = "Mixed" if draw < MIXED_SHARE else ("Snow" if draw < MIXED_SHARE + (1 - MIXED_SHARE) * cluster_snow else "Rain")
+
+        fields = {
+            "phase": phase,
+            "latitude": round(rng.gauss(lat_center, 0.3), 6),
+            "longitude": round(rng.gauss(lon_center, 0.3), 6),
+            # a few frequent observers (30% of the observations) and a long tail
+            "user": f"user_{rng.randrange(min(10, users)) if rng.random() < 0.3 else rng.randrange(users)}",
+            "time_submitted_local": local.strftime("%H:%M:%S"),
+            "date_submitted_local": local.strftime("%m/%d/%y"),
+            "time_submitted_utc": submitted.strftime("%H:%M:%S"),
+            "date_submitted_utc": date,
+            "datetime_received_pacific": iso_time,
+            "DeviceType": rng.choices(DEVICE_TYPES, weights=DEVICE_WEIGHTS)[0]
+        }
+
+        if rng.random() < missing_field_rate:
+            del fields["DeviceType"]
+
+        if rng.random() < 0.1:
+            fields["comment"] = rng.choice(["heavy", "light", "wet snow", "graupel?", "drizzle", "synthetic comment"])
+
+        records.append({"id": _record_id(rng), "createdTime": iso_time, "fields": fields})
+
+    return sorted(records, key=lambda record: (record["createdTime"], record["id"]))
+
+def enriched_record(message_body, enrichment_columns, rng=None):
+    """
+    Add made up enrichment values to an SQS message body (a stand-in for the add_climate_data R container).
+
+    Parameters:
+    message_body (dict): Record sent to SQS by mros_airtable_to_sqs.
+    enrichment_columns (list): (column name, kind) tuples of the enrichment columns (see master_schema.py).
+    rng (random.Random): Random number generator.
+
+    Returns:
+    dict: Enriched record.
+    """
+    rng    = rng or random.Random(0)
+    record = dict(message_body)
+
+    for col, kind in enrichment_columns:
+        if kind in ("float", "int"):
+            record[col] = round(rng.uniform(-10, 30), 3) if kind == "float" else rng.randrange(10)
+        else:
+            record[col] = f"{col}_{rng.randrange(5)}"
+
+    return record
+
+def staging_file_contents(record):
+    """
+    Contents of the staging JSON file for an enriched record (jsonlite::write_json() of a JSON string,
+    i.e. a JSON list holding the JSON encoded list of records).
+    """
+    return json.dumps([json.dumps([record])])
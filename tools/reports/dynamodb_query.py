@@ -0,0 +1,255 @@
+# Description: Read path for the MRoS DynamoDB table (the table that mros_insert_into_dynamodb writes).
+# Region and time queries are served by the "geohash5-timestamp-index" GSI: the bounding box is covered with
+# geohash5 cells and one Query per cell (timestamp BETWEEN start and end) is sent from a pool of worker threads.
+# Day queries use the "date_key-timestamp-index" GSI and single records are fetched with batched BatchGetItem requests.
+# Results are returned as pandas dataframes, so targeted lookups can replace table scans or master dataset downloads.
+# Usage:
+#   from reports import dynamodb_query
+#   df = dynamodb_query.query_bbox("mros-table", -106.0, 39.5, -105.0, 40.5, "2024-01-01", "2024-02-01")
+# NOTE: needs the Python packages of mros_insert_into_dynamodb (pandas, boto3) and AWS credentials, lambdas/ and
+# tools/ on sys.path (see query.py).
+# Author: Angus Watters
+
+# general utility libraries
+import math
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeDeserializer
+
+# parallel BatchWriteItem writer of mros_insert_into_dynamodb (shares its DynamoDB client, worker count and retry settings)
+from mros_insert_into_dynamodb import batch_writer
+
+# geohash encoder mros_stage_to_prod stamps the records with (the query cells must match the stored geohash5 values)
+from mros_common import geohash
+
+# leveled, structured logging
+from mros_common import log
+
+# global secondary indexes of the table (see infra/dynamodb.tf)
+GEOHASH5_INDEX = "geohash5-timestamp-index"
+DATE_KEY_INDEX = "date_key-timestamp-index"
+
+# geohash precision of the "geohash5" attribute
+GEOHASH_PRECISION = 5
+
+# max number of geohash5 cells a bounding box query may fan out to (~ 4.9 km x 4.9 km cells, 2500 cells ~ 2.2 x 2.2 degrees)
+MAX_CELLS = 2500
+
+# max number of keys in a single BatchGetItem request
+BATCH_GET_SIZE = 100
+
+deserializer = TypeDeserializer()
+
+logger = log.get_logger("dynamodb_query")
+
+def geohash_cells(min_lon, min_lat, max_lon, max_lat, precision=GEOHASH_PRECISION):
+    """
+    Get the geohash cells covering a bounding box.
+
+    Parameters:
+    min_lon, min_lat, max_lon, max_lat (float): Bounding box in degrees (WGS84).
+    precision (int): Geohash precision.
+
+    Returns:
+    list: Sorted geohash strings.
+    """
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError(f"Invalid bounding box: ({min_lon}, {min_lat}, {max_lon}, {max_lat})")
+
+    lat_step, lon_step = geohash.cell_size(precision)
+
+    n_lat = math.floor(max_lat / lat_step) - math.floor(min_lat / lat_step) + 1
+    n_lon = math.floor(max_lon / lon_step) - math.floor(min_lon / lon_step) + 1
+
+    if n_lat * n_lon > MAX_CELLS:
+        raise ValueError(f"Bounding box covers {n_lat * n_lon} geohash{precision} cells (max {MAX_CELLS}), use a smaller box")
+
+    # one point in each cell row/column (clamped to the box), plus the box corners
+    lats = [min(max_lat, min_lat + i * lat_step) for i in range(n_lat)] + [max_lat]
+    lons = [min(max_lon, min_lon + j * lon_step) for j in range(n_lon)] + [max_lon]
+
+    return sorted({geohash.encode(lat, lon, precision) for lat in lats for lon in lons})
+
+def to_epoch(value):
+    """Convert a time (epoch seconds, datetime or date string, UTC) to epoch seconds."""
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    timestamp = pd.Timestamp(value)
+
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+
+    return timestamp.timestamp()
+
+def items_to_dataframe(items):
+    """
+    Convert DynamoDB items (low level AttributeValue format) into a dataframe, numbers as float64.
+    """
+    if not items:
+        return pd.DataFrame()
+
+    df = pd.DataFrame([{name: deserializer.deserialize(value) for name, value in item.items()} for item in items])
+
+    for col in df.columns:
+        if df[col].map(lambda value: value is None or isinstance(value, Decimal)).all():
+            df[col] = pd.to_numeric(df[col].map(lambda value: None if value is None else float(value)))
+
+    return df
+
+def _call(method, **kwargs):
+    """Call a DynamoDB client method, retrying throttling errors with jittered backoff."""
+    for attempt in range(batch_writer.MAX_RETRIES + 1):
+        try:
+            return getattr(batch_writer.dynamodb, method)(**kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in batch_writer.THROTTLE_ERROR_CODES or attempt == batch_writer.MAX_RETRIES:
+                raise
+            batch_writer.backoff(attempt)
+
+def query_index(table_name, index_name, key_name, key_value, start_time=None, end_time=None):
+    """
+    Query all items of one partition of a "<key>-timestamp-index" GSI, optionally between two times.
+
+    Parameters:
+    table_name (str): DynamoDB table name.
+    index_name (str): GSI name.
+    key_name (str): Partition key of the GSI (e.g. "geohash5").
+    key_value (str): Partition key value.
+    start_time, end_time: Optional time range (inclusive, see to_epoch()).
+
+    Returns:
+    list: DynamoDB items.
+    """
+    condition = "#k = :k"
+    values    = {":k": {"S": key_value}}
+    names     = {"#k": key_name}
+
+    if start_time is not None or end_time is not None:
+        condition += " AND #t BETWEEN :t0 AND :t1"
+        names["#t"] = "timestamp"
+        values[":t0"] = {"N": repr(to_epoch(start_time) if start_time is not None else 0.0)}
+        values[":t1"] = {"N": repr(to_epoch(end_time) if end_time is not None else 1e11)}
+
+    request = {
+        "TableName": table_name,
+        "IndexName": index_name,
+        "KeyConditionExpression": condition,
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+        }
+
+    items = []
+
+    while True:
+        response = _call("query", **request)
+        items.extend(response.get("Items", []))
+
+        if "LastEvaluatedKey" not in response:
+            return items
+
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def _fan_out(func, args, max_workers=None):
+    """Run func over args in a pool of worker threads and concatenate the returned item lists."""
+    max_workers = max_workers or batch_writer.MAX_WORKERS
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [item for items in executor.map(func, args) for item in items]
+
+def query_bbox(table_name, min_lon, min_lat, max_lon, max_lat, start_time=None, end_time=None, max_workers=None):
+    """
+    Get all observations inside a bounding box (and optional time range).
+
+    Parameters:
+    table_name (str): DynamoDB table name.
+    min_lon, min_lat, max_lon, max_lat (float): Bounding box in degrees (WGS84).
+    start_time, end_time: Optional time range (inclusive, epoch seconds, datetime or date string, UTC).
+    max_workers (int): Number of parallel Query requests (defaults to DYNAMODB_WRITE_WORKERS).
+
+    Returns:
+    pandas.DataFrame: Observations inside the box, sorted by timestamp.
+    """
+    cells = geohash_cells(min_lon, min_lat, max_lon, max_lat)
+
+    logger.info("Querying %s geohash%s cells of '%s'", len(cells), GEOHASH_PRECISION, table_name)
+
+    items = _fan_out(
+        lambda cell: query_index(table_name, GEOHASH5_INDEX, "geohash5", cell, start_time, end_time),
+        cells,
+        max_workers
+        )
+
+    df = items_to_dataframe(items)
+
+    if df.empty:
+        return df
+
+    # the cells stick out of the box, keep only the observations inside it
+    inside = df["latitude"].between(min_lat, max_lat) & df["longitude"].between(min_lon, max_lon)
+
+    return df[inside].sort_values("timestamp", ignore_index=True)
+
+def query_dates(table_name, date_keys, start_time=None, end_time=None, max_workers=None):
+    """
+    Get all observations for one or more date keys ("YYYY_MM_DD", the day the record was staged).
+
+    Parameters:
+    table_name (str): DynamoDB table name.
+    date_keys (list): Date keys (a single string is also accepted).
+    start_time, end_time: Optional time range (inclusive, see to_epoch()).
+    max_workers (int): Number of parallel Query requests (defaults to DYNAMODB_WRITE_WORKERS).
+
+    Returns:
+    pandas.DataFrame: Observations, sorted by timestamp.
+    """
+    date_keys = [date_keys] if isinstance(date_keys, str) else list(date_keys)
+
+    items = _fan_out(
+        lambda date_key: query_index(table_name, DATE_KEY_INDEX, "date_key", date_key, start_time, end_time),
+        date_keys,
+        max_workers
+        )
+
+    df = items_to_dataframe(items)
+
+    return df if df.empty else df.sort_values("timestamp", ignore_index=True)
+
+def _get_batch(table_name, keys):
+    """Get up to 100 items by record_hash with BatchGetItem, retrying UnprocessedKeys."""
+    items   = []
+    request = {"Keys": [{"record_hash": {"S": key}} for key in keys]}
+
+    for attempt in range(batch_writer.MAX_RETRIES + 1):
+        response = _call("batch_get_item", RequestItems={table_name: request})
+        items.extend(response.get("Responses", {}).get(table_name, []))
+
+        request = response.get("UnprocessedKeys", {}).get(table_name)
+
+        if not request:
+            return items
+
+        batch_writer.backoff(attempt)
+
+    raise RuntimeError(f"{len(request['Keys'])} keys were still unprocessed after {batch_writer.MAX_RETRIES} retries")
+
+def get_records(table_name, record_hashes, max_workers=None):
+    """
+    Get observations by record_hash with parallel BatchGetItem requests.
+
+    Parameters:
+    table_name (str): DynamoDB table name.
+    record_hashes (list): record_hash values.
+    max_workers (int): Number of parallel requests (defaults to DYNAMODB_WRITE_WORKERS).
+
+    Returns:
+    pandas.DataFrame: The observations that were found.
+    """
+    keys    = list(dict.fromkeys(record_hashes))
+    batches = [keys[i:i + BATCH_GET_SIZE] for i in range(0, len(keys), BATCH_GET_SIZE)]
+
+    return items_to_dataframe(_fan_out(lambda batch: _get_batch(table_name, batch), batches, max_workers))
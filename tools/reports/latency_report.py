@@ -0,0 +1,220 @@
+# Description: Per-stage and end to end latency of the records in the MRoS master dataset, from the lineage
+# timestamps each stage stamps on the records (see lambdas/mros_common/lineage.py):
+#   airtable_to_sqs    createdtime -> ts_enqueued    submitted until mros_airtable_to_sqs sent it (includes the
+#                                                    deliberate wait for the GPM data)
+#   enrichment         ts_enqueued -> ts_staged      SQS queue + add_climate_data
+#   stage_to_prod      ts_staged   -> ts_prod        S3 event + SQS batching + mros_stage_to_prod
+#   append             ts_prod     -> ts_appended    SNS/SQS + mros_append_daily_data
+#   end_to_end         createdtime -> ts_appended
+# For each segment the report lists the number of records with both timestamps, latency percentiles and a histogram
+# (log spaced buckets from seconds to weeks). Records from before the lineage timestamps existed are skipped per
+# segment. --by adds a per-group table (e.g. per date_key or device_type) of each segment's p50/p95.
+#
+# Usage: python tools/reports/latency_report.py s3://<output bucket>/mros_output
+#        python tools/reports/latency_report.py ./mros_output.parquet --since 2024-06-01 --by date_submitted_utc
+#        python tools/reports/latency_report.py ./mros_output --json latency.json
+# NOTE: needs pandas/pyarrow (lambdas/mros_append_daily_data/requirements.txt) and AWS credentials for s3:// sources.
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS_DIR   = os.path.dirname(REPORTS_DIR)
+REPO_DIR    = os.path.dirname(TOOLS_DIR)
+
+# the lambdas are imported as packages (e.g. "from mros_append_daily_data import master_schema"), like in the zips
+sys.path.insert(0, os.path.join(REPO_DIR, "lambdas"))
+sys.path.insert(0, TOOLS_DIR)
+
+from mros_common import lineage
+from mros_append_daily_data import master_schema
+from reports import master_source
+
+# column of the submission time (Airtable record creation)
+SUBMITTED = "createdtime"
+
+# (segment name, start column, end column), in pipeline order
+SEGMENTS = [
+    ("airtable_to_sqs", SUBMITTED, lineage.ENQUEUED),
+    ("enrichment", lineage.ENQUEUED, lineage.STAGED),
+    ("stage_to_prod", lineage.STAGED, lineage.PROD),
+    ("append", lineage.PROD, lineage.APPENDED),
+    ("end_to_end", SUBMITTED, lineage.APPENDED),
+]
+
+PERCENTILES = [50, 90, 95, 99]
+
+# histogram bucket upper bounds (seconds) and labels
+HISTOGRAM_BUCKETS = [
+    (1, "<1s"), (10, "1-10s"), (60, "10s-1m"), (600, "1-10m"), (3600, "10m-1h"), (6 * 3600, "1-6h"),
+    (86400, "6h-1d"), (2 * 86400, "1-2d"), (4 * 86400, "2-4d"), (7 * 86400, "4-7d"), (14 * 86400, "7-14d"),
+    (np.inf, ">14d"),
+]
+
+def format_seconds(seconds):
+    """Short human readable duration, e.g. "850ms", "42.0s", "3.5h", "6.2d"."""
+    if seconds is None or pd.isna(seconds):
+        return "-"
+
+    sign, seconds = ("-" if seconds < 0 else ""), abs(seconds)
+
+    for limit, unit, scale in [(1, "ms", 1e-3), (60, "s", 1), (3600, "m", 60), (86400, "h", 3600)]:
+        if seconds < limit:
+            return f"{sign}{seconds / scale:.0f}{unit}" if unit == "ms" else f"{sign}{seconds / scale:.1f}{unit}"
+
+    return f"{sign}{seconds / 86400:.1f}d"
+
+def load_timestamps(sources, since=None, until=None, by=None):
+    """
+    Read the submission and lineage timestamps (and the --by column) of the master dataset as UTC timestamps.
+
+    Parameters:
+    sources (list): Master dataset sources (see master_source.expand()).
+    since (str): Only records submitted on/after this date/time (UTC).
+    until (str): Only records submitted before this date/time (UTC).
+    by (str): Extra column to group by.
+
+    Returns:
+    pandas.DataFrame: One row per record (deduplicated on record_hash).
+    """
+    columns = ["record_hash", SUBMITTED] + lineage.MASTER_COLUMNS + ([by] if by else [])
+    df      = master_source.read_master(sources, columns)
+
+    for col in [SUBMITTED] + lineage.MASTER_COLUMNS:
+        series  = df[col] if col in df.columns else pd.Series([None] * len(df), index=df.index, dtype=object)
+        df[col] = master_schema.coerce_column(col, series)
+
+    if "record_hash" in df.columns:
+        df = df.drop_duplicates(subset=["record_hash"], keep="first")
+
+    if since:
+        df = df[df[SUBMITTED] >= pd.Timestamp(since, tz="UTC")]
+
+    if until:
+        df = df[df[SUBMITTED] < pd.Timestamp(until, tz="UTC")]
+
+    return df.reset_index(drop=True)
+
+def segment_seconds(df, start, end):
+    """Latencies (seconds) of the records that have both timestamps of a segment."""
+    both = df[start].notna() & df[end].notna()
+
+    return (df.loc[both, end] - df.loc[both, start]).dt.total_seconds().to_numpy()
+
+def segment_stats(seconds):
+    """
+    Count, percentiles, mean, max, negative count (clock skew) and histogram of a segment's latencies.
+
+    Returns:
+    dict: Stats (seconds).
+    """
+    stats = {"records": int(len(seconds))}
+
+    if len(seconds) == 0:
+        return stats
+
+    stats.update({f"p{q}": float(np.percentile(seconds, q, method="nearest")) for q in PERCENTILES})
+    stats.update(mean=float(seconds.mean()), max=float(seconds.max()), negative=int((seconds < 0).sum()))
+
+    # bucket of each latency (the first bucket whose upper bound is above it, negative latencies go in the first)
+    buckets = np.searchsorted([limit for limit, _ in HISTOGRAM_BUCKETS], seconds, side="right")
+    counts  = np.bincount(buckets, minlength=len(HISTOGRAM_BUCKETS))
+
+    stats["histogram"] = {label: int(count) for (_, label), count in zip(HISTOGRAM_BUCKETS, counts)}
+
+    return stats
+
+def latency_report(df, by=None):
+    """
+    Latency stats of each segment, overall and (optionally) per value of the by column.
+
+    Returns:
+    dict: {"records", "segments": {name: stats}, "groups": {value: {name: stats}}}.
+    """
+    report = {
+        "records": int(len(df)),
+        "segments": {name: segment_stats(segment_seconds(df, start, end)) for name, start, end in SEGMENTS}
+    }
+
+    if by:
+        report["by"]     = by
+        report["groups"] = {
+            str(value): {name: segment_stats(segment_seconds(group, start, end)) for name, start, end in SEGMENTS}
+            for value, group in df.groupby(by, observed=True, sort=True)
+        }
+
+    return report
+
+def print_report(report, bar_width=40):
+    print(f"Records: {report['records']}\n")
+
+    header = f"{'segment':<18}{'records':>9}" + "".join(f"{f'p{q}':>9}" for q in PERCENTILES) + f"{'max':>9}{'negative':>10}"
+    print(header)
+    print("-" * len(header))
+
+    for name, stats in report["segments"].items():
+        row = f"{name:<18}{stats['records']:>9}"
+        row += "".join(f"{format_seconds(stats.get(f'p{q}')):>9}" for q in PERCENTILES)
+        row += f"{format_seconds(stats.get('max')):>9}{stats.get('negative', 0):>10}"
+        print(row)
+
+    for name, stats in report["segments"].items():
+        if not stats.get("histogram"):
+            continue
+
+        print(f"\n{name} latency histogram:")
+
+        peak = max(stats["histogram"].values()) or 1
+
+        for label, count in stats["histogram"].items():
+            bar = "#" * int(round(bar_width * count / peak))
+            print(f"  {label:>8} {count:>8} {bar}")
+
+    if report.get("groups"):
+        names = [name for name, _, _ in SEGMENTS]
+
+        print(f"\np50 / p95 by {report['by']}:")
+        header = f"{report['by']:<24}" + "".join(f"{name:>22}" for name in names)
+        print(header)
+        print("-" * len(header))
+
+        for value, segments in report["groups"].items():
+            cells = [f"{format_seconds(segments[name].get('p50'))} / {format_seconds(segments[name].get('p95'))}" for name in names]
+            print(f"{value[:23]:<24}" + "".join(f"{cell:>22}" for cell in cells))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage and end to end latency of the MRoS master dataset records.")
+    parser.add_argument("sources", nargs="+",
+                        help="Master dataset prefix(es) (directory/S3 prefix of _manifest.json) or Parquet/CSV files.")
+    parser.add_argument("--since", default=None, help="Only records submitted on/after this UTC date/time.")
+    parser.add_argument("--until", default=None, help="Only records submitted before this UTC date/time.")
+    parser.add_argument("--by", default=None, help="Also report p50/p95 per value of this column (e.g. date_key).")
+    parser.add_argument("--json", default=None, help="Write the report (seconds) to this JSON file.")
+    args = parser.parse_args(argv)
+
+    if args.by:
+        available = master_source.column_names(args.sources)
+
+        if args.by not in available:
+            parser.error(f"--by: no column '{args.by}' in the master dataset, the columns are {', '.join(available)}")
+
+    df     = load_timestamps(args.sources, args.since, args.until, args.by)
+    report = latency_report(df, args.by)
+
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
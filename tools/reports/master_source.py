@@ -0,0 +1,146 @@
+# Description: Reads (a subset of the columns of) the MRoS master dataset for the reporting tools, from a local copy
+# or straight from S3:
+#   - a master dataset prefix, i.e. the directory/S3 prefix holding _manifest.json (snapshot + delta files,
+#     see lambdas/mros_append_daily_data/master_manifest.py), e.g. s3://<output bucket>/mros_output
+#   - single Parquet or CSV files (e.g. the mros_output.parquet export), local paths may be glob patterns
+# Local paths and s3:// URIs both go through pyarrow.fs (S3 credentials from the usual AWS environment/profile).
+# Usage: from reports import master_source
+# Author: Angus Watters
+
+# general utility libraries
+import io
+import glob
+import json
+import posixpath
+
+import pandas as pd
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+MANIFEST_NAME = "_manifest.json"
+
+def filesystem(uri):
+    """
+    pyarrow filesystem and path of a local path or s3:// URI.
+
+    Returns:
+    tuple: (pyarrow.fs.FileSystem, path within it).
+    """
+    if uri.startswith("s3://"):
+        return pafs.FileSystem.from_uri(uri)
+
+    return pafs.LocalFileSystem(), uri
+
+def _is_file(uri):
+    fs, path = filesystem(uri)
+    return fs.get_file_info(path).type == pafs.FileType.File
+
+def manifest_files(prefix_uri):
+    """
+    Snapshot and delta files of a master dataset manifest.
+
+    Parameters:
+    prefix_uri (str): Master dataset prefix (directory/S3 prefix of _manifest.json), or the manifest itself.
+
+    Returns:
+    list: File URIs (local paths or s3:// URIs), snapshot first.
+    """
+    manifest_uri = prefix_uri if prefix_uri.endswith(MANIFEST_NAME) else posixpath.join(prefix_uri.rstrip("/"), MANIFEST_NAME)
+    prefix_uri   = posixpath.dirname(manifest_uri)
+
+    fs, path = filesystem(manifest_uri)
+
+    with fs.open_input_stream(path) as f:
+        manifest = json.loads(f.read())
+
+    entries = ([manifest["snapshot"]] if manifest.get("snapshot") else []) + manifest.get("deltas", [])
+
+    # manifest keys are "<prefix>/snapshots/<file>" and "<prefix>/deltas/<file>", relative to the bucket
+    return [posixpath.join(prefix_uri, *entry["key"].split("/")[-2:]) for entry in entries]
+
+def expand(sources):
+    """
+    Resolve master dataset sources (see the module description) to data files.
+
+    Parameters:
+    sources (list): Prefixes, manifests, files or (local) glob patterns.
+
+    Returns:
+    list: Parquet/CSV file URIs.
+    """
+    files = []
+
+    for source in sources:
+        if source.endswith(MANIFEST_NAME):
+            files.extend(manifest_files(source))
+        elif source.endswith((".parquet", ".csv")) and (source.startswith("s3://") or not glob.has_magic(source)):
+            files.append(source)
+        elif not source.startswith("s3://") and glob.has_magic(source):
+            files.extend(sorted(glob.glob(source)))
+        elif _is_file(posixpath.join(source.rstrip("/"), MANIFEST_NAME)):
+            files.extend(manifest_files(source))
+        else:
+            raise FileNotFoundError(f"'{source}' is not a Parquet/CSV file or a master dataset prefix (no {MANIFEST_NAME})")
+
+    return files
+
+def read_file(uri, columns=None):
+    """
+    Read the given columns of one Parquet or CSV file (columns the file does not have are left out).
+
+    Returns:
+    pandas.DataFrame: File contents (Parquet columns keep their stored types, CSV columns are as read).
+    """
+    fs, path = filesystem(uri)
+
+    if uri.endswith(".csv"):
+        with fs.open_input_stream(path) as f:
+            data = f.read()
+
+        usecols = (lambda col: col in columns) if columns else None
+        return pd.read_csv(io.BytesIO(data), usecols=usecols, low_memory=False)
+
+    schema = pq.read_schema(path, filesystem=fs)
+    found  = [col for col in columns if col in schema.names] if columns else None
+
+    return pq.read_table(path, columns=found, filesystem=fs).to_pandas()
+
+def file_columns(uri):
+    """Column names of one Parquet or CSV file (only the Parquet footer / CSV header is read)."""
+    fs, path = filesystem(uri)
+
+    if uri.endswith(".csv"):
+        with fs.open_input_stream(path) as f:
+            return list(pd.read_csv(f, nrows=0).columns)
+
+    return list(pq.read_schema(path, filesystem=fs).names)
+
+def column_names(sources):
+    """
+    Column names of the master dataset.
+
+    Parameters:
+    sources (list): Master dataset sources (see expand()).
+
+    Returns:
+    list: Columns of any of the files, in order of first appearance.
+    """
+    return list(dict.fromkeys(col for uri in expand(sources) for col in file_columns(uri)))
+
+def read_master(sources, columns=None):
+    """
+    Read the given columns of the master dataset.
+
+    Parameters:
+    sources (list): Master dataset sources (see expand()).
+    columns (list): Columns to read (None reads all of them).
+
+    Returns:
+    pandas.DataFrame: Rows of all files (columns missing from a file are NA in its rows).
+    """
+    frames = [read_file(uri, columns) for uri in expand(sources)]
+
+    if not frames:
+        return pd.DataFrame(columns=columns or [])
+
+    return pd.concat(frames, axis=0, ignore_index=True)
@@ -0,0 +1,314 @@
+# Description: Ad hoc queries over the MRoS prod and master datasets without downloading them into pandas first,
+# e.g. the snow share by geohash5 over the last week. Sources are scanned in batches (see scan.py): date_key range
+# pruning, column projection and filters (including geohash prefixes) are pushed down to the file readers, and the
+# results are streamed out (row queries) or folded into per-group partial aggregates (aggregate queries), so memory
+# stays bounded by the batch size and the number of groups, not the size of the dataset.
+#
+# Row queries (--select) write the matching records as CSV (stdout or --output .csv/.parquet), up to --limit rows.
+# Aggregate queries (--group-by and/or --agg) print a table (or write --output .csv/.parquet/.json). Aggregations:
+#   count                 number of records (column "n")
+#   sum:COL, mean:COL     sum/mean of the non-null values of a numeric column
+#   min:COL, max:COL      min/max of a column
+#   share:COL=VALUE       share of the records with a non-null COL whose COL is VALUE
+# Filters (--where, repeatable, all must hold): COL=V, COL=V1|V2, COL!=V, COL<V, COL<=V, COL>V, COL>=V, COL^=PREFIX.
+# Column names are the master dataset ones (phase, datetime_received_pacific, ...) for prod CSVs too, and --where
+# columns must be declared in the master dataset schema (master_schema.py).
+#
+# Usage: python tools/reports/query.py s3://<output bucket>/mros_output --last-days 7 \
+#            --group-by geohash5 --agg count --agg share:phase=Snow --sort n --desc --limit 20
+#        python tools/reports/query.py s3://<prod bucket> --since 2024-06-01 --until 2024-06-08 --geohash 9x,9w \
+#            --select id,phase,latitude,longitude,temp_air_idw_lapse_var --output june_week.parquet
+#        python tools/reports/query.py ./mros_output.parquet --where "phase=Snow|Mix" --where "temp_air_avg_obs>2" \
+#            --group-by state --agg count --agg mean:temp_air_avg_obs --format csv
+# NOTE: needs pandas/pyarrow (lambdas/mros_append_daily_data/requirements.txt) and AWS credentials for s3:// sources.
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS_DIR   = os.path.dirname(REPORTS_DIR)
+REPO_DIR    = os.path.dirname(TOOLS_DIR)
+
+# the lambdas are imported as packages (e.g. "from mros_append_daily_data import master_schema"), like in the zips
+sys.path.insert(0, os.path.join(REPO_DIR, "lambdas"))
+sys.path.insert(0, TOOLS_DIR)
+
+from mros_append_daily_data import master_schema
+from mros_append_daily_data import master_store
+from reports import scan
+
+AGGREGATIONS = ("count", "sum", "mean", "min", "max", "share")
+
+def parse_agg(spec):
+    """
+    Parse an aggregation spec (count, sum:COL, mean:COL, min:COL, max:COL or share:COL=VALUE).
+
+    Returns:
+    tuple: (output column name, aggregation, column, value).
+    """
+    func, _, arg = spec.partition(":")
+
+    if func not in AGGREGATIONS or (func == "count") != (not arg):
+        raise ValueError(f"Invalid aggregation '{spec}', expected count, sum:COL, mean:COL, min:COL, max:COL or share:COL=VALUE")
+
+    if func == "count":
+        return "n", func, None, None
+
+    if func == "share":
+        column, found, value = arg.partition("=")
+
+        if not found:
+            raise ValueError(f"Invalid aggregation '{spec}', share needs a value (share:COL=VALUE)")
+
+        return f"share_{column}_{value}", func, column, value
+
+    return f"{func}_{arg}", func, arg, None
+
+class Aggregator:
+    """Per-group partial aggregates (sums, counts, mins, maxs) folded in batch by batch."""
+
+    def __init__(self, group_by, aggs):
+        self.group_by = list(group_by)
+        self.aggs     = [parse_agg(spec) for spec in aggs] or [parse_agg("count")]
+        self.state    = None
+
+    @property
+    def columns(self):
+        """Columns the aggregation reads."""
+        return list(dict.fromkeys(self.group_by + [column for _, _, column, _ in self.aggs if column]))
+
+    def _partials(self, df):
+        """Partial aggregate columns of a batch and how to combine them ({column: "sum"/"min"/"max"})."""
+        parts, how = {"_n": pd.Series(1, index=df.index)}, {"_n": "sum"}
+
+        for i, (_, func, column, value) in enumerate(self.aggs):
+            if func in ("sum", "mean"):
+                values = pd.to_numeric(df[column], errors="coerce")
+                parts[f"_{i}_sum"], parts[f"_{i}_count"] = values.fillna(0), values.notna().astype("int64")
+                how[f"_{i}_sum"], how[f"_{i}_count"] = "sum", "sum"
+            elif func in ("min", "max"):
+                parts[f"_{i}_{func}"], how[f"_{i}_{func}"] = df[column], func
+            elif func == "share":
+                present = df[column].notna()
+                matches = present & (df[column].astype(str) == value)
+                if master_schema.column_kind(column) in ("float", "int"):
+                    matches = present & (pd.to_numeric(df[column], errors="coerce") == float(value))
+                parts[f"_{i}_sum"], parts[f"_{i}_count"] = matches.astype("int64"), present.astype("int64")
+                how[f"_{i}_sum"], how[f"_{i}_count"] = "sum", "sum"
+
+        return pd.DataFrame(parts), how
+
+    def update(self, df):
+        """Fold a batch (pandas.DataFrame) into the aggregates."""
+        parts, how = self._partials(df)
+        keys       = [df[col] for col in self.group_by] or [pd.Series(0, index=df.index)]
+
+        partial = parts.groupby(keys, dropna=False, sort=False).agg(how)
+
+        if self.state is not None:
+            partial = pd.concat([self.state, partial]).groupby(level=list(range(len(keys))), dropna=False,
+                                                                sort=False).agg(how)
+
+        self.state = partial
+
+    def result(self):
+        """
+        Final aggregates.
+
+        Returns:
+        pandas.DataFrame: One row per group (group columns, then one column per aggregation), sorted by group.
+        """
+        names = [name for name, _, _, _ in self.aggs]
+
+        if self.state is None:
+            # no matching records: no groups, or a single row of empty aggregates
+            empty = pd.DataFrame(columns=self.group_by + names)
+            return empty if self.group_by else pd.DataFrame([{name: 0 if name == "n" else None for name in names}])
+
+        state = self.state
+        out   = pd.DataFrame(index=state.index)
+
+        for i, (name, func, _, _) in enumerate(self.aggs):
+            if func == "count":
+                out[name] = state["_n"]
+            elif func == "sum":
+                out[name] = state[f"_{i}_sum"].where(state[f"_{i}_count"] > 0)
+            elif func in ("mean", "share"):
+                out[name] = state[f"_{i}_sum"] / state[f"_{i}_count"].where(state[f"_{i}_count"] > 0)
+            else:
+                out[name] = state[f"_{i}_{func}"]
+
+        if not self.group_by:
+            return out.reset_index(drop=True)
+
+        out.index.names = self.group_by
+
+        return out.sort_index().reset_index()
+
+def sort_rows(df, column, descending=False):
+    """Sort a result on a column."""
+    if not column:
+        return df
+
+    if column not in df.columns:
+        raise ValueError(f"Cannot sort on '{column}', the result columns are {', '.join(df.columns)}")
+
+    return df.sort_values(column, ascending=not descending, kind="stable", na_position="last")
+
+def write_result(df, output=None, fmt="table"):
+    """Write an aggregate result to a .csv/.parquet/.json file, or print it (table, csv or json)."""
+    if output:
+        if output.endswith(".parquet"):
+            df.to_parquet(output, index=False)
+        elif output.endswith(".json"):
+            df.to_json(output, orient="records", date_format="iso", indent=2)
+        else:
+            df.to_csv(output, index=False)
+    elif fmt == "csv":
+        df.to_csv(sys.stdout, index=False)
+    elif fmt == "json":
+        print(df.to_json(orient="records", date_format="iso", indent=2))
+    else:
+        print(df.to_string(index=False) if len(df) else "(no rows)")
+
+def to_csv_frame(table):
+    """pandas.DataFrame of a scan batch for CSV output, timestamps as ISO 8601 strings like the master CSV export."""
+    df = table.to_pandas()
+
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime(master_store.CSV_TIMESTAMP_FORMAT).str[:-3] + "Z"
+
+    return df
+
+def stream_rows(batches, columns, output=None, limit=None):
+    """
+    Write the records of a scan as they come (CSV to stdout or a .csv file, or a .parquet file), up to limit rows.
+
+    Returns:
+    int: Number of rows written.
+    """
+    parquet = bool(output) and output.endswith(".parquet")
+    target  = sys.stdout if not output else (None if parquet else open(output, "w", newline=""))
+    writer  = None
+    written = 0
+
+    try:
+        if target:
+            target.write(",".join(columns) + "\n")
+
+        for table in batches:
+            if limit is not None:
+                table = table.slice(0, max(0, limit - written))
+
+            if parquet:
+                writer = writer or pq.ParquetWriter(output, table.schema)
+                writer.write_table(table)
+            elif not table.num_rows:
+                continue
+            else:
+                to_csv_frame(table).to_csv(target, index=False, header=False)
+
+            written += table.num_rows
+
+            # stop reading files once the limit is reached
+            if limit is not None and written >= limit:
+                break
+    finally:
+        # a query without matches still writes a (column only) Parquet file
+        if parquet and not writer:
+            writer = pq.ParquetWriter(output, pa.schema([(col, pa.null()) for col in columns]))
+        if writer:
+            writer.close()
+        if target and target is not sys.stdout:
+            target.close()
+
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ad hoc queries over the MRoS prod and master datasets.")
+    parser.add_argument("sources", nargs="+", help="Prod prefix(es) (YYYY/MM/DD/*.csv), master dataset prefix(es) "
+                                                   "(directory/S3 prefix of _manifest.json) or Parquet/CSV files.")
+    parser.add_argument("--select", default=None, help="Comma separated columns of a row query.")
+    parser.add_argument("--where", action="append", default=[], help="Filter clause (repeatable), e.g. 'phase=Snow|Mix'.")
+    parser.add_argument("--since", default=None, help="First date_key (YYYY-MM-DD, inclusive).")
+    parser.add_argument("--until", default=None, help="Last date_key (YYYY-MM-DD, exclusive).")
+    parser.add_argument("--last-days", type=int, default=None, help="Records of the last N days (date_key, UTC).")
+    parser.add_argument("--geohash", default=None, help="Comma separated geohash prefixes (any of them).")
+    parser.add_argument("--group-by", default=None, help="Comma separated columns to group by.")
+    parser.add_argument("--agg", action="append", default=[],
+                        help="Aggregation (repeatable): count, sum:COL, mean:COL, min:COL, max:COL, share:COL=VALUE.")
+    parser.add_argument("--sort", default=None, help="Sort an aggregate result on a column (e.g. n).")
+    parser.add_argument("--desc", action="store_true", help="Sort in descending order.")
+    parser.add_argument("--limit", type=int, default=None, help="Max rows of the result.")
+    parser.add_argument("--format", choices=["table", "csv", "json"], default="table",
+                        help="Printed format of an aggregate result.")
+    parser.add_argument("--output", default=None, help="Write the result to this .csv/.parquet (or .json) file.")
+    args = parser.parse_args(argv)
+
+    group_by = [col for col in (args.group_by or "").split(",") if col]
+    select   = [col for col in (args.select or "").split(",") if col]
+
+    if select and (group_by or args.agg):
+        parser.error("--select (row query) cannot be combined with --group-by/--agg (aggregate query)")
+
+    if not (select or group_by or args.agg):
+        parser.error("give --select for a row query or --group-by/--agg for an aggregate query")
+
+    if select and args.sort:
+        parser.error("--sort only applies to aggregate queries (row queries are streamed in file order)")
+
+    try:
+        where      = [scan.parse_where(clause) for clause in args.where]
+        aggregator = Aggregator(group_by, args.agg) if not select else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    since = scan.parse_date(args.since) if args.since else None
+    until = scan.parse_date(args.until) if args.until else None
+
+    if args.last_days is not None:
+        since = datetime.now(timezone.utc).date() - timedelta(days=args.last_days)
+
+    prefixes = [p for p in (args.geohash or "").split(",") if p]
+    columns  = select or aggregator.columns
+    stats    = scan.ScanStats()
+    batches  = scan.scan(args.sources, columns, where, since, until, prefixes, stats)
+
+    # (filters on undeclared columns are rejected by scan.parse_where())
+    unknown = [col for col in columns if master_schema.column_kind(col) is None]
+    if unknown:
+        print(f"Warning: {', '.join(dict.fromkeys(unknown))} not in the master dataset schema", file=sys.stderr)
+
+    try:
+        if select:
+            stream_rows(batches, columns, args.output, args.limit)
+        else:
+            for table in batches:
+                aggregator.update(table.to_pandas())
+    except FileNotFoundError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if not select:
+        try:
+            result = sort_rows(aggregator.result(), args.sort, args.desc)
+        except ValueError as e:
+            parser.error(str(e))
+
+        write_result(result.head(args.limit) if args.limit is not None else result, args.output, args.format)
+
+    print(stats, file=sys.stderr)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
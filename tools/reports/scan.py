@@ -0,0 +1,525 @@
+# Description: Streaming, filtered scans of the MRoS prod and master datasets for the reporting tools, in bounded
+# memory, from a local copy or straight from S3:
+#   - prod: the CSV files mros_stage_to_prod writes to the prod bucket, partitioned by date_key as
+#     <prefix>/YYYY/MM/DD/<uuid>_<timestamp>.csv (e.g. s3://<prod bucket> or a local copy of it)
+#   - master: a master dataset prefix (directory/S3 prefix of _manifest.json) or single Parquet/CSV files,
+#     see master_source.py
+# The work is pushed down as far as each format allows:
+#   - date partition pruning: only the YYYY/MM/DD directories of the date_key range are listed (prod), and Parquet
+#     row groups whose date_key statistics are outside the range are skipped (the master dataset is sorted by time,
+#     so its row groups cover narrow date_key ranges)
+#   - other filters on the statistics of the Parquet row groups (e.g. geohash12 prefixes, timestamp ranges)
+#   - column projection: only the needed columns are read (Parquet column chunks, CSV include_columns)
+#   - filters (including geohash prefixes, as geohash12 ranges) are evaluated by the Parquet scanner on the row
+#     groups that are left, and on each CSV block as it is parsed
+# Batches come out with the master dataset column names and types (prod CSV columns are renamed like
+# mros_append_daily_data does, lineage epoch milliseconds become timestamps, category columns are plain strings, and
+# declared columns of files that store every column as strings, like the legacy mros_output.parquet, are coerced).
+# Usage: from reports import scan
+# Author: Angus Watters
+
+# general utility libraries
+import re
+import csv
+import difflib
+import posixpath
+from datetime import date, datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+from mros_append_daily_data import master_schema
+from mros_append_daily_data import master_store
+from reports import master_source
+
+# prod CSV object keys: YYYY/MM/DD/<uuid>_<timestamp>.csv under the prod prefix
+PROD_KEY = re.compile(r"(?:^|/)(\d{4})/(\d{2})/(\d{2})/[^/]+\.csv$")
+
+# rows per batch read from Parquet files
+PARQUET_BATCH_ROWS = 65536
+
+# bytes per block read from CSV files (each block becomes one batch)
+CSV_BLOCK_BYTES = 4 << 20
+
+# geohash characters are 0-9 and lowercase letters, all sorting before "{", so a prefix p matches [p, p + "{")
+GEOHASH_PREFIX_END = "{"
+
+# prod CSV column names of the master dataset columns that mros_append_daily_data renames
+PROD_NAMES = {master: prod for prod, master in master_store.COLUMN_RENAME_MAP.items()}
+
+# comparison operators of the --where clauses (longest first, so ">=" is not read as ">")
+OPERATORS = ["^=", "!=", ">=", "<=", "=", ">", "<"]
+
+class ScanStats:
+    """Counters of a scan (files/row groups listed and pruned, rows read and matched)."""
+
+    def __init__(self):
+        self.files           = 0
+        self.files_pruned    = 0
+        self.row_groups      = 0
+        self.row_groups_read = 0
+        self.rows_read       = 0
+        self.rows_matched    = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    def __str__(self):
+        return (f"files: {self.files - self.files_pruned}/{self.files} read, "
+                f"row groups: {self.row_groups_read}/{self.row_groups} read, "
+                f"rows: {self.rows_matched} matched of {self.rows_read} read")
+
+def parse_date(value):
+    """date of a YYYY-MM-DD (or YYYY_MM_DD) string."""
+    return datetime.strptime(value.replace("_", "-"), "%Y-%m-%d").date()
+
+def date_key(day):
+    """date_key (YYYY_MM_DD) of a date."""
+    return day.strftime("%Y_%m_%d")
+
+def parse_where(clause):
+    """
+    Parse a filter clause "<column><op><value>", where op is one of =, !=, <, <=, >, >= or ^= (prefix), and
+    "=" / "!=" accept several values separated by "|" (e.g. "phase=Snow|Mix").
+
+    Returns:
+    tuple: (column, operator, value or list of values).
+
+    Raises:
+    ValueError: Invalid clause, or a column that is not in the master dataset schema (see filter_kind()).
+    """
+    for op in OPERATORS:
+        column, found, value = clause.partition(op)
+
+        if found and column.strip() and "=" not in column and "<" not in column and ">" not in column:
+            column, value = column.strip(), value.strip()
+            filter_kind(column)
+
+            if op in ("=", "!="):
+                return column, op, value.split("|")
+
+            return column, op, value
+
+    raise ValueError(f"Invalid filter '{clause}', expected <column><op><value> with op one of {', '.join(OPERATORS)}")
+
+def filter_kind(column):
+    """
+    Declared kind of a filter column (see master_schema.column_kind()). Filters on undeclared columns are rejected:
+    their type is whatever Arrow infers from each file (or CSV block), so no filter value type fits all of them.
+
+    Returns:
+    str: Column kind.
+    """
+    kind = master_schema.column_kind(column)
+
+    if kind is None:
+        close = difflib.get_close_matches(column, list(master_schema.MASTER_KINDS), n=3, cutoff=0.6)
+        hint  = f", did you mean {' / '.join(close)}?" if close else ""
+
+        raise ValueError(f"Cannot filter on '{column}', it is not a column of the master dataset schema "
+                         f"(master_schema.py){hint}")
+
+    return kind
+
+def _scalar(column, value):
+    """Filter value as an Arrow scalar of the column's type in the (normalized) scan batches."""
+    kind = filter_kind(column)
+
+    if kind in ("float", "int"):
+        return pa.scalar(float(value))
+
+    if kind in ("timestamp", "epoch_ms"):
+        return pa.scalar(datetime.fromisoformat(value.replace("Z", "+00:00")), type=pa.timestamp("ms", tz="UTC"))
+
+    return pa.scalar(value)
+
+def filter_expression(where=(), since=None, until=None, geohash_prefixes=()):
+    """
+    Filter expression of a scan, on the master dataset column names and types.
+
+    Parameters:
+    where (list): Parsed filter clauses (see parse_where()), all of which must hold.
+    since (date): First date_key (inclusive).
+    until (date): Last date_key (exclusive).
+    geohash_prefixes (list): Keep the records whose geohash12 starts with any of these prefixes.
+
+    Returns:
+    pyarrow.dataset.Expression: Filter, or None.
+
+    Raises:
+    ValueError: A filter column is not in the master dataset schema (see filter_kind()).
+    """
+    clauses = []
+
+    for column, op, value in where:
+        filter_kind(column)
+        field = ds.field(column)
+
+        if op == "^=":
+            # geohash prefixes as ranges, which the Parquet row group statistics can prune on
+            clauses.append((field >= value) & (field < value + GEOHASH_PREFIX_END) if column.startswith("geohash")
+                           else pc.starts_with(field, pattern=value))
+        elif op in ("=", "!="):
+            values = [_scalar(column, v).as_py() for v in value]
+            clause = field.isin(values)
+            clauses.append(clause if op == "=" else ~clause)
+        else:
+            scalar = _scalar(column, value)
+            clauses.append({">": field > scalar, ">=": field >= scalar, "<": field < scalar, "<=": field <= scalar}[op])
+
+    if since:
+        clauses.append(ds.field("date_key") >= date_key(since))
+
+    if until:
+        clauses.append(ds.field("date_key") < date_key(until))
+
+    if geohash_prefixes:
+        ranges = [(ds.field("geohash12") >= p) & (ds.field("geohash12") < p + GEOHASH_PREFIX_END)
+                  for p in geohash_prefixes]
+        clauses.append(_any(ranges))
+
+    return _all(clauses)
+
+def _all(clauses):
+    expression = None
+
+    for clause in clauses:
+        expression = clause if expression is None else expression & clause
+
+    return expression
+
+def _any(clauses):
+    expression = None
+
+    for clause in clauses:
+        expression = clause if expression is None else expression | clause
+
+    return expression
+
+def filter_columns(where=(), since=None, until=None, geohash_prefixes=()):
+    """Columns the filter expression of a scan (see filter_expression()) refers to."""
+    columns = {column for column, _, _ in where}
+
+    if since or until:
+        columns.add("date_key")
+
+    if geohash_prefixes:
+        columns.add("geohash12")
+
+    return columns
+
+def prod_files(prefix_uri, since=None, until=None, stats=None):
+    """
+    Prod CSV files under a prod prefix, only listing the YYYY/MM/DD directories of the date_key range when there is one.
+
+    Parameters:
+    prefix_uri (str): Local directory or s3:// prefix holding the YYYY/MM/DD directories.
+    since (date): First date (inclusive).
+    until (date): Last date (exclusive, defaults to tomorrow when since is given).
+    stats (ScanStats): Scan counters to update.
+
+    Returns:
+    list: File URIs, in date order.
+    """
+    stats    = stats if stats is not None else ScanStats()
+    fs, path = master_source.filesystem(prefix_uri)
+    path     = path.rstrip("/")
+    base_uri = prefix_uri.rstrip("/")
+
+    if since:
+        until = until or date.today() + timedelta(days=1)
+        days  = [since + timedelta(days=i) for i in range((until - since).days)]
+        dirs  = [posixpath.join(path, day.strftime("%Y/%m/%d")) for day in days]
+    else:
+        dirs = [path]
+
+    files = []
+
+    for directory in dirs:
+        selector = pafs.FileSelector(directory, recursive=not since, allow_not_found=True)
+
+        for info in fs.get_file_info(selector):
+            match = PROD_KEY.search(info.path)
+
+            if info.type != pafs.FileType.File or not match:
+                continue
+
+            day = date(*map(int, match.groups()))
+            stats.files += 1
+
+            if until and day >= until:
+                stats.files_pruned += 1
+                continue
+
+            files.append((day, base_uri + info.path[len(path):]))
+
+    return [uri for _, uri in sorted(files)]
+
+def resolve(sources, since=None, until=None, stats=None):
+    """
+    Data files of the scan sources: prod prefixes (YYYY/MM/DD layout), master dataset prefixes/manifests and
+    Parquet/CSV files or (local) glob patterns.
+
+    Returns:
+    list: File URIs.
+    """
+    stats = stats if stats is not None else ScanStats()
+    files = []
+
+    for source in sources:
+        try:
+            found = master_source.expand([source])
+            stats.files += len(found)
+        except FileNotFoundError:
+            fs, path = master_source.filesystem(source)
+
+            # S3 has no directories, a prefix "exists" when objects are listed under it
+            if not source.startswith("s3://") and fs.get_file_info(path).type != pafs.FileType.Directory:
+                raise FileNotFoundError(f"'{source}' is not a prod prefix, master dataset prefix or Parquet/CSV file")
+
+            found = prod_files(source, since, until, stats)
+
+        files.extend(found)
+
+    return files
+
+def _scan_type(column):
+    """Arrow type of a declared column in the scan batches (category columns as plain strings), None if undeclared."""
+    kind = master_schema.column_kind(column)
+
+    if kind is None:
+        return None
+
+    return pa.string() if kind == "category" else master_schema.ARROW_TYPES[kind]
+
+def _is_untyped(column, arrow_type):
+    """Whether a declared, non-string column was stored as strings (the legacy mros_output.parquet and the first
+    master dataset snapshot copied from it, see master_manifest.bootstrap_manifest(), have every column as strings)."""
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+
+    scan_type = _scan_type(column)
+
+    return scan_type is not None and scan_type != pa.string() and \
+        (pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type))
+
+def _coerce(column, array):
+    """Column of strings as its declared type, the same way master_store.read_parquet_columns() coerces them."""
+    series = master_schema.coerce_column(column, array.to_pandas())
+
+    return pa.Array.from_pandas(series, type=_scan_type(column))
+
+def _normalize(table, columns):
+    """Rename prod CSV columns to the master dataset names, convert the lineage columns to timestamps, decode
+    dictionary columns, coerce declared columns stored as strings to their type and add missing columns (as nulls),
+    so the batches of every file have the same columns and types."""
+    names = [master_store.COLUMN_RENAME_MAP.get(name, name) for name in table.column_names]
+    table = table.rename_columns(names)
+
+    arrays = []
+
+    for column in columns:
+        if column not in names:
+            arrays.append(pa.nulls(table.num_rows))
+            continue
+
+        array = table.column(column)
+
+        if master_schema.column_kind(column) == "epoch_ms" and pa.types.is_integer(array.type):
+            array = array.cast(pa.int64()).cast(pa.timestamp("ms", tz="UTC"))
+
+        # dictionary encoded (category) Parquet columns as plain strings, like in the CSV files
+        if pa.types.is_dictionary(array.type):
+            array = array.cast(array.type.value_type)
+
+        if _is_untyped(column, array.type):
+            array = _coerce(column, array)
+
+        arrays.append(array)
+
+    # (a count only query reads no columns, the batches still carry their row count)
+    return pa.Table.from_arrays(arrays, names=columns) if columns else table.select([])
+
+def _csv_types(columns):
+    """CSV column types of the columns to read (both their master and prod names), so the CSV batches get the master
+    dataset types whatever the values of a block look like."""
+    types = {}
+
+    for column in columns:
+        kind = master_schema.column_kind(column)
+
+        if kind in ("string", "category"):
+            arrow_type = pa.string()
+        elif kind in ("float", "int"):
+            arrow_type = pa.float64()
+        elif kind == "timestamp":
+            arrow_type = pa.timestamp("ms", tz="UTC")
+        elif kind == "epoch_ms":
+            arrow_type = pa.int64()
+        else:
+            continue
+
+        types[column] = arrow_type
+        types[PROD_NAMES.get(column, column)] = arrow_type
+
+    return types
+
+def _csv_header(f):
+    """Column names of a CSV file (random access file, rewound afterwards)."""
+    head = b""
+
+    while b"\n" not in head:
+        chunk = f.read(65536)
+        if not chunk:
+            break
+        head += chunk
+
+    f.seek(0)
+
+    return next(csv.reader([head.split(b"\n", 1)[0].decode("utf-8-sig").rstrip("\r")]), [])
+
+def _scan_csv(uri, columns, expression, read_columns, stats):
+    fs, path = master_source.filesystem(uri)
+
+    with fs.open_input_file(path) as f:
+        names  = _csv_header(f)
+        header = set(names)
+
+        # each column under its master dataset name, or its prod name in prod CSVs (columns the file does not have
+        # are added as nulls by _normalize()). No include_columns reads them all, a count only query reads the first
+        include = [column if column in header else PROD_NAMES[column] for column in read_columns
+                   if column in header or PROD_NAMES.get(column) in header] or names[:1]
+
+        convert = pacsv.ConvertOptions(column_types=_csv_types(read_columns), include_columns=include,
+                                       null_values=sorted(master_schema.NULL_TOKENS), strings_can_be_null=True,
+                                       timestamp_parsers=[pacsv.ISO8601])
+
+        reader = pacsv.open_csv(f, read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_BYTES), convert_options=convert)
+
+        for batch in reader:
+            table = _normalize(pa.Table.from_batches([batch]), read_columns)
+
+            stats.rows_read += table.num_rows
+
+            if expression is not None:
+                table = table.filter(expression)
+
+            stats.rows_matched += table.num_rows
+
+            if table.num_rows:
+                yield table.select(columns)
+
+def _in_date_range(row_group, since, until):
+    """Whether the date_key statistics of a Parquet row group (RowGroupInfo) overlap the [since, until) range."""
+    minmax = row_group.statistics.get("date_key") or {}
+
+    if minmax.get("min") is None or minmax.get("max") is None:
+        return True
+
+    return (since is None or minmax["max"] >= date_key(since)) and (until is None or minmax["min"] < date_key(until))
+
+def _scan_parquet(uri, columns, expression, filtered, read_columns, since, until, stats):
+    fs, path = master_source.filesystem(uri)
+    dataset  = ds.dataset(path, format="parquet", filesystem=fs)
+    schema   = dataset.schema
+    names    = [master_store.COLUMN_RENAME_MAP.get(name, name) for name in schema.names]
+
+    # filters on columns the file stores as strings can not be pushed down (the filter values are typed), these files
+    # are read whole and filtered once their columns are coerced, like the CSV files
+    untyped = any(_is_untyped(name, field.type) for name, field in zip(names, schema) if name in filtered)
+
+    if untyped:
+        yield from _scan_untyped_parquet(dataset, columns, expression, read_columns, since, until, stats)
+        return
+
+    present = [column for column in columns if column in schema.names]
+
+    for fragment in dataset.get_fragments():
+        stats.row_groups += fragment.num_row_groups
+
+        # row groups whose column statistics rule the filter out are not read at all. Arrow does not prune on the
+        # statistics of dictionary encoded columns, so the date_key (category) range is checked here
+        kept = fragment.split_by_row_group(expression, schema=dataset.schema) if expression is not None else [fragment]
+        kept = [row_group for row_group in kept if all(_in_date_range(info, since, until) for info in row_group.row_groups)]
+
+        for row_group in kept:
+            stats.row_groups_read += row_group.num_row_groups
+            stats.rows_read       += sum(info.num_rows for info in row_group.row_groups)
+
+            for batch in row_group.to_batches(schema=dataset.schema, columns=present, filter=expression,
+                                              batch_size=PARQUET_BATCH_ROWS):
+                stats.rows_matched += batch.num_rows
+
+                if batch.num_rows:
+                    yield _normalize(pa.Table.from_batches([batch]), columns)
+
+def _scan_untyped_parquet(dataset, columns, expression, read_columns, since, until, stats):
+    """Scan of a Parquet file with string columns: the date_key range still prunes row groups (date_key is a string
+    either way), the other filters are evaluated on the coerced batches."""
+    present = [name for name in dataset.schema.names if master_store.COLUMN_RENAME_MAP.get(name, name) in read_columns]
+
+    for fragment in dataset.get_fragments():
+        stats.row_groups += fragment.num_row_groups
+
+        kept = [row_group for row_group in fragment.split_by_row_group()
+                if all(_in_date_range(info, since, until) for info in row_group.row_groups)]
+
+        for row_group in kept:
+            stats.row_groups_read += row_group.num_row_groups
+
+            for batch in row_group.to_batches(schema=dataset.schema, columns=present, batch_size=PARQUET_BATCH_ROWS):
+                table = _normalize(pa.Table.from_batches([batch]), read_columns)
+
+                stats.rows_read += table.num_rows
+                table = table.filter(expression)
+                stats.rows_matched += table.num_rows
+
+                if table.num_rows:
+                    yield table.select(columns)
+
+def _file_columns(uri):
+    """Column names of a Parquet/CSV file (master dataset names)."""
+    fs, path = master_source.filesystem(uri)
+
+    if uri.endswith(".csv"):
+        with fs.open_input_file(path) as f:
+            names = _csv_header(f)
+    else:
+        names = ds.dataset(path, format="parquet", filesystem=fs).schema.names
+
+    return {master_store.COLUMN_RENAME_MAP.get(name, name) for name in names}
+
+def scan(sources, columns, where=(), since=None, until=None, geohash_prefixes=(), stats=None):
+    """
+    Stream the matching records of the prod/master dataset sources as Arrow tables of at most a batch each.
+
+    Parameters:
+    sources (list): Prod prefixes, master dataset prefixes/manifests or Parquet/CSV files (see resolve()).
+    columns (list): Columns to return (master dataset names, columns a file does not have are nulls).
+    where (list): Parsed filter clauses (see parse_where()).
+    since (date): First date_key (inclusive).
+    until (date): Last date_key (exclusive).
+    geohash_prefixes (list): Keep the records whose geohash12 starts with any of these prefixes.
+    stats (ScanStats): Scan counters to update.
+
+    Yields:
+    pyarrow.Table: Matching records, `columns` only.
+    """
+    stats      = stats if stats is not None else ScanStats()
+    expression = filter_expression(where, since, until, geohash_prefixes)
+    filtered   = filter_columns(where, since, until, geohash_prefixes)
+    read_cols  = list(columns) + sorted(filtered - set(columns))
+
+    for uri in resolve(sources, since, until, stats):
+        # a filter on a column the file does not have matches none of its rows (comparisons with nulls are null)
+        if filtered and not filtered <= _file_columns(uri):
+            stats.files_pruned += 1
+            continue
+
+        if uri.endswith(".csv"):
+            yield from _scan_csv(uri, columns, expression, read_cols, stats)
+        else:
+            yield from _scan_parquet(uri, columns, expression, filtered, read_cols, since, until, stats)
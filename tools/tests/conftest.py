@@ -0,0 +1,47 @@
+# Description: pytest setup of the tests of the Python lambdas. Puts lambdas/ and tools/ on sys.path (the lambdas are
+# imported as packages, e.g. "from mros_append_daily_data import master_manifest", like in the zips) and provides a
+# `fake` fixture that routes the lambdas' boto3/awswrangler calls to the in-process AWS stand-ins of the pipeline
+# harness (pipeline_harness/fake_aws.py).
+# Usage: python -m pytest tools/tests
+# NOTE: needs the Python packages of the lambdas (pandas, pyarrow, awswrangler, boto3), no network.
+# Author: Angus Watters
+
+# general utility libraries
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS_DIR = os.path.dirname(TESTS_DIR)
+REPO_DIR  = os.path.dirname(TOOLS_DIR)
+
+sys.path.insert(0, os.path.join(REPO_DIR, "lambdas"))
+sys.path.insert(0, TOOLS_DIR)
+
+# no /tmp master dataset cache in the tests (read before the lambda modules are imported)
+os.environ.setdefault("MASTER_CACHE_MAX_MB", "0")
+
+import pytest
+
+from mros_common import aws
+from pipeline_harness import fake_aws
+
+def _lazy_clients():
+    """Module level LazyClients of the imported lambda modules."""
+    return [obj for module in list(sys.modules.values()) if module is not None
+            for obj in list(vars(module).values()) if isinstance(obj, aws.LazyClient)]
+
+@pytest.fixture
+def fake():
+    """Fake AWS services (fake_aws.FakeAWS) installed for the duration of a test."""
+    fake = fake_aws.FakeAWS().install()
+
+    # clients created in an earlier test still point at that test's fakes
+    for client in _lazy_clients():
+        client.reset()
+
+    yield fake
+
+    fake.uninstall()
+
+    for client in _lazy_clients():
+        client.reset()
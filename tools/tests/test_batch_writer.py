@@ -0,0 +1,97 @@
+# Description: Tests of the parallel BatchWriteItem writer of mros_insert_into_dynamodb (batch_writer.py): unprocessed
+# items and throttling errors are resent until every item is written, and the shared rate limiter halves the write
+# rate on throttling and raises it again after successful requests.
+# Usage: python -m pytest tools/tests/test_batch_writer.py
+# Author: Angus Watters
+
+import pytest
+from botocore.exceptions import ClientError
+
+from pipeline_harness import fake_aws
+from mros_insert_into_dynamodb import batch_writer
+
+TABLE = "mros-test-table"
+
+def items(n):
+    return [{"record_hash": {"S": f"hash{i}"}, "v": {"N": str(i)}} for i in range(n)]
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(batch_writer, "backoff", lambda attempt: None)
+
+class ScriptedDynamoDB(fake_aws.FakeDynamoDB):
+    """FakeDynamoDB whose first BatchWriteItem calls throttle: a throttling error, then every item unprocessed."""
+
+    def __init__(self, script):
+        super().__init__(fake_aws.ApiCounter())
+        self.script = list(script)
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        step = self.script.pop(0) if self.script else None
+
+        if step == "error":
+            raise fake_aws.client_error("ProvisionedThroughputExceededException", "BatchWriteItem")
+
+        if step == "unprocessed":
+            self.counter.count("dynamodb.BatchWriteItem")
+            return {"UnprocessedItems": RequestItems, "ConsumedCapacity": []}
+
+        return super().batch_write_item(RequestItems, **kwargs)
+
+def test_unprocessed_items_are_retried(fake, monkeypatch):
+    fake.dynamodb.unprocessed_rate = 0.3
+
+    # (most requests come back with unprocessed items, the rate would sit at MIN_RATE items/s for most of the test)
+    monkeypatch.setattr(batch_writer, "MIN_RATE", 5000.0)
+
+    stats = batch_writer.write_items(items(500), TABLE, max_workers=4)
+
+    assert sorted(fake.dynamodb.tables[TABLE]) == sorted(f"hash{i}" for i in range(500))
+    assert stats["items"] == 500
+    assert stats["retries"] > 0
+    assert stats["throttles"] == stats["retries"]
+    assert stats["requests"] == 20 + stats["retries"]
+    assert stats["wcu"] == 500
+
+def test_throttling_halves_the_rate(monkeypatch):
+    stub = ScriptedDynamoDB(["error", "unprocessed"])
+    monkeypatch.setattr(batch_writer, "dynamodb", stub)
+
+    stats = batch_writer.write_items(items(10), TABLE, max_workers=1)
+
+    assert len(stub.tables[TABLE]) == 10
+    assert (stats["requests"], stats["retries"], stats["throttles"]) == (3, 2, 2)
+    assert len(stub.script) == 0
+
+    # halved twice, then raised once after the request that went through
+    rate = batch_writer.INITIAL_RATE * batch_writer.RATE_DECREASE ** 2 + batch_writer.RATE_INCREASE
+    assert stats["final_rate"] == round(rate, 1)
+
+def test_rate_limits():
+    limiter = batch_writer.RateLimiter(100.0)
+
+    limiter.throttled()
+    assert limiter.rate == 50.0
+
+    for _ in range(10):
+        limiter.throttled()
+    assert limiter.rate == batch_writer.MIN_RATE
+
+    limiter.rate = batch_writer.MAX_RATE
+    limiter.succeeded()
+    assert limiter.rate == batch_writer.MAX_RATE
+
+def test_gives_up_after_max_retries(monkeypatch):
+    stub = ScriptedDynamoDB(["unprocessed"] * (batch_writer.MAX_RETRIES + 1))
+    monkeypatch.setattr(batch_writer, "dynamodb", stub)
+
+    with pytest.raises(RuntimeError, match="unprocessed"):
+        batch_writer.write_items(items(3), TABLE, max_workers=1)
+
+def test_other_errors_are_not_retried(monkeypatch):
+    stub = ScriptedDynamoDB([])
+    monkeypatch.setattr(batch_writer, "dynamodb", stub)
+
+    # more than 25 items in one request: rejected, not retried
+    with pytest.raises(ClientError, match="ValidationException"):
+        batch_writer._write_batch(TABLE, items(26), batch_writer.RateLimiter(1000.0))
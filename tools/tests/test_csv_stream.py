@@ -0,0 +1,104 @@
+# Description: Tests of the chunked, checkpointed CSV reads of mros_insert_into_dynamodb (csv_stream.py) against the
+# fake S3/DynamoDB of the pipeline harness: a retried invocation resumes after the chunks of the saved checkpoint,
+# checkpoints of an older version of the file are ignored, a complete file is not written again, and stopping early
+# stops the prefetch thread.
+# Usage: python -m pytest tools/tests/test_csv_stream.py
+# Author: Angus Watters
+
+import threading
+import time
+
+import pytest
+
+from pipeline_harness import fake_aws
+from mros_insert_into_dynamodb import csv_stream
+from mros_insert_into_dynamodb import mros_insert_into_dynamodb as handler
+
+BUCKET = "mros-test-prod"
+KEY    = "2024/06/15/abc_1718409600.csv"
+TABLE  = "mros-test-table"
+
+ROWS = 10
+
+def prod_csv():
+    lines = ["id,name,latitude,date_key,record_hash"]
+    lines += [f"rec{i},Snow,{40 + i / 100},2024_06_15,hash{i}" for i in range(ROWS)]
+
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+@pytest.fixture
+def prod_file(fake, monkeypatch):
+    monkeypatch.setattr(csv_stream, "CHUNK_ROWS", 3)
+    monkeypatch.setattr(handler, "DYNAMODB_TABLE", TABLE)
+
+    return fake.s3.put_bytes(BUCKET, KEY, prod_csv())
+
+def invoke():
+    message = fake_aws.s3_event(BUCKET, KEY, len(prod_csv()), csv_stream.object_etag(BUCKET, KEY))
+    handler.mros_insert_into_dynamodb(fake_aws.sns_lambda_event("arn:aws:sns:us-west-1:000000000000:test", message), None)
+
+def batch_writes(fake):
+    return fake.counter.by_stage().get("harness", {}).get("dynamodb.BatchWriteItem", 0)
+
+def written(fake):
+    return sorted(fake.dynamodb.tables[TABLE], key=lambda key: int(key[4:]))
+
+def test_resumes_after_the_checkpoint(fake, prod_file):
+    # an earlier invocation wrote the first 2 chunks, then timed out
+    csv_stream.write_checkpoint(BUCKET, KEY, prod_file, 6)
+
+    invoke()
+
+    assert written(fake) == [f"hash{i}" for i in range(6, ROWS)]
+    assert batch_writes(fake) == 2
+
+    checkpoint = csv_stream.read_checkpoint(BUCKET, KEY, prod_file)
+    assert (checkpoint["rows_done"], checkpoint["complete"]) == (ROWS, True)
+
+def test_skipped_rows_keep_the_header(fake, prod_file):
+    chunks = list(csv_stream.read_csv_chunks(f"s3://{BUCKET}/{KEY}", skip_rows=6))
+
+    assert [len(chunk) for chunk in chunks] == [3, 1]
+    assert chunks[0]["id"].tolist() == ["rec6", "rec7", "rec8"]
+    assert str(chunks[0]["record_hash"].dtype) == "string"
+    assert str(chunks[0]["name"].dtype) == "string"
+
+def test_checkpoints_of_an_older_version_are_ignored(fake, prod_file):
+    csv_stream.write_checkpoint(BUCKET, KEY, '"older-etag"', 6, complete=True)
+
+    invoke()
+
+    assert written(fake) == [f"hash{i}" for i in range(ROWS)]
+
+def test_complete_files_are_not_written_again(fake, prod_file):
+    csv_stream.write_checkpoint(BUCKET, KEY, prod_file, ROWS, complete=True)
+
+    invoke()
+
+    assert written(fake) == []
+    assert batch_writes(fake) == 0
+
+def test_stopping_early_stops_the_reader():
+    closed = []
+
+    def endless():
+        try:
+            while True:
+                yield "chunk"
+        finally:
+            closed.append(True)
+
+    before = threading.active_count()
+    chunks = csv_stream.prefetch(endless())
+    assert next(chunks) == "chunk"
+
+    # the caller gave up (timeout, write error): the reader thread stops and closes its iterator
+    chunks.close()
+
+    for _ in range(50):
+        if closed and threading.active_count() == before:
+            break
+        time.sleep(csv_stream.PREFETCH_POLL_S)
+
+    assert closed == [True]
+    assert threading.active_count() == before
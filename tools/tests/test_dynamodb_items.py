@@ -0,0 +1,91 @@
+# Description: Tests of the column by column DynamoDB item serializer of mros_insert_into_dynamodb (dynamodb_items.py):
+# the items match what boto3's TypeSerializer writes for the same values (numbers as Decimal(str(x))), and missing
+# values are left out of the items.
+# Usage: python -m pytest tools/tests/test_dynamodb_items.py
+# Author: Angus Watters
+
+# general utility libraries
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+from boto3.dynamodb.types import TypeSerializer
+
+from mros_insert_into_dynamodb import dynamodb_items
+
+def type_serializer_items(df):
+    """Reference: every present value of every row through boto3's TypeSerializer, floats as Decimal(str(x))."""
+    serializer = TypeSerializer()
+    items      = []
+
+    for row in df.to_dict("records"):
+        item = {}
+
+        for name, value in row.items():
+            if value is None or value is pd.NA or (isinstance(value, float) and not np.isfinite(value)) or value == "":
+                continue
+
+            if isinstance(value, (bool, np.bool_)):
+                value = bool(value)
+            elif isinstance(value, (int, np.integer)):
+                value = int(value)
+            elif isinstance(value, (float, np.floating)):
+                value = Decimal(str(float(value)))
+
+            item[name] = serializer.serialize(value)
+
+        items.append(item)
+
+    return items
+
+def numbers_as_decimals(items):
+    """Items with their "N" values as Decimals (whole number columns are written as "3" instead of "3.0")."""
+    return [{name: {"N": Decimal(value["N"])} if "N" in value else value for name, value in item.items()}
+            for item in items]
+
+def records():
+    return pd.DataFrame({
+        "record_hash": ["a", "b", "c"],
+        "latitude": [40.123456789, -0.1, 1e-7],
+        "temp_air": [-2.5, 1 / 3, 1e21],
+        "count": [3.0, 4.0, np.nan],
+        "n_stations": np.array([1, 2, 2 ** 40], dtype=np.int64),
+        "near_duplicate": [True, False, True],
+        "comment": ["wet, heavy", None, "雪"],
+        "phase": pd.Series(["Snow", "Rain", "Mix"], dtype="category"),
+        })
+
+def test_items_match_the_type_serializer():
+    df    = records()
+    items = dynamodb_items.dataframe_to_items(df)
+
+    assert numbers_as_decimals(items) == numbers_as_decimals(type_serializer_items(df))
+
+    # same digits as Decimal(str(x)), whole number columns without a trailing ".0"
+    assert items[0]["latitude"] == {"N": "40.123456789"}
+    assert items[1]["temp_air"] == {"N": str(Decimal(str(1 / 3)))}
+    assert items[0]["count"] == {"N": "3"}
+    assert items[2]["n_stations"] == {"N": str(2 ** 40)}
+    assert items[0]["near_duplicate"] == {"BOOL": True}
+    assert items[2]["comment"] == {"S": "雪"}
+
+def test_missing_values_are_left_out():
+    df = pd.DataFrame({
+        "record_hash": ["a", "b"],
+        "latitude": [np.nan, 40.0],
+        "temp_air": [np.inf, -1.5],
+        "comment": ["", None],
+        })
+
+    items = dynamodb_items.dataframe_to_items(df)
+
+    assert items == [{"record_hash": {"S": "a"}},
+                     {"record_hash": {"S": "b"}, "latitude": {"N": "40"}, "temp_air": {"N": "-1.5"}}]
+
+def test_string_columns_stay_strings():
+    # a chunk where the key column looks numeric must not turn it into a number
+    df    = pd.DataFrame({"record_hash": pd.Series(["123", "0456"], dtype="string"), "date_key": ["2024_06_15"] * 2})
+    items = dynamodb_items.dataframe_to_items(df)
+
+    assert [item["record_hash"] for item in items] == [{"S": "123"}, {"S": "0456"}]
+    assert items == type_serializer_items(df)
@@ -0,0 +1,70 @@
+# Description: Tests of the bounding box cover of the DynamoDB query helper (reports/dynamodb_query.py): every
+# geohash5 cell holding a point of the box (as encoded by mros_common/geohash.py, i.e. like the stored geohash5
+# values) is queried, and no cell outside the box, also for boxes on cell boundaries and at the edges of the map.
+# Usage: python -m pytest tools/tests/test_dynamodb_query.py
+# Author: Angus Watters
+
+# general utility libraries
+import random
+
+import pytest
+
+from mros_common import geohash
+from reports import dynamodb_query
+
+LAT_STEP, LON_STEP = geohash.cell_size(dynamodb_query.GEOHASH_PRECISION)
+
+def sampled_cells(min_lon, min_lat, max_lon, max_lat, per_cell=4):
+    """Cells of a dense grid of points over the box (several per cell, plus the edges and corners)."""
+    n_lat = int((max_lat - min_lat) / LAT_STEP * per_cell) + 1
+    n_lon = int((max_lon - min_lon) / LON_STEP * per_cell) + 1
+
+    lats = [min_lat + (max_lat - min_lat) * i / n_lat for i in range(n_lat + 1)]
+    lons = [min_lon + (max_lon - min_lon) * j / n_lon for j in range(n_lon + 1)]
+
+    return {geohash.encode(lat, lon, dynamodb_query.GEOHASH_PRECISION) for lat in lats for lon in lons}
+
+def touches_box(cell, min_lon, min_lat, max_lon, max_lat):
+    lat, lon, lat_err, lon_err = geohash.decode_exactly(cell)
+
+    return lat - lat_err <= max_lat and lat + lat_err >= min_lat and \
+           lon - lon_err <= max_lon and lon + lon_err >= min_lon
+
+def assert_cover(min_lon, min_lat, max_lon, max_lat):
+    cells = dynamodb_query.geohash_cells(min_lon, min_lat, max_lon, max_lat)
+
+    assert cells == sorted(set(cells))
+    assert sampled_cells(min_lon, min_lat, max_lon, max_lat) <= set(cells)
+    assert all(touches_box(cell, min_lon, min_lat, max_lon, max_lat) for cell in cells)
+
+def test_random_boxes():
+    rng = random.Random(5)
+
+    for _ in range(200):
+        lat, lon = rng.uniform(-85, 85), rng.uniform(-175, 175)
+        assert_cover(lon, lat, lon + rng.uniform(0, 0.6), lat + rng.uniform(0, 0.6))
+
+def test_boxes_on_cell_boundaries():
+    # edges exactly on cell boundaries (a point on a boundary is encoded into the cell below/left of it)
+    for lat0, lon0 in [(39.0234375, -105.1171875), (0.0, 0.0), (-45.0, -90.0)]:
+        assert_cover(lon0, lat0, lon0 + 3 * LON_STEP, lat0 + 2 * LAT_STEP)
+        assert_cover(lon0 - LON_STEP / 2, lat0 - LAT_STEP / 2, lon0, lat0)
+
+def test_point_and_thin_boxes():
+    assert dynamodb_query.geohash_cells(-105.0, 40.0, -105.0, 40.0) == [geohash.encode(40.0, -105.0, 5)]
+
+    assert_cover(-105.3, 40.0, -104.7, 40.0)
+    assert_cover(-105.0, 39.7, -105.0, 40.3)
+
+def test_edges_of_the_map():
+    assert_cover(179.5, 10.0, 180.0, 10.5)
+    assert_cover(-180.0, -10.5, -179.5, -10.0)
+    assert_cover(20.0, 89.6, 20.5, 90.0)
+    assert_cover(20.0, -90.0, 20.5, -89.6)
+
+def test_invalid_and_too_large_boxes():
+    with pytest.raises(ValueError):
+        dynamodb_query.geohash_cells(-104.0, 40.0, -105.0, 41.0)
+
+    with pytest.raises(ValueError):
+        dynamodb_query.geohash_cells(-110.0, 35.0, -100.0, 45.0)
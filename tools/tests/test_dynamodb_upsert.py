@@ -0,0 +1,77 @@
+# Description: Tests of the write-if-changed upserts of mros_insert_into_dynamodb (dynamodb_upsert.py): the item_hash
+# of the same record read from differently typed/formatted files, the lookup against the fake DynamoDB of the
+# pipeline harness, and items without a record_hash being left out of the writes.
+# Usage: python -m pytest tools/tests/test_dynamodb_upsert.py
+# Author: Angus Watters
+
+import pandas as pd
+import pytest
+
+from mros_insert_into_dynamodb import dynamodb_items
+from mros_insert_into_dynamodb import dynamodb_upsert
+
+TABLE = "mros-test-table"
+
+def test_item_hash_ignores_number_formatting():
+    base = {"record_hash": {"S": "abc"}, "n": {"N": "3"}, "x": {"N": "0.5"}}
+
+    assert dynamodb_upsert.item_hash(base) == dynamodb_upsert.item_hash(
+        {"record_hash": {"S": "abc"}, "n": {"N": "3.0"}, "x": {"N": "5E-1"}})
+
+    # a column read as strings in another file
+    assert dynamodb_upsert.item_hash(base) == dynamodb_upsert.item_hash(
+        {"record_hash": {"S": "abc"}, "n": {"S": "3"}, "x": {"S": "0.50"}})
+
+    assert dynamodb_upsert.item_hash(base) != dynamodb_upsert.item_hash(
+        {"record_hash": {"S": "abc"}, "n": {"N": "3.5"}, "x": {"N": "0.5"}})
+
+    assert dynamodb_upsert.item_hash({"a": {"S": "Snow"}}) != dynamodb_upsert.item_hash({"a": {"S": "snow"}})
+    assert dynamodb_upsert.item_hash({"a": {"BOOL": True}}) != dynamodb_upsert.item_hash({"a": {"S": "True"}})
+
+def test_item_hash_does_not_depend_on_the_chunk():
+    # "count" only has whole numbers in the first chunk (written as "3"), not in the second one (written as "3.0")
+    df     = pd.DataFrame({"record_hash": ["a", "b"], "count": [3.0, 2.5], "user": ["u1", "u2"]})
+    whole  = dynamodb_items.dataframe_to_items(df.iloc[:1])
+    mixed  = dynamodb_items.dataframe_to_items(df)
+    string = dynamodb_items.dataframe_to_items(df.iloc[:1].astype(str))
+
+    assert whole[0]["count"] != mixed[0]["count"]
+    assert dynamodb_upsert.item_hash(whole[0]) == dynamodb_upsert.item_hash(mixed[0]) == \
+           dynamodb_upsert.item_hash(string[0])
+
+def test_changed_items(fake):
+    items = dynamodb_upsert.add_item_hashes([
+        {"record_hash": {"S": "a"}, "v": {"N": "1"}},
+        {"record_hash": {"S": "b"}, "v": {"N": "2"}},
+        ])
+
+    for item in items:
+        fake.dynamodb.put_item(TableName=TABLE, Item=item)
+
+    new = dynamodb_upsert.add_item_hashes([
+        {"record_hash": {"S": "a"}, "v": {"N": "1.0"}},   # unchanged
+        {"record_hash": {"S": "b"}, "v": {"N": "3"}},     # changed
+        {"record_hash": {"S": "c"}, "v": {"N": "1"}},     # new
+        {"v": {"N": "4"}},                                # no key: dropped
+        ])
+
+    changed, stats = dynamodb_upsert.changed_items(new, TABLE)
+
+    assert [item["record_hash"]["S"] for item in changed] == ["b", "c"]
+    assert stats["skipped"] == 1
+    assert stats["unkeyed"] == 1
+
+def test_items_without_key_are_not_written(fake, monkeypatch):
+    from mros_insert_into_dynamodb import mros_insert_into_dynamodb as handler
+
+    # a BatchWriteItem request holding an item without the key is rejected as a whole
+    df = pd.DataFrame({"record_hash": ["a", None, "c"], "v": [1.0, 2.0, 3.0]})
+
+    for write_if_changed in (True, False):
+        monkeypatch.setattr(dynamodb_upsert, "WRITE_IF_CHANGED", write_if_changed)
+        fake.dynamodb.tables[TABLE].clear()
+
+        stats = handler.pandas_to_dynamodb(df, TABLE)
+
+        assert sorted(fake.dynamodb.tables[TABLE]) == ["a", "c"]
+        assert (stats["written"], stats["unkeyed"]) == (2, 1)
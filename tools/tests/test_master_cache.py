@@ -0,0 +1,79 @@
+# Description: Tests of the /tmp master dataset cache of mros_append_daily_data (master_cache.py) against the fake S3
+# of the pipeline harness: files written by the container are cached with the ETag of their PutObject response, so
+# reading them back is a cache hit, a file another appender overwrote right after the upload is downloaded again, and
+# projected reads of uncached files and files too large to cache are not downloaded.
+# Usage: python -m pytest tools/tests/test_master_cache.py
+# Author: Angus Watters
+
+import pandas as pd
+import pytest
+
+BUCKET = "mros-test-output"
+URI    = f"s3://{BUCKET}/mros_output/snapshots/test.parquet"
+
+@pytest.fixture
+def cache_module(fake, monkeypatch, tmp_path):
+    """master_cache enabled, with an empty index in a temporary directory."""
+    from mros_append_daily_data import master_cache
+
+    monkeypatch.setattr(master_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(master_cache, "CACHE_MAX_BYTES", 64 * 1024 * 1024)
+    monkeypatch.setattr(master_cache, "_index", master_cache.OrderedDict())
+
+    master_cache.reset_stats()
+
+    return master_cache
+
+def master_df(n):
+    return pd.DataFrame({"id": [f"rec{i}" for i in range(n)], "record_hash": [f"hash{i:05d}" for i in range(n)]})
+
+def s3_calls(fake):
+    return fake.counter.by_stage()["harness"]
+
+def test_written_file_is_cached_without_a_head_request(fake, cache_module):
+    from mros_append_daily_data import master_store
+
+    master_store.write_master(master_df(10), URI)
+
+    assert "s3.HeadObject" not in s3_calls(fake)
+    assert cache_module.fetch(URI) is not None
+    assert cache_module.cache_stats()["hits"] == 1
+
+def test_file_overwritten_after_the_upload_is_downloaded_again(fake, cache_module):
+    from mros_append_daily_data import master_store
+
+    master_store.write_master(master_df(10), URI)
+
+    # another appender overwrites the file before this container reads it back
+    fake.s3.put_object(Bucket=BUCKET, Key=URI.split("/", 3)[3], Body=b"other appender")
+
+    path = cache_module.fetch(URI)
+
+    assert cache_module.cache_stats()["misses"] == 1
+    with open(path, "rb") as f:
+        assert f.read() == b"other appender"
+
+def test_projected_reads_of_uncached_files_do_not_download_them(fake, cache_module):
+    fake.s3.put_object(Bucket=BUCKET, Key=URI.split("/", 3)[3], Body=b"x" * 1000)
+
+    assert cache_module.fetch(URI, columns=["record_hash"]) is None
+    assert "s3.GetObject" not in s3_calls(fake)
+
+    stats = cache_module.cache_stats()
+    assert (stats["projected"], stats["misses"], stats["bytes_downloaded"]) == (1, 0, 0)
+
+    # a full read downloads and caches it, projected reads of the cached copy are then hits
+    assert cache_module.fetch(URI) is not None
+    assert cache_module.fetch(URI, columns=["record_hash"]) is not None
+    assert cache_module.cache_stats()["hits"] == 1
+    assert cache_module.cache_stats()["bytes_downloaded"] == 1000
+
+def test_files_too_large_to_cache_are_not_downloaded(fake, cache_module, monkeypatch):
+    monkeypatch.setattr(cache_module, "CACHE_MAX_BYTES", 100)
+    fake.s3.put_object(Bucket=BUCKET, Key=URI.split("/", 3)[3], Body=b"x" * 1000)
+
+    assert cache_module.fetch(URI) is None
+    assert "s3.GetObject" not in s3_calls(fake)
+
+    stats = cache_module.cache_stats()
+    assert (stats["uncached"], stats["bytes_downloaded"]) == (1, 0)
@@ -0,0 +1,308 @@
+# Description: Tests of the master dataset commit protocol (mros_append_daily_data/master_manifest.py) against the
+# fake S3 of the pipeline harness (conditional writes with IfMatch/IfNoneMatch). Appenders and compactions are
+# interleaved by running the "other" appender right before a manifest write, so the write loses the race, and
+# with threads. After each scenario every record is in the master dataset exactly once and every file under the
+# master prefix is referenced by the manifest.
+# Usage: python -m pytest tools/tests/test_master_manifest.py
+# Author: Angus Watters
+
+# general utility libraries
+import threading
+
+import pandas as pd
+import pytest
+
+BUCKET = "mros-test-output"
+PREFIX = "mros_output"
+
+@pytest.fixture
+def manifest_module(fake, monkeypatch):
+    """master_manifest with the retry sleeps turned off."""
+    from mros_append_daily_data import master_manifest
+
+    monkeypatch.setattr(master_manifest, "backoff", lambda attempt: None)
+
+    return master_manifest
+
+def records(numbers):
+    """New records (master dataset column names) numbered as given."""
+    numbers = list(numbers)
+
+    return pd.DataFrame({
+        "id": [f"rec{n}" for n in numbers],
+        "timestamp": [1718409600.0 + 60 * n for n in numbers],
+        "user": [f"user_{n % 7}" for n in numbers],
+        "latitude": [39.0 + n / 1000 for n in numbers],
+        "longitude": [-105.0 - n / 1000 for n in numbers],
+        "duplicate_id": [f"user_{n % 7}_{n}" for n in numbers],
+        "record_hash": [f"hash{n:05d}" for n in numbers],
+    })
+
+def append(master_manifest, numbers, source="s3://mros-test-prod/input.csv"):
+    """Commit records to the master dataset like the handler does."""
+    return master_manifest.commit_append(
+        bucket             = BUCKET,
+        prefix             = PREFIX,
+        input_df           = records(numbers),
+        source_uri         = source,
+        legacy_parquet_uri = f"s3://{BUCKET}/{PREFIX}.parquet",
+        legacy_csv_uri     = f"s3://{BUCKET}/{PREFIX}.csv"
+        )
+
+def compact_latest(master_manifest):
+    manifest, etag = master_manifest.read_manifest(BUCKET, PREFIX)
+    return master_manifest.compact(BUCKET, PREFIX, manifest, etag)
+
+def master_hashes(master_manifest):
+    """record_hash of every record in the master dataset (snapshot + deltas), duplicates included."""
+    manifest, _ = master_manifest.read_manifest(BUCKET, PREFIX)
+    df = master_manifest.read_manifest_columns(BUCKET, manifest, ["record_hash"])
+
+    return sorted(df["record_hash"].astype(str))
+
+def expected_hashes(numbers):
+    return sorted(f"hash{n:05d}" for n in set(numbers))
+
+def data_files(fake):
+    """Snapshot and delta files in S3."""
+    return set(fake.s3.keys(BUCKET, f"{PREFIX}/snapshots/")) | set(fake.s3.keys(BUCKET, f"{PREFIX}/deltas/"))
+
+def assert_consistent(fake, master_manifest, numbers):
+    """Every record exactly once, and no snapshot/delta files the manifest does not know about."""
+    assert master_hashes(master_manifest) == expected_hashes(numbers)
+
+    manifest, _ = master_manifest.read_manifest(BUCKET, PREFIX)
+    assert data_files(fake) == master_manifest.referenced_keys(manifest)
+
+def run_before_put(monkeypatch, master_manifest, action):
+    """Run action() right before the next manifest write, so that write loses the race against it."""
+    put_manifest = master_manifest.put_manifest
+    pending      = [action]
+
+    def put_after_action(*args, **kwargs):
+        if pending:
+            pending.pop()()
+        return put_manifest(*args, **kwargs)
+
+    monkeypatch.setattr(master_manifest, "put_manifest", put_after_action)
+
+def test_first_append_bootstraps_manifest(fake, manifest_module):
+    stats = append(manifest_module, range(10))
+
+    assert stats["appended"] == 10
+    assert stats["version"] == 1
+    assert_consistent(fake, manifest_module, range(10))
+
+def test_existing_records_are_not_appended_again(fake, manifest_module):
+    append(manifest_module, range(10))
+    stats = append(manifest_module, range(5, 15))
+
+    assert stats["appended"] == 5
+    assert_consistent(fake, manifest_module, range(15))
+
+def test_lost_race_retries_commit(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+    run_before_put(monkeypatch, manifest_module, lambda: append(manifest_module, range(20, 30)))
+
+    stats = append(manifest_module, range(10, 20))
+
+    assert stats["retries"] == 1
+    assert stats["appended"] == 10
+    assert stats["version"] == 3
+    assert_consistent(fake, manifest_module, range(30))
+
+def test_lost_race_rechecks_records_committed_meanwhile(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+    run_before_put(monkeypatch, manifest_module, lambda: append(manifest_module, range(15, 25)))
+
+    stats = append(manifest_module, range(10, 20))
+
+    # 15-19 were committed by the other appender, the delta is rewritten without them (and the first one deleted)
+    assert stats["appended"] == 5
+    assert_consistent(fake, manifest_module, range(25))
+
+def test_lost_race_with_all_records_committed_meanwhile(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+    run_before_put(monkeypatch, manifest_module, lambda: append(manifest_module, range(10, 20)))
+
+    stats = append(manifest_module, range(10, 20))
+
+    assert stats["appended"] == 0
+    assert stats["retries"] == 1
+    assert_consistent(fake, manifest_module, range(20))
+
+def test_lost_race_against_compaction_rechecks_snapshot(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+
+    def append_and_compact():
+        append(manifest_module, range(15, 25))
+        compact_latest(manifest_module)
+
+    run_before_put(monkeypatch, manifest_module, append_and_compact)
+
+    stats = append(manifest_module, range(10, 20))
+
+    assert stats["appended"] == 5
+    assert_consistent(fake, manifest_module, range(25))
+
+def test_commit_whose_response_was_lost(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+
+    # the write goes through but the appender sees a conflict (e.g. a retried request after a lost response)
+    put_manifest = manifest_module.put_manifest
+    calls        = []
+
+    def put_then_conflict(*args, **kwargs):
+        put_manifest(*args, **kwargs)
+        calls.append(1)
+        if len(calls) == 1:
+            raise manifest_module.ManifestConflictError("lost response")
+
+    monkeypatch.setattr(manifest_module, "put_manifest", put_then_conflict)
+
+    stats = append(manifest_module, range(10, 20))
+
+    assert stats["appended"] == 10
+    assert len(calls) == 1
+    assert_consistent(fake, manifest_module, range(20))
+
+def test_commit_gives_up_after_max_retries(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+    monkeypatch.setattr(manifest_module, "MAX_COMMIT_RETRIES", 2)
+
+    # every commit attempt loses the race against another appender
+    put_manifest = manifest_module.put_manifest
+    other        = iter(range(100, 200))
+
+    def put_after_other_append(*args, **kwargs):
+        monkeypatch.setattr(manifest_module, "put_manifest", put_manifest)
+        append(manifest_module, [next(other)])
+        monkeypatch.setattr(manifest_module, "put_manifest", put_after_other_append)
+        return put_manifest(*args, **kwargs)
+
+    monkeypatch.setattr(manifest_module, "put_manifest", put_after_other_append)
+
+    with pytest.raises(manifest_module.ManifestConflictError):
+        append(manifest_module, range(10, 20))
+
+    monkeypatch.setattr(manifest_module, "put_manifest", put_manifest)
+
+    # the delta of the failed commit is deleted
+    assert_consistent(fake, manifest_module, list(range(10)) + [100, 101, 102])
+
+def test_compaction_folds_deltas(fake, manifest_module):
+    for start in range(0, 30, 10):
+        append(manifest_module, range(start, start + 10))
+
+    master_df, version = compact_latest(manifest_module)
+
+    manifest, _ = manifest_module.read_manifest(BUCKET, PREFIX)
+
+    assert len(master_df) == 30
+    assert version == manifest["version"] == 4
+    assert manifest["deltas"] == []
+    assert len(manifest["garbage"]) == 3
+    assert_consistent(fake, manifest_module, range(30))
+
+def test_compaction_keeps_deltas_committed_meanwhile(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+    append(manifest_module, range(10, 20))
+
+    run_before_put(monkeypatch, manifest_module, lambda: append(manifest_module, range(20, 30)))
+
+    master_df, version = compact_latest(manifest_module)
+
+    manifest, _ = manifest_module.read_manifest(BUCKET, PREFIX)
+
+    assert len(master_df) == 20
+    assert version == manifest["version"]
+    assert len(manifest["deltas"]) == 1
+    assert_consistent(fake, manifest_module, range(30))
+
+def test_compaction_gives_up_when_another_appender_compacted(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+    append(manifest_module, range(10, 20))
+
+    run_before_put(monkeypatch, manifest_module, lambda: compact_latest(manifest_module))
+
+    assert compact_latest(manifest_module) == (None, None)
+
+    manifest, _ = manifest_module.read_manifest(BUCKET, PREFIX)
+
+    # only the winner's snapshot is left
+    assert len(fake.s3.keys(BUCKET, f"{PREFIX}/snapshots/")) == 1
+    assert_consistent(fake, manifest_module, range(20))
+
+def test_compaction_whose_response_was_lost(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+    append(manifest_module, range(10, 20))
+
+    put_manifest = manifest_module.put_manifest
+
+    def put_then_conflict(*args, **kwargs):
+        put_manifest(*args, **kwargs)
+        monkeypatch.setattr(manifest_module, "put_manifest", put_manifest)
+        raise manifest_module.ManifestConflictError("lost response")
+
+    monkeypatch.setattr(manifest_module, "put_manifest", put_then_conflict)
+
+    master_df, version = compact_latest(manifest_module)
+
+    manifest, _ = manifest_module.read_manifest(BUCKET, PREFIX)
+
+    # the compactor recognises its own snapshot and keeps it
+    assert len(master_df) == 20
+    assert manifest["snapshot"]["key"] in fake.s3.keys(BUCKET, f"{PREFIX}/snapshots/")
+    assert_consistent(fake, manifest_module, range(20))
+
+def test_superseded_files_are_deleted_after_grace_period(fake, manifest_module, monkeypatch):
+    append(manifest_module, range(10))
+    append(manifest_module, range(10, 20))
+    compact_latest(manifest_module)
+
+    first_garbage = {entry["key"] for entry in manifest_module.read_manifest(BUCKET, PREFIX)[0]["garbage"]}
+
+    # still within the grace period: kept
+    append(manifest_module, range(20, 30))
+    compact_latest(manifest_module)
+
+    assert first_garbage <= data_files(fake)
+
+    monkeypatch.setattr(manifest_module, "GC_GRACE_SECONDS", 0)
+
+    append(manifest_module, range(30, 40))
+    compact_latest(manifest_module)
+
+    manifest, _ = manifest_module.read_manifest(BUCKET, PREFIX)
+
+    assert not first_garbage & data_files(fake)
+    assert [entry["key"] for entry in manifest["garbage"]] != []
+    assert_consistent(fake, manifest_module, range(40))
+
+def test_concurrent_appenders(fake, manifest_module, monkeypatch):
+    monkeypatch.setattr(manifest_module, "MAX_COMMIT_RETRIES", 100)
+
+    # 4 appenders, each appends 6 overlapping batches and compacts like the handler does
+    batches = [[range(start, start + 25) for start in range(worker * 10, 200, 40)] for worker in range(4)]
+    errors  = []
+
+    def appender(worker_batches):
+        try:
+            for numbers in worker_batches:
+                stats = append(manifest_module, numbers)
+                if stats["appended"] and len(stats["manifest"]["deltas"]) >= 3:
+                    manifest_module.compact(BUCKET, PREFIX, stats["manifest"], stats["etag"])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=appender, args=(worker_batches,)) for worker_batches in batches]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+    numbers = [n for worker_batches in batches for batch in worker_batches for n in batch]
+    assert_consistent(fake, manifest_module, numbers)
@@ -0,0 +1,53 @@
+# Description: Tests of the declared master dataset schema (mros_append_daily_data/master_schema.py): undeclared
+# columns in the MASTER_UNKNOWN_COLUMNS modes, and coercion failures of declared columns.
+# Usage: python -m pytest tools/tests/test_master_schema.py
+# Author: Angus Watters
+
+# general utility libraries
+import io
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from mros_append_daily_data import master_schema
+
+def records():
+    return pd.DataFrame({
+        "id": ["rec1", "rec2"],
+        "timestamp": [1718409600.0, 1718409660.0],
+        "duplicate_count": ["1", "2.0"],
+        "record_hash": ["hash1", "hash2"],
+        "new_upstream_column": [1.5, None],
+    })
+
+def test_unknown_columns_are_kept_as_strings():
+    df = master_schema.coerce_to_schema(records(), "string")
+
+    assert df["new_upstream_column"].tolist()[0] == "1.5"
+    assert pd.isna(df["new_upstream_column"].tolist()[1])
+    assert df["duplicate_count"].tolist() == [1, 2]
+
+    table = pq.read_table(io.BytesIO(master_schema.to_parquet_bytes(df)))
+    assert str(table.schema.field("new_upstream_column").type) == "string"
+
+def test_unknown_columns_are_dropped():
+    df = master_schema.coerce_to_schema(records(), "drop")
+
+    assert "new_upstream_column" not in df.columns
+    assert len(df) == 2
+
+def test_unknown_columns_fail():
+    with pytest.raises(master_schema.SchemaDriftError):
+        master_schema.coerce_to_schema(records(), "fail")
+
+    with pytest.raises(ValueError):
+        master_schema.coerce_to_schema(records(), "ignore")
+
+@pytest.mark.parametrize("mode", master_schema.UNKNOWN_COLUMN_MODES)
+def test_coercion_failures_always_raise(mode):
+    df = records()
+    df["duplicate_count"] = ["1", "two"]
+
+    with pytest.raises(master_schema.SchemaDriftError):
+        master_schema.coerce_to_schema(df, mode)
@@ -0,0 +1,133 @@
+# Description: Tests of the summary tables of the master dataset (mros_append_daily_data/master_summaries.py) against
+# the fake S3 of the pipeline harness: the counts after appends and compactions, and the table files left in S3 (only
+# the files of the current state and of the garbage within the grace period).
+# Usage: python -m pytest tools/tests/test_master_summaries.py
+# Author: Angus Watters
+
+import pandas as pd
+import pytest
+
+BUCKET = "mros-test-output"
+PREFIX = "mros_output"
+
+@pytest.fixture
+def modules(fake, monkeypatch):
+    """master_manifest and master_summaries with the retry sleeps turned off."""
+    from mros_append_daily_data import master_manifest
+    from mros_append_daily_data import master_summaries
+
+    monkeypatch.setattr(master_manifest, "backoff", lambda attempt: None)
+
+    return master_manifest, master_summaries
+
+def records(numbers):
+    """New records (master dataset column names) numbered as given."""
+    numbers = list(numbers)
+
+    return pd.DataFrame({
+        "id": [f"rec{n}" for n in numbers],
+        "timestamp": [1718409600.0 + 60 * n for n in numbers],
+        "user": [f"user_{n % 7}" for n in numbers],
+        "latitude": [39.0 + n / 1000 for n in numbers],
+        "longitude": [-105.0 - n / 1000 for n in numbers],
+        "phase": [["Rain", "Snow", "Mixed"][n % 3] for n in numbers],
+        "duplicate_id": [f"user_{n % 7}_{n}" for n in numbers],
+        "record_hash": [f"hash{n:05d}" for n in numbers],
+    })
+
+def append_and_summarise(master_manifest, master_summaries, numbers):
+    """Commit records and update the summaries like the handler does."""
+    commit = master_manifest.commit_append(
+        bucket             = BUCKET,
+        prefix             = PREFIX,
+        input_df           = records(numbers),
+        source_uri         = "s3://mros-test-prod/input.csv",
+        legacy_parquet_uri = f"s3://{BUCKET}/{PREFIX}.parquet",
+        legacy_csv_uri     = f"s3://{BUCKET}/{PREFIX}.csv"
+        )
+
+    return master_summaries.update_summaries(BUCKET, PREFIX, commit["manifest"])
+
+def phase_counts(master_summaries):
+    df = master_summaries.read_summary(BUCKET, PREFIX, "phase_counts")
+    return dict(zip(df["phase"].astype(str), df["n_obs"]))
+
+def table_files(fake, master_summaries):
+    return {key for key in fake.s3.keys(BUCKET, master_summaries.summaries_prefix(PREFIX) + "/")
+            if key.endswith(".parquet")}
+
+def current_state(master_manifest, master_summaries):
+    return master_manifest.read_json(BUCKET, master_summaries.summaries_key(PREFIX))[0]
+
+def test_counts_after_appends_and_compaction(fake, modules):
+    master_manifest, master_summaries = modules
+
+    append_and_summarise(master_manifest, master_summaries, range(30))
+    append_and_summarise(master_manifest, master_summaries, range(20, 45))
+
+    manifest, etag = master_manifest.read_manifest(BUCKET, PREFIX)
+    master_manifest.compact(BUCKET, PREFIX, manifest, etag)
+
+    stats = append_and_summarise(master_manifest, master_summaries, range(45, 60))
+
+    assert not stats["rebuilt"]
+    assert phase_counts(master_summaries) == {"Rain": 20, "Snow": 20, "Mixed": 20}
+
+def test_superseded_table_files_are_deleted_after_grace_period(fake, modules, monkeypatch):
+    master_manifest, master_summaries = modules
+
+    append_and_summarise(master_manifest, master_summaries, range(10))
+    first_tables = set(current_state(master_manifest, master_summaries)["tables"].values())
+
+    # within the grace period the replaced files are kept as garbage
+    append_and_summarise(master_manifest, master_summaries, range(10, 20))
+    state = current_state(master_manifest, master_summaries)
+
+    assert first_tables <= table_files(fake, master_summaries)
+    assert table_files(fake, master_summaries) == master_summaries.state_keys(state)
+
+    monkeypatch.setattr(master_manifest, "GC_GRACE_SECONDS", 0)
+
+    for start in range(20, 50, 10):
+        append_and_summarise(master_manifest, master_summaries, range(start, start + 10))
+
+    state = current_state(master_manifest, master_summaries)
+
+    assert not first_tables & table_files(fake, master_summaries)
+    assert table_files(fake, master_summaries) == master_summaries.state_keys(state)
+    assert len(table_files(fake, master_summaries)) == 2 * len(master_summaries.SUMMARY_TABLES)
+
+def test_lost_race_deletes_its_table_files(fake, modules, monkeypatch):
+    master_manifest, master_summaries = modules
+
+    append_and_summarise(master_manifest, master_summaries, range(10))
+
+    # another appender commits (and updates the summaries) right before this update writes the summary state
+    put_json = master_manifest.put_json
+    pending  = [lambda: append_and_summarise(master_manifest, master_summaries, range(10, 20))]
+
+    def put_after_other_update(bucket, key, body, etag):
+        if pending and key == master_summaries.summaries_key(PREFIX):
+            monkeypatch.setattr(master_manifest, "put_json", put_json)
+            pending.pop()()
+            monkeypatch.setattr(master_manifest, "put_json", put_after_other_update)
+        return put_json(bucket, key, body, etag)
+
+    manifest, _ = master_manifest.read_manifest(BUCKET, PREFIX)
+    monkeypatch.setattr(master_manifest, "put_json", put_after_other_update)
+
+    commit = master_manifest.commit_append(
+        bucket             = BUCKET,
+        prefix             = PREFIX,
+        input_df           = records(range(20, 30)),
+        source_uri         = "s3://mros-test-prod/input.csv",
+        legacy_parquet_uri = f"s3://{BUCKET}/{PREFIX}.parquet",
+        legacy_csv_uri     = f"s3://{BUCKET}/{PREFIX}.csv"
+        )
+    stats = master_summaries.update_summaries(BUCKET, PREFIX, commit["manifest"])
+
+    state = current_state(master_manifest, master_summaries)
+
+    assert stats["retries"] == 1
+    assert sum(phase_counts(master_summaries).values()) == 30
+    assert table_files(fake, master_summaries) == master_summaries.state_keys(state)
@@ -0,0 +1,165 @@
+# Description: Tests of the near duplicate (double-tap) detection of mros_airtable_to_sqs (near_duplicates.py): the
+# vectorized detection against a brute force reference (all pairs, records kept in time order) on random batches,
+# including batches around the 180 degree meridian, long chains (result and scaling), the modes of
+# handle_near_duplicates() and the near_duplicate_of field of the SQS message bodies.
+# Usage: python -m pytest tools/tests/test_near_duplicates.py
+# Author: Angus Watters
+
+# general utility libraries
+import math
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mros_airtable_to_sqs import near_duplicates
+
+def brute_force(users, lat, lon, times, window_s, distance_m):
+    """Reference: go through the records in time order, compare each record with every kept record."""
+    times_ms  = [round(t * 1000) for t in times]
+    window_ms = math.ceil(window_s * 1000)
+
+    order  = sorted(range(len(users)), key=lambda i: (times_ms[i], i))
+    parent = [-1] * len(users)
+    kept   = []
+
+    for i in order:
+        for k in kept:
+            if users[k] == users[i] and abs(times_ms[i] - times_ms[k]) <= window_ms and \
+               near_duplicates.haversine_m(lat[i], lon[i], lat[k], lon[k]) <= distance_m:
+                parent[i] = k
+                break
+        else:
+            kept.append(i)
+
+    return parent
+
+def random_batch(rng, n, lon_center):
+    """n records of a few users, clustered in time and space so that many of them are close."""
+    users = [f"user_{u}" for u in rng.integers(0, 4, n)]
+    lat   = 40 + rng.normal(0, 0.0004, n)
+    lon   = lon_center + rng.normal(0, 0.0005, n)
+    times = 1718409600 + rng.integers(0, 240_000, n) / 1000
+
+    # wrap longitudes around the 180 degree meridian
+    lon = (lon + 180) % 360 - 180
+
+    return users, lat, lon, times
+
+@pytest.mark.parametrize("lon_center", [-105.0, 179.9995, -179.9995])
+def test_matches_brute_force(lon_center):
+    rng = np.random.default_rng(int(abs(lon_center) * 1000))
+
+    for case in range(100):
+        n                        = int(rng.integers(2, 60))
+        users, lat, lon, times   = random_batch(rng, n, lon_center)
+        window_s, distance_m     = float(rng.choice([5, 30, 60])), float(rng.choice([20, 50, 120]))
+
+        expected = brute_force(users, lat, lon, times, window_s, distance_m)
+        found    = near_duplicates.find_near_duplicates(users, lat, lon, times, window_s, distance_m)
+
+        assert found.tolist() == expected, f"case {case}"
+
+def test_across_the_antimeridian():
+    # 2 records ~22 m apart on either side of the 180 degree meridian
+    parent = near_duplicates.find_near_duplicates(["a", "a"], [10.0, 10.0], [179.9999, -179.9999], [0.0, 5.0], 30, 50)
+
+    assert parent.tolist() == [-1, 0]
+
+def test_chains_are_compared_with_the_kept_record():
+    # a submission every 25 s from the same spot: each record is close to the previous one,
+    # but only every other record is close to a kept one
+    times  = [0.0, 25.0, 50.0, 75.0, 100.0]
+    parent = near_duplicates.find_near_duplicates(["a"] * 5, [40.0] * 5, [-105.0] * 5, times, 30, 50)
+
+    assert parent.tolist() == [-1, 0, -1, 2, -1]
+
+def test_other_users_missing_values_and_far_records_are_not_near_duplicates():
+    users  = ["a", "b", "a", "a", None]
+    lat    = [40.0, 40.0, 41.0, None, 40.0]
+    lon    = [-105.0] * 5
+    parent = near_duplicates.find_near_duplicates(users, lat, lon, [0.0, 1.0, 2.0, 3.0, 4.0], 30, 50)
+
+    assert parent.tolist() == [-1] * 5
+
+def records_df():
+    return pd.DataFrame({
+        "id": ["rec1", "rec2", "rec3"],
+        "user": ["a", "a", "b"],
+        "latitude": [40.0, 40.0001, 40.0],
+        "longitude": [-105.0, -105.0, -105.0],
+        "timestamp": [1718409600.0, 1718409605.0, 1718409606.0],
+    })
+
+def test_flag_mode_marks_near_duplicates():
+    df, count = near_duplicates.handle_near_duplicates(records_df(), "flag", 30, 50)
+
+    assert count == 1
+    assert len(df) == 3
+    assert df["near_duplicate"].tolist() == [False, True, False]
+    assert df["near_duplicate_of"].tolist() == [None, "rec1", None]
+
+def test_drop_and_off_modes():
+    dropped, count = near_duplicates.handle_near_duplicates(records_df(), "drop", 30, 50)
+
+    assert count == 1
+    assert dropped["id"].tolist() == ["rec1", "rec3"]
+
+    unchanged, count = near_duplicates.handle_near_duplicates(records_df(), "off", 30, 50)
+
+    assert count == 0
+    assert unchanged.equals(records_df())
+
+    with pytest.raises(ValueError):
+        near_duplicates.handle_near_duplicates(records_df(), "delete")
+
+def test_default_mode_is_flag():
+    assert near_duplicates.NEAR_DUPLICATE_MODE == "flag"
+
+def test_near_duplicate_of_is_sent_without_changing_the_record_hash():
+    from mros_airtable_to_sqs import mros_airtable_to_sqs
+
+    airtable_records = [{
+        "id": f"rec{i}",
+        "createdTime": "2024-06-15T00:00:00.000Z",
+        "fields": {
+            "phase": "Snow", "latitude": 40.0, "longitude": -105.0, "user": "user_1",
+            "time_submitted_local": "18:00:0%d" % i, "date_submitted_local": "06/14/24",
+            "time_submitted_utc": "00:00:0%d" % i, "date_submitted_utc": "06/15/24",
+            "datetime_received_pacific": "2024-06-15T00:00:0%d.000Z" % i,
+        }
+    } for i in (1, 4)]
+
+    flagged = mros_airtable_to_sqs.build_messages(mros_airtable_to_sqs.records_to_dataframe(airtable_records))
+
+    df, _    = near_duplicates.handle_near_duplicates(mros_airtable_to_sqs.records_to_dataframe(airtable_records), "off")
+    unmarked = mros_airtable_to_sqs.build_messages(df)
+
+    assert "near_duplicate_of" not in flagged[0]
+    assert flagged[1]["near_duplicate_of"] == "rec1"
+    assert [m["record_hash"] for m in flagged] == [m["record_hash"] for m in unmarked]
+
+def test_long_chains_are_settled_in_one_sweep():
+    # one user submitting every 25 s from the same spot (window 30 s): every record is close to the previous one
+    def chain(n):
+        times = np.arange(n) * 25.0
+        return ["a"] * n, np.full(n, 40.0), np.full(n, -105.0), times
+
+    parent = near_duplicates.find_near_duplicates(*chain(20000), 30, 50)
+
+    expected = np.where(np.arange(20000) % 2 == 1, np.arange(20000) - 1, -1)
+    assert parent.tolist() == expected.tolist()
+
+    # close to linear: 16x the records take far less than 16^2 the time (settling a record or two per round was
+    # quadratic, ~135x from 2000 to 32000 records)
+    def elapsed(n):
+        args  = chain(n)
+        start = time.perf_counter()
+        near_duplicates.find_near_duplicates(*args, 30, 50)
+        return time.perf_counter() - start
+
+    small = min(elapsed(2000) for _ in range(3))
+    large = min(elapsed(32000) for _ in range(3))
+
+    assert large < 16 * 3 * max(small, 1e-3)
@@ -0,0 +1,83 @@
+# Description: Tests of the pandas-free prod CSV writer of mros_stage_to_prod (prod_csv.py): the CSV text of each
+# date_key is byte for byte what the pandas path writes, on batches mixing ints, floats, bools, strings and missing
+# values, and batches pandas would type differently are left to the pandas path.
+# Usage: python -m pytest tools/tests/test_prod_csv.py
+# Author: Angus Watters
+
+import pandas as pd
+import pytest
+
+from mros_stage_to_prod import prod_csv
+
+def pandas_csv_files(records):
+    """Reference: the pandas path of mros_stage_to_prod (record_hash moved last, one CSV per date_key)."""
+    df = pd.DataFrame(records)
+    df.insert(len(df.columns)-1, 'record_hash', df.pop('record_hash'))
+
+    return {date_key: (group_df.to_csv(index=False), len(group_df)) for date_key, group_df in df.groupby('date_key')}
+
+def record(i, **fields):
+    base = {
+        "id": f"rec{i}",
+        "record_hash": f"hash{i}",
+        "phase": "Snow",
+        "latitude": 40.0 + i / 1000,
+        "longitude": -105.0,
+        "timestamp": 1718409600 + i,
+        "date_key": "2024_06_15" if i % 2 else "2024_06_16",
+        }
+    base.update(fields)
+
+    return base
+
+BATCHES = {
+    "plain": [record(i) for i in range(4)],
+    "missing values": [
+        record(0, temp_air=-2.5, comment=None, state="Colorado"),
+        record(1, temp_air=None, comment="wet, heavy snow", state=float("nan")),
+        record(2, temp_air=float("nan"), comment='said "hail"', state="Utah"),
+        ],
+    "ints and floats": [
+        record(0, count=3, elevation=1609, plp=0.5),
+        record(1, count=4, elevation=1609.25, plp=1),
+        record(2, count=5, elevation=None, plp=float("inf")),
+        ],
+    "ints near int64": [
+        record(0, big=2 ** 63 - 1, small=-2 ** 63),
+        record(1, big=2 ** 62, small=0),
+        ],
+    "mixed types": [
+        record(0, flag=True, mixed=1, note="a", other=True),
+        record(1, flag=False, mixed="two", note=3.5, other=None),
+        record(2, flag=True, mixed=2.5, note=False, other=2),
+        ],
+    "quoting and unicode": [
+        record(0, comment="line one\nline two", user="Zoë, 雪"),
+        record(1, comment="tab\there", user="'quoted'"),
+        ],
+    "missing keys and date_key": [
+        {"id": "rec0", "date_key": "2024_06_15", "record_hash": "hash0", "phase": "Rain"},
+        {"id": "rec1", "date_key": None, "record_hash": "hash1", "extra": 1},
+        {"id": "rec2", "date_key": "2024_06_15", "record_hash": "hash2", "extra": 2, "phase": "Mix"},
+        ],
+    }
+
+@pytest.mark.parametrize("name", list(BATCHES))
+def test_same_csv_as_the_pandas_path(name):
+    records = BATCHES[name]
+    files   = prod_csv.group_csv_files(records)
+
+    assert files == pandas_csv_files(records)
+    assert list(files) == sorted(files)
+
+@pytest.mark.parametrize("fields", [
+    {"nested": {"a": 1}},
+    {"nested": [1, 2]},
+    {"big": 2 ** 63},
+    {"small": -2 ** 63 - 1},
+    ])
+def test_batches_pandas_types_differently_use_the_pandas_path(fields):
+    assert prod_csv.group_csv_files([record(0), record(1, **fields)]) is None
+
+def test_batches_without_record_hash_use_the_pandas_path():
+    assert prod_csv.group_csv_files([{"id": "rec0", "date_key": "2024_06_15"}]) is None
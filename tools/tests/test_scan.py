@@ -0,0 +1,75 @@
+# Description: Tests of the filters of the reporting scans (reports/scan.py) on a local prod CSV layout: typed
+# comparisons on declared columns, a clear error for filters on columns that are not in the master dataset schema, and
+# typed filters and values on a Parquet file with every column as strings (the legacy mros_output.parquet).
+# Usage: python -m pytest tools/tests/test_scan.py
+# Author: Angus Watters
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from reports import scan
+
+PROD_CSV = """id,timestamp,name,latitude,longitude,temp_air,temp_air_nearest,date_key,record_hash
+rec1,1718409600,Snow,40.0,-105.0,-2.5,-2.0,2024_06_15,hash1
+rec2,1718409660,Rain,40.1,-105.1,3.0,4.0,2024_06_15,hash2
+rec3,1718409720,Snow,40.2,-105.2,,-0.5,2024_06_15,hash3
+"""
+
+@pytest.fixture
+def prod_dir(tmp_path):
+    day = tmp_path / "2024" / "06" / "15"
+    day.mkdir(parents=True)
+    (day / "abc_1718409600.csv").write_text(PROD_CSV)
+
+    return str(tmp_path)
+
+@pytest.fixture
+def legacy_parquet(tmp_path):
+    # like the old astype(str) master dataset: numbers, timestamps and missing values as strings
+    df = pd.DataFrame({
+        "id": ["rec1", "rec2", "rec3", "rec4"],
+        "state": ["Colorado", "Colorado", "Utah", "Utah"],
+        "temp_air_avg_obs": [-2.5, 10.0, 3.0, None],
+        "temp_air_n_stations": [3.0, 12.0, 9.0, None],
+        "createdtime": pd.to_datetime(["2024-06-15T00:00:00Z", "2024-06-15T06:30:00Z", "2024-06-16T00:00:00Z", None]),
+        "date_key": ["2024_06_15", "2024_06_15", "2024_06_16", "2024_06_16"],
+        })
+    path = tmp_path / "mros_output.parquet"
+    df.astype(str).to_parquet(path, index=False)
+
+    return str(path)
+
+def scan_ids(prod_dir, *clauses):
+    where  = [scan.parse_where(clause) for clause in clauses]
+    tables = scan.scan([prod_dir], ["id"], where)
+
+    return sorted(id_ for table in tables for id_ in table.column("id").to_pylist())
+
+def test_filters_on_declared_columns(prod_dir):
+    assert scan_ids(prod_dir, "temp_air_nearest<0") == ["rec1", "rec3"]
+    assert scan_ids(prod_dir, "phase=Snow", "temp_air_nearest>=-1") == ["rec3"]
+    assert scan_ids(prod_dir, "latitude>40.05") == ["rec2", "rec3"]
+
+def test_filters_on_undeclared_columns_are_rejected(prod_dir):
+    with pytest.raises(ValueError, match="'temp_air'.*master dataset schema.*temp_air_nearest"):
+        scan.parse_where("temp_air<0")
+
+    # also when the clause is built without parse_where()
+    with pytest.raises(ValueError, match="'temp_air'"):
+        list(scan.scan([prod_dir], ["id"], [("temp_air", "<", "0")]))
+
+def test_filters_and_values_on_a_string_typed_parquet_file(legacy_parquet):
+    assert scan_ids(legacy_parquet, "temp_air_avg_obs>2") == ["rec2", "rec3"]
+    assert scan_ids(legacy_parquet, "temp_air_n_stations>=9", "state=Colorado") == ["rec2"]
+    assert scan_ids(legacy_parquet, "createdtime<2024-06-15T12:00:00Z") == ["rec1", "rec2"]
+
+    # typed values, so min/max compare numbers and not strings ("10.0" < "3.0")
+    table = pa.concat_tables(scan.scan([legacy_parquet], ["temp_air_avg_obs", "temp_air_n_stations", "createdtime"],
+                                       since=scan.parse_date("2024-06-15")))
+
+    assert table.column("temp_air_avg_obs").type == pa.float64()
+    assert table.column("temp_air_n_stations").type == pa.int32()
+    assert pa.types.is_timestamp(table.column("createdtime").type)
+    assert max(table.column("temp_air_avg_obs").to_pylist(), key=lambda v: v if v is not None else -1e9) == 10.0
+    assert table.column("temp_air_avg_obs").null_count == 1